@@ -22,7 +22,8 @@ import sys
 import socket
 import select
 import time
-import json
+
+from rstatus_proto import encode_line
 
 hb_per = 60 * 9
 next_hb = int(time.time()) + hb_per
@@ -31,7 +32,7 @@ s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 s.connect("/home/daniel/.irssi/rstatus_sock")
 s.setblocking(False)
 
-s.send(json.dumps({"type": "settings", "send_messages": True}) + "\n")
+s.send(encode_line({"type": "settings", "send_messages": True}))
 messages = True
 
 p = select.poll()
@@ -61,7 +62,7 @@ while True:
             sys.stderr.write("Commands: reset, msgs\n")
 
         if o:
-            s.send(json.dumps(o) + "\n")
+            s.send(encode_line(o))
 
     if time.time() >= next_hb:
         next_hb = int(time.time()) + hb_per
@@ -15,9 +15,17 @@
 # You should have received a copy of the GNU General Public License
 # along with irssi_rstatus.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
+import stat
 import time
+import errno
+import fcntl
 import select
+import socket
+
+def log(text):
+    sys.stderr.write(time.strftime("%Y-%m-%d %H:%M:%S ") + text + "\n")
 
 class DisconnectedError(Exception):
     pass
@@ -25,49 +33,337 @@ class DisconnectedError(Exception):
 class TimeoutError(Exception):
     pass
 
+class Poller:
+    """
+    select.epoll where there is one, otherwise select.poll
+
+    Timeouts are in seconds for both. Descriptors are registered once; only
+    their masks change afterwards. epoll refuses regular files (say, stdin
+    redirected from one); reading or writing those never blocks, so they
+    are reported as ready whenever they ask to be.
+    """
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poll = select.epoll()
+            self._timeout_scale = 1
+            (self.IN, self.OUT, self.ERR, self.HUP) = \
+                (select.EPOLLIN, select.EPOLLOUT,
+                 select.EPOLLERR, select.EPOLLHUP)
+        else:
+            self._poll = select.poll()
+            self._timeout_scale = 1000
+            (self.IN, self.OUT, self.ERR, self.HUP) = \
+                (select.POLLIN, select.POLLOUT,
+                 select.POLLERR, select.POLLHUP)
+
+        # fd -> mask, for descriptors epoll would not take
+        self._always = {}
+
+    def register(self, fd, mask):
+        try:
+            self._poll.register(fd, mask)
+        except (IOError, OSError), e:
+            if e.errno != errno.EPERM:
+                raise
+            self._always[fd] = mask
+
+    def modify(self, fd, mask):
+        if fd in self._always:
+            self._always[fd] = mask
+        else:
+            self._poll.modify(fd, mask)
+
+    def unregister(self, fd):
+        if fd in self._always:
+            del self._always[fd]
+        else:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        ready = [(fd, mask & (self.IN | self.OUT))
+                 for (fd, mask) in self._always.iteritems()
+                 if mask & (self.IN | self.OUT)]
+        if ready:
+            timeout = 0
+        return self._poll.poll(max(0, timeout) * self._timeout_scale) + ready
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def splice_find():
+    # Python 2 has no os.splice; Linux's libc does
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.splice
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def splice(fd_in, fd_out, length):
+        moved = func(fd_in, None, fd_out, None, length,
+                     SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        if moved < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return moved
+
+    return splice
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+# libc has splice() but the kernel can't do it for these descriptors (e.g.
+# AF_UNIX sockets before Linux 4.2)
+splice_unsupported = (errno.EINVAL, errno.ENOSYS)
+F_GETPIPE_SZ = 1032
+splice = splice_find()
+
+def splice_ok(fd):
+    # One end of each splice must be a pipe, and sockets and pipes are the
+    # only things a relay is expected to join that it can move data between
+    mode = os.fstat(fd).st_mode
+    return stat.S_ISSOCK(mode) or stat.S_ISFIFO(mode)
+
 class Peer:
-    READ_TIMEOUT = 1 #60 * 10
-    WRITE_TIMEOUT = 1 #60
+    READ_TIMEOUT = 60 * 10
+    WRITE_TIMEOUT = 60
 
     def __init__(self, pair):
+        # Sockets and files (stdin, stdout) alike are read and written
+        # through their descriptors
         (self._read_file, self._write_file) = pair
-        self._read_file.setblocking(False)
-        self._write_file.setblocking(False)
+        self._read_fd = self._read_file.fileno()
+        self._write_fd = self._write_file.fileno()
+        for fd in set([self._read_fd, self._write_fd]):
+            set_nonblocking(fd)
+
         self._write_buffer = None
         self._timeouts = {}
         self._timeouts["read"] = time.time() + self.READ_TIMEOUT
+        self._poll = None
+        self._handlers = None
+        # Only used when splicing: data on its way to us waits in _pipe
+        # rather than _write_buffer
+        self._pipe = None
+        self._pipe_pending = 0
+        self._reading = True
+        # Set once nothing more will be read from us; the pair then lasts
+        # only until what we sent has been written to the peer
+        self._eof = False
 
     def set_peer(self, peer):
         self.peer = peer
 
-    def poll_setup(self, poll):
-        mask = select.POLLHUP | select.POLLERR | select.POLLIN
+    def splice_setup(self):
+        # Called once both peers are set, for the data coming to this one
+        if splice is None or \
+           not (splice_ok(self.peer._read_fd) and splice_ok(self._write_fd)):
+            return
+
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            set_nonblocking(fd)
+
+        try:
+            self._pipe_size = fcntl.fcntl(self._pipe[1], F_GETPIPE_SZ)
+        except IOError:
+            self._pipe_size = 65536
+
+    def poll_register(self, poll, handlers):
+        self._poll = poll
+        self._handlers = handlers
+        for fd in set([self._read_fd, self._write_fd]):
+            poll.register(fd, self._poll_mask(fd))
+            handlers[fd] = self
 
-        if self._write_buffer != None:
-            mask |= select.POLLOUT
+    def close(self):
+        for fd in set([self._read_fd, self._write_fd]):
+            if not self._eof:
+                self._poll.unregister(fd)
+            del self._handlers[fd]
+        for f in set([self._read_file, self._write_file]):
+            f.close()
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
 
-        # Overwrites old settings:
-        poll.register(self._read_file, mask)
-        poll.register(self._write_file, mask)
+    def _write_pending(self):
+        return self._write_buffer != None or self._pipe_pending > 0
 
-    def polled(self, eventmask):
-        if eventmask & (select.POLLERR | select.POLLHUP):
+    def _poll_mask(self, fd):
+        # Errors and hangups are reported regardless
+        mask = 0
+        if fd == self._read_fd and self._reading:
+            mask |= self._poll.IN
+        if fd == self._write_fd and self._write_pending():
+            mask |= self._poll.OUT
+        return mask
+
+    def _poll_update(self, fd):
+        # Only called when there starts or stops being something to write,
+        # or reading is paused or resumed
+        self._poll.modify(fd, self._poll_mask(fd))
+
+    def _set_reading(self, reading):
+        if reading != self._reading and not self._eof:
+            self._reading = reading
+            self._poll_update(self._read_fd)
+
+    def polled(self, fd, eventmask):
+        poll = self._poll
+
+        if self._eof:
+            # Left over from the same poll
+            return
+
+        if eventmask & poll.ERR:
             raise DisconnectedError
 
-        if eventmask & select.POLLIN:
-            data = self._read_file.recv(1024)
-            if len(data) > 0:
+        if fd == self._read_fd and eventmask & (poll.IN | poll.HUP) and \
+           not self.peer._eof:
+            if self.peer._pipe is not None:
+                moved = self.peer._splice_from(self)
+            else:
+                moved = self._read_buffered()
+
+            if moved == 0:
+                self._read_closed()
+                return
+            if moved != None:
                 self._timeouts["read"] = time.time() + self.READ_TIMEOUT
-                self.peer.add_to_write_buffer(data)
+        elif eventmask & poll.HUP:
+            raise DisconnectedError
+
+        if fd == self._write_fd and eventmask & poll.OUT:
+            if self._pipe_pending > 0:
+                sent = self._splice_to()
+            elif self._write_buffer != None:
+                sent = self._write(self._write_buffer)
+                if sent > 0:
+                    self._write_buffer = self._write_buffer[sent:]
+                    if self._write_buffer == "":
+                        self._write_buffer = None
+            else:
+                sent = 0
 
-        if eventmask & select.POLLOUT and self._write_buffer != None:
-            sent = self._write_file.send(self._write_buffer)
             if sent > 0:
                 self._timeouts["write"] = time.time() + self.WRITE_TIMEOUT
-                self._write_buffer = self._write_buffer[sent:]
-                if self._write_buffer == "":
+                if not self._write_pending():
                     del self._timeouts["write"]
-                    self._write_buffer = None
+                    if self.peer._eof:
+                        raise DisconnectedError
+                    self._poll_update(self._write_fd)
+
+    def _read_closed(self):
+        # EOF (or a hangup) from our side. What we sent may still be in
+        # the peer's pipe or write buffer: that is delivered before the
+        # pair is torn down. Nothing more is read from the peer, and
+        # anything still to be written to us is dropped. Our descriptors
+        # leave the poll so that a hangup isn't reported over and over
+        # meanwhile.
+        if not self.peer._write_pending():
+            raise DisconnectedError
+
+        self.peer._set_reading(False)
+        self._eof = True
+        self._timeouts.pop("write", None)
+        for fd in set([self._read_fd, self._write_fd]):
+            self._poll.unregister(fd)
+
+    def _read_buffered(self):
+        data = self._read()
+        if data == None:
+            return None
+        if data != "":
+            self.peer.add_to_write_buffer(data)
+        return len(data)
+
+    def _read(self):
+        try:
+            return os.read(self._read_fd, 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return None
+            raise DisconnectedError
+
+    def _write(self, data):
+        try:
+            return os.write(self._write_fd, data)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return 0
+            raise DisconnectedError
+
+    def _splice_from(self, source):
+        # Moves what source has read into our pipe, without it passing
+        # through userspace. Returns as _read_buffered does.
+        space = self._pipe_size - self._pipe_pending
+        if space <= 0:
+            source._set_reading(False)
+            return None
+
+        try:
+            moved = splice(source._read_fd, self._pipe[1], space)
+        except OSError, e:
+            if e.errno in splice_unsupported:
+                self._splice_stop()
+                return source._read_buffered()
+            if e.errno != errno.EAGAIN:
+                raise DisconnectedError
+            # Either nothing to read, or the pipe is full (it counts
+            # buffers as well as bytes); wait for us to drain it
+            if self._pipe_pending > 0:
+                source._set_reading(False)
+            return None
+
+        if moved > 0:
+            if self._pipe_pending == 0:
+                self._timeouts["write"] = time.time() + self.WRITE_TIMEOUT
+                self._pipe_pending = moved
+                self._poll_update(self._write_fd)
+            else:
+                self._pipe_pending += moved
+
+        return moved
+
+    def _splice_to(self):
+        try:
+            sent = splice(self._pipe[0], self._write_fd, self._pipe_pending)
+        except OSError, e:
+            if e.errno in splice_unsupported:
+                # What is in the pipe goes out of _write_buffer instead
+                self._splice_stop()
+                return 0
+            if e.errno != errno.EAGAIN:
+                raise DisconnectedError
+            return 0
+
+        self._pipe_pending -= sent
+        if sent > 0:
+            self.peer._set_reading(True)
+        return sent
+
+    def _splice_stop(self):
+        # Back to the buffered path for data coming to us, keeping the
+        # order of anything already in the pipe
+        data = []
+        while self._pipe_pending > 0:
+            chunk = os.read(self._pipe[0], self._pipe_pending)
+            data.append(chunk)
+            self._pipe_pending -= len(chunk)
+        data.append(self._write_buffer or "")
+        self._write_buffer = "".join(data) or None
+
+        for fd in self._pipe:
+            os.close(fd)
+        self._pipe = None
+        self.peer._set_reading(True)
 
     def get_timeout(self):
         return min(self._timeouts.values())
@@ -82,39 +378,43 @@ class Peer:
         if self._write_buffer == None:
             self._timeouts["write"] = time.time() + self.WRITE_TIMEOUT
             self._write_buffer = data
+            self._poll_update(self._write_fd)
         else:
             self._write_buffer += data
 
     def fds(self):
-        return (self._read_file.fileno(), self._write_file.fileno())
+        return (self._read_fd, self._write_fd)
 
-class Relay:
-    def __init__(self, a, b):
-        self._a = Peer(a)
-        self._b = Peer(b)
-        self._a.set_peer(self._b)
-        self._b.set_peer(self._a)
-
-        self._poll = select.poll()
+def pair_add(poll, handlers, a, b, use_splice=True):
+    (a, b) = (Peer(a), Peer(b))
+    a.set_peer(b)
+    b.set_peer(a)
+    if use_splice:
+        a.splice_setup()
+        b.splice_setup()
+    a.poll_register(poll, handlers)
+    b.poll_register(poll, handlers)
+    return (a, b)
 
-    def _update_poll_setup(self):
-        self._a.poll_setup(self._poll)
-        self._b.poll_setup(self._poll)
+class Relay:
+    def __init__(self, a, b, use_splice=True):
+        self._poll = Poller()
+        # fd -> Peer
+        self._handlers = {}
+        (self._a, self._b) = pair_add(self._poll, self._handlers, a, b,
+                                      use_splice)
 
     def _poll_once(self):
         next_timeout = min([self._a.get_timeout(), self._b.get_timeout()])
         next_timeout -= time.time()
 
-        self._update_poll_setup()
         events = self._poll.poll(next_timeout)
 
         self._a.check_timeouts()
         self._b.check_timeouts()
 
         for (fd, eventmask) in events:
-            for peer in [self._a, self._b]:
-                if fd in peer.fds():
-                    peer.polled(eventmask)
+            self._handlers[fd].polled(fd, eventmask)
 
     def run(self):
         try:
@@ -127,11 +427,233 @@ class Relay:
         else:
             return True
 
-def main():
-    import socket
+class MultiRelay:
+    """
+    Relays any number of pairs in one process
+
+    Each connection accepted on listener is paired with what connect()
+    returns, a (read, write) pair like Relay's. A pair that disconnects or
+    times out is closed without disturbing the others, and nor does a
+    failed accept(): the listener is left alone until the next sweep. Rather
+    than finding the nearest deadline among every peer each time round, all
+    of them are checked once every SWEEP_INTERVAL seconds.
+    """
+
+    SWEEP_INTERVAL = 1
+
+    def __init__(self, listener, connect, use_splice=True):
+        self._listener = listener
+        self._connect = connect
+        self._use_splice = use_splice
+        self._listener.setblocking(False)
+
+        self._poll = Poller()
+        # fd -> Peer
+        self._handlers = {}
+        self._pairs = set()
+        self._poll.register(self._listener.fileno(), self._poll.IN)
+        self._accept_paused = False
+        self._next_sweep = time.time() + self.SWEEP_INTERVAL
+
+    def _accept(self):
+        while True:
+            try:
+                (conn, address) = self._listener.accept()
+            except socket.error, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                elif e.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+
+                # e.g. EMFILE: the connection stays queued, so rather than
+                # being woken for it again straight away, wait for a sweep
+                log("Could not accept a connection: {0}".format(e))
+                self._poll.modify(self._listener.fileno(), 0)
+                self._accept_paused = True
+                return
+
+            try:
+                far = self._connect()
+            except (socket.error, OSError):
+                conn.close()
+                continue
+
+            self._pairs.add(pair_add(self._poll, self._handlers,
+                                     (conn, conn), far, self._use_splice))
+
+    def _pair_close(self, peer):
+        pair = (peer, peer.peer)
+        if pair not in self._pairs:
+            pair = (peer.peer, peer)
+
+        self._pairs.remove(pair)
+        for peer in pair:
+            peer.close()
+
+    def _sweep(self):
+        for pair in list(self._pairs):
+            try:
+                for peer in pair:
+                    peer.check_timeouts()
+            except TimeoutError:
+                self._pair_close(pair[0])
+
+        if self._accept_paused:
+            self._accept_paused = False
+            self._poll.modify(self._listener.fileno(), self._poll.IN)
+
+    def _poll_once(self):
+        events = self._poll.poll(self._next_sweep - time.time())
+
+        # Accepting last means no descriptor is reused by a new pair while
+        # events for its old one are still to be handled
+        accept = False
+        listener_fd = self._listener.fileno()
+
+        for (fd, eventmask) in events:
+            if fd == listener_fd:
+                accept = True
+                continue
+
+            peer = self._handlers.get(fd)
+            if peer is None:
+                continue
+
+            try:
+                peer.polled(fd, eventmask)
+            except DisconnectedError:
+                self._pair_close(peer)
+
+        if accept:
+            self._accept()
+
+        if time.time() >= self._next_sweep:
+            self._sweep()
+            self._next_sweep = time.time() + self.SWEEP_INTERVAL
+
+    def run(self):
+        while True:
+            self._poll_once()
+
+def rstatus_connect(path="~/.irssi/rstatus_sock"):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    s.connect("/home/daniel/.irssi/rstatus_sock")
-    r = Relay((s, s), (sys.stdin, sys.stdout))
+    s.connect(os.path.expanduser(path))
+    return (s, s)
+
+def loopback(family, sockaddr):
+    if family == socket.AF_INET:
+        return sockaddr[0].startswith("127.")
+    elif family == socket.AF_INET6:
+        return sockaddr[0] in ("::1", "0:0:0:0:0:0:0:1") or \
+               sockaddr[0].startswith("::ffff:127.")
+    else:
+        return False
+
+def listen(address):
+    # "host:port" (or "[v6 address]:port") for TCP, otherwise the path of
+    # a UNIX socket. rstatus's socket asks nothing of who connects and
+    # carries private messages, so TCP is only offered on loopback, for
+    # e.g. an ssh -L tunnel; anything further needs rstatus's own
+    # listen_tcp with auth_token and TLS.
+    (host, sep, port) = address.rpartition(":")
+    if sep and port.isdigit():
+        (family, stype, proto, name, sockaddr) = socket.getaddrinfo(
+            host.strip("[]") or None, int(port), 0, socket.SOCK_STREAM)[0]
+        if not loopback(family, sockaddr):
+            raise ValueError("{0} is not a loopback address; relay does not "
+                             "authenticate clients".format(host))
+
+        s = socket.socket(family, stype)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(sockaddr)
+    else:
+        # A socket left behind by an earlier run; anything else is not
+        # ours to remove
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(address)
+    s.listen(128)
+    return s
+
+def benchmark(megabytes=512):
+    # Socket to socket through a relay in another process, as when
+    # relaying a tunnelled client to rstatus
+    chunk = "x" * 65536
+    total = megabytes << 20
+
+    modes = [("buffered", False)]
+    if splice is not None:
+        modes.append(("splice", True))
+    else:
+        print "splice is not available"
+
+    for (name, use_splice) in modes:
+        (source, relay_a) = socket.socketpair()
+        (relay_b, sink) = socket.socketpair()
+
+        relay_pid = os.fork()
+        if relay_pid == 0:
+            try:
+                source.close()
+                sink.close()
+                Relay((relay_a, relay_a), (relay_b, relay_b),
+                      use_splice).run()
+            finally:
+                os._exit(0)
+
+        relay_a.close()
+        relay_b.close()
+
+        start = time.time()
+        source_pid = os.fork()
+        if source_pid == 0:
+            try:
+                sink.close()
+                for i in xrange(total // len(chunk)):
+                    source.sendall(chunk)
+            finally:
+                os._exit(0)
+
+        source.close()
+        received = 0
+        while received < total:
+            data = sink.recv(65536)
+            if not data:
+                break
+            received += len(data)
+        elapsed = time.time() - start
+
+        sink.close()
+        os.waitpid(source_pid, 0)
+        os.waitpid(relay_pid, 0)
+
+        print "{0:10} {1:8.1f} MiB/s".format(
+            name, (received >> 20) / elapsed)
+
+def main():
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+        return
+    elif sys.argv[1:2] == ["multi"] and len(sys.argv) == 3:
+        try:
+            listener = listen(sys.argv[2])
+        except ValueError, e:
+            print >>sys.stderr, e
+            sys.exit(1)
+        r = MultiRelay(listener, rstatus_connect)
+    elif len(sys.argv) == 1:
+        r = Relay(rstatus_connect(), (sys.stdin, sys.stdout))
+    else:
+        print >>sys.stderr, "Usage: {0} [multi LISTEN | benchmark]" \
+            .format(sys.argv[0])
+        sys.exit(1)
+
     r.run()
 
 if __name__ == "__main__":
@@ -17,66 +17,916 @@
 
 import irssi
 import os
+import sys
 import string
+import re
 import traceback
 import time
+import math
 import errno
 import socket
-import json
+import ssl
+import hmac
+import struct
 import pprint
+import collections
 
-# Emulate irssi's nick_match_msg
-def fuzzymatch_trtbl_gen():
-    keep = [
-        string.digits,
-        string.uppercase,
-        string.lowercase
-    ]
+from rstatus_proto import LineFramer, TextDecoder, encode_line, decode_line, \
+                          encoders
+from rstatus_helper import PollLoop, CallReader, pack_call
 
-    table = list('.' * 256)
+# Emulate irssi's nick_match_msg: the nick must be bounded by
+# non-alphanumerics, letters match case-insensitively and any other
+# character in the nick matches any non-alphanumeric character
+fuzzymatch_keep = string.digits + string.ascii_letters
 
-    for data in keep:
-        first = ord(data[0])
-        table[first:first + len(data)] = string.lower(data)
+def fuzzymatch_compile(nick):
+    pattern = ["(?<![0-9A-Za-z])"]
 
-    table = ''.join(table)
-    return table
+    for c in nick:
+        if c in fuzzymatch_keep:
+            pattern.append(c)
+        else:
+            pattern.append("[^0-9A-Za-z]")
+
+    pattern.append("(?![0-9A-Za-z])")
+    return re.compile("".join(pattern), re.IGNORECASE)
+
+def would_block(e):
+    # Non-blocking TLS sockets ask for a read or write rather than raising
+    # EAGAIN
+    if isinstance(e, ssl.SSLError):
+        return e.errno in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    return isinstance(e, socket.error) and e.errno == errno.EAGAIN
+
+# accept() failures that say nothing about the listening socket itself:
+# those that only concern one connection, and those that last until some
+# descriptors or memory are freed
+accept_skip = set([errno.ECONNABORTED, errno.EINTR])
+accept_transient = set([errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                        errno.ENOMEM])
+
+# Linux's value; Python 2's socket module doesn't name it
+SO_PEERCRED = 17
+peercred = struct.Struct("3i")
+
+def peer_uid(sock):
+    # The uid at the other end of a UNIX socket, or None where the kernel
+    # can't say
+    if not sys.platform.startswith("linux"):
+        return None
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, peercred.size)
+    return peercred.unpack(creds)[1]
+
+def loopback(family, sockaddr):
+    if family == socket.AF_INET:
+        return sockaddr[0].startswith("127.")
+    elif family == socket.AF_INET6:
+        return sockaddr[0] in ("::1", "0:0:0:0:0:0:0:1") or \
+               sockaddr[0].startswith("::ffff:127.")
+    else:
+        return False
+
+def window_key(info):
+    if info["wtype"] == "channel":
+        name = info["channel"]
+    else:
+        name = info["nick"]
+
+    return (info["server"], info["wtype"], name)
+
+def settings_plain(settings):
+    # What JSON can carry to the helper: the override sets become lists
+    return dict((key, sorted(value) if isinstance(value, set) else value)
+                for (key, value) in settings.iteritems())
+
+def settings_native(settings):
+    # The other way: JSON hands back unicode, but e.g. hmac wants the str
+    # that irssi gave the plugin
+    native = {}
+    for (key, value) in settings.iteritems():
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        elif isinstance(value, list):
+            value = set(v.encode("utf8") for v in value)
+        native[str(key)] = value
+    return native
+
+# What to do when a client's send queue passes cbuffer_limit. Window levels
+# are now always conflated as they are queued; "conflate" used to conflate
+# and then resync, so it is kept as another name for "resync"
+slow_consumer_policies = ["disconnect", "conflate", "resync"]
+
+class FrameQueue:
+    """
+    Frames waiting to be written to a client
+
+    Frames are kept whole in a deque, and the head is resumed via an offset
+    after a short write, so a backlog is never copied to trim it. Python 2
+    sockets lack sendmsg(), so several pending frames are gathered into a
+    single string for one write instead.
+
+    A frame may carry a key (the window, for window_level frames). Until
+    a write starts on it, a keyed frame is superseded by the next one with
+    the same key: the old one is blanked and the new one goes on the end,
+    so the stream stays in seq order and a slow client's backlog grows
+    with the number of windows rather than the rate of events.
+    """
+
+    def __init__(self):
+        self.frames = collections.deque()
+        self.offset = 0
+        self.size = 0
+        # key -> index in frames of its unsent frame
+        self.latest = {}
+        self.blanks = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, frame, key=None):
+        """Queue frame; return True if it superseded a queued one"""
+        superseded = False
+
+        if key is not None:
+            index = self.latest.get(key)
+            if index is not None:
+                self.size -= len(self.frames[index])
+                self.frames[index] = ""
+                self.blanks += 1
+                superseded = True
+            self.latest[key] = len(self.frames)
+
+        self.frames.append(frame)
+        self.size += len(frame)
+
+        if self.blanks > 64 and self.blanks * 2 > len(self.frames):
+            self.compact()
+
+        return superseded
+
+    def compact(self):
+        indexes = {}
+        frames = collections.deque()
+
+        for (index, frame) in enumerate(self.frames):
+            if frame or (index == 0 and self.offset):
+                indexes[index] = len(frames)
+                frames.append(frame)
+
+        self.frames = frames
+        self.latest = dict((key, indexes[index])
+                           for (key, index) in self.latest.iteritems())
+        self.blanks = 0
+
+    def truncate(self):
+        """Drop everything but a part written head frame"""
+        self.latest.clear()
+        self.blanks = 0
+
+        if self.offset:
+            head = self.frames[0]
+            self.frames.clear()
+            self.frames.append(head)
+            self.size = len(head) - self.offset
+        else:
+            self.frames.clear()
+            self.size = 0
+
+    def send(self, conn):
+        # Whatever is left afterwards is part of a frame being written
+        self.latest.clear()
+        self.blanks = 0
+        sent_total = 0
+
+        while self.frames:
+            if self.offset == 0 and len(self.frames) > 1:
+                frame = "".join(self.frames)
+                self.frames.clear()
+                self.frames.append(frame)
+
+            frame = self.frames[0]
+            if self.offset:
+                data = buffer(frame, self.offset)
+            else:
+                data = frame
+
+            try:
+                sent = conn.send(data)
+            except socket.error, e:
+                if sent_total and would_block(e):
+                    break
+                raise
+
+            sent_total += sent
+            self.size -= sent
+
+            if sent < len(data):
+                self.offset += sent
+                break
+
+            self.frames.popleft()
+            self.offset = 0
+
+        return sent_total
+
+
+class FilterPolicy:
+    """
+    Decides which windows' events are forwarded
+
+    Override patterns are a channel or nick name, a glob ("#foo-*") or a
+    regex ("re:^#bar"), optionally limited to one server by prefixing its
+    tag ("freenode/#irssi"). All unscoped patterns of a list are compiled
+    into one regex, as are those of each server, so a name is tested in a
+    single pass. Decisions are remembered per (server, wtype, name) in a
+    bounded LRU; a new policy (and so an empty cache) is built whenever
+    the settings are reloaded. args holds what it was built from, less any
+    bad patterns, so the helper can build the same policy.
+    """
+
+    cache_limit = 1024
+
+    def __init__(self, default_channels, default_queries,
+                 override_notify, override_ignore):
+        self.defaults = {"channel": default_channels,
+                         "query": default_queries}
+        self.args = (default_channels, default_queries, [], [])
+        self.notify = self.compile(override_notify, self.args[2])
+        self.ignore = self.compile(override_ignore, self.args[3])
+        self.cache = collections.OrderedDict()
+
+    @staticmethod
+    def pattern_regex(pattern):
+        if pattern.startswith("re:"):
+            regex = pattern[3:]
+            re.compile(regex)
+            # match() with a leading .*? keeps search() semantics, and a ^
+            # in the regex still only matches at the start of the name
+            return ".*?(?:" + regex + ")"
+        else:
+            parts = []
+            for c in pattern:
+                if c == "*":
+                    parts.append(".*")
+                elif c == "?":
+                    parts.append(".")
+                else:
+                    parts.append(re.escape(c))
+            return "".join(parts) + r"\Z"
+
+    @staticmethod
+    def pattern_split(pattern):
+        # Nicks and tags can't contain a "/", but channel names can
+        (tag, sep, rest) = pattern.partition("/")
+        if sep and tag and tag[0] not in "#&!+" and \
+                not pattern.startswith("re:"):
+            return (tag.lower(), rest)
+        else:
+            return (None, pattern)
+
+    @classmethod
+    def compile(cls, patterns, good=None):
+        scoped = {}
+
+        for pattern in patterns:
+            (tag, name) = cls.pattern_split(pattern)
+            try:
+                regex = cls.pattern_regex(name)
+            except re.error, e:
+                irssi.prnt("RStatus: Warning: bad pattern {0!r}: {1}"
+                           .format(name, e))
+                continue
+            scoped.setdefault(tag, []).append("(?:" + regex + ")")
+            if good is not None:
+                good.append(pattern)
+
+        return dict((tag, re.compile("|".join(regexes),
+                                     re.IGNORECASE | re.DOTALL))
+                    for (tag, regexes) in scoped.items())
+
+    @staticmethod
+    def search(compiled, tag, name):
+        for key in (None, tag):
+            regex = compiled.get(key)
+            if regex and regex.match(name):
+                return True
+        return False
+
+    def decide(self, tag, wtype, name):
+        tag = tag.lower()
+
+        if self.search(self.notify, tag, name):
+            return True
+        if self.search(self.ignore, tag, name):
+            return False
+
+        return self.defaults[wtype]
+
+    def allows(self, info):
+        wtype = info["wtype"]
+        if wtype == "channel":
+            name = info["channel"]
+        elif wtype == "query":
+            name = info["nick"]
+        else:
+            return False
+
+        key = (info["server"], wtype, name)
+
+        try:
+            result = self.cache.pop(key)
+        except KeyError:
+            result = self.decide(info["server"], wtype, name)
+            if len(self.cache) >= self.cache_limit:
+                self.cache.popitem(last=False)
+
+        self.cache[key] = result
+        return result
+
+
+class Subscription:
+    """
+    The events a client has asked for
+
+    Built from the optional "subscribe" object of a settings message, with
+    any of the keys "servers" (tags), "wtypes", "channels" (patterns, as
+    for override_notify) and "min_level". Window level events below
+    min_level are skipped, except level 0 so that the client still sees
+    windows being read.
+
+    keys() gives the (type, server, wtype) tuples under which the client
+    is indexed, server being None for "any"; matches() checks the rest.
+    """
+
+    wtypes_all = ("channel", "query")
+
+    def __init__(self, send_messages=False, spec=None):
+        if spec is None:
+            spec = {}
+        if not isinstance(spec, dict):
+            raise ValueError("subscribe must be an object")
+
+        if spec.get("servers") is not None:
+            self.servers = set(s.lower() for s in spec["servers"])
+        else:
+            self.servers = None
+
+        self.wtypes = set(spec.get("wtypes") or self.wtypes_all)
+        if not self.wtypes <= set(self.wtypes_all):
+            raise ValueError("Unknown wtypes: " + repr(spec["wtypes"]))
+
+        if spec.get("channels") is not None:
+            self.channels = FilterPolicy.compile(spec["channels"])
+        else:
+            self.channels = None
+
+        self.min_level = spec.get("min_level", 0)
+        if not isinstance(self.min_level, (int, long)):
+            raise ValueError("min_level must be an integer")
+
+        self.restricted = self.servers is not None or \
+                          self.channels is not None or \
+                          self.wtypes != set(self.wtypes_all) or \
+                          self.min_level > 0
+
+        if send_messages:
+            self.types = ("window_level", "message")
+        else:
+            self.types = ("window_level", )
+
+    def keys(self):
+        for event_type in self.types:
+            for server in (self.servers or [None]):
+                for wtype in self.wtypes:
+                    yield (event_type, server, wtype)
+
+    def matches(self, info):
+        if self.channels is not None and info["wtype"] == "channel" and \
+           not FilterPolicy.search(self.channels, info["server"].lower(),
+                                   info["channel"]):
+            return False
+
+        if info["type"] == "window_level" and \
+           0 < info["level"] < self.min_level:
+            return False
+
+        return True
+
+    def allows(self, info):
+        if info["type"] not in self.types or \
+           info["wtype"] not in self.wtypes:
+            return False
+        if self.servers is not None and \
+           info["server"].lower() not in self.servers:
+            return False
+
+        return self.matches(info)
+
+
+class TimerWheel:
+    """
+    Many deadlines, driven by a single periodic irssi timeout
+
+    A hashed timer wheel: an entry due at tick t sits in slot t % slots,
+    and each tick only that slot is looked at. Pushing a deadline later,
+    which is what happens on nearly every read and write, only rewrites
+    the entry; it is moved to its new slot when its old one comes round.
+    Removed or replaced entries are likewise skipped lazily. The irssi
+    timeout only runs while there are deadlines.
+    """
+
+    def __init__(self, tick=1, slots=64):
+        self.tick = tick
+        self.slots = [[] for i in xrange(slots)]
+        self.now = 0
+        self.entries = {}
+        self.source = None
+        self.advancing = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, key, timeout, func, *args):
+        due = self.now + max(1, int(math.ceil(float(timeout) / self.tick)))
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[1] <= due:
+            entry[0] = due
+            entry[2] = func
+            entry[3] = args
+            return
+
+        # [due, the tick whose slot holds it, func, args, key]
+        entry = [due, due, func, args, key]
+        self.entries[key] = entry
+        self.slots[due % len(self.slots)].append(entry)
+
+        if self.source is None and not self.advancing:
+            self.source = irssi.get_script().timeout_add(self.tick * 1000,
+                                                         self.advance)
+
+    def remaining(self, key):
+        return (self.entries[key][0] - self.now) * self.tick
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None and not self.entries \
+                and not self.advancing:
+            irssi.get_script().source_remove(self.source)
+            self.source = None
+
+    def advance(self):
+        self.now += 1
+        index = self.now % len(self.slots)
+        (slot, self.slots[index]) = (self.slots[index], [])
+        self.advancing = True
+
+        for entry in slot:
+            (due, slotted, func, args, key) = entry
+
+            if self.entries.get(key) is not entry:
+                continue
+            elif slotted != self.now:
+                # Due on a later turn of the wheel
+                self.slots[index].append(entry)
+            elif due != self.now:
+                entry[1] = due
+                self.slots[due % len(self.slots)].append(entry)
+            else:
+                del self.entries[key]
+                try:
+                    func(*args)
+                except:
+                    irssi.prnt("RStatus: Timer error:")
+                    irssi.prnt(traceback.format_exc())
+
+        self.advancing = False
+
+        if not self.entries:
+            self.source = None
+            return False
 
-def fuzzymatch(msg, nick, other_channel_nicks):
-    tmsg = '.' + string.translate(msg, fuzzymatch_trtbl) + '.'
-    tnick = '.' + string.translate(nick, fuzzymatch_trtbl) + '.'
+        return True
+
+
+class Client(object):
+    """
+    One connected client: its socket, buffers, watches and deadlines
+
+    Fields are touched on every read and write, and there may be hundreds
+    of clients, so this is a slotted (and so new-style) class rather than
+    a dict. The transport lives here; what the client says is handled by
+    RStatus.
+    """
+
+    __slots__ = ("rstatus", "conn", "send_queue", "recv_buffer",
+                 "send_messages", "encoding", "watches", "timeouts",
+                 "subscription", "tls", "authed", "dropped", "resync")
+
+    def __init__(self, rstatus, conn, tls=False, authed=True):
+        self.rstatus = rstatus
+        self.conn = conn
+        self.send_queue = FrameQueue()
+        self.recv_buffer = LineFramer(rstatus.cbuffer_limit,
+                                      rstatus.recv_size)
+        self.send_messages = False
+        self.encoding = "json"
+        self.watches = {}
+        self.timeouts = set()
+        self.subscription = None
+        self.tls = tls
+        self.authed = authed
+        self.dropped = False
+        # Set when a backlog was thrown away: what is part written is
+        # finished, then the client is sent a reset and snapshot
+        self.resync = False
+
+    def watch_add(self, name, func, iotype):
+        assert name not in self.watches
+        self.watches[name] = \
+            irssi.get_script().io_add_watch(self.conn, func, None, iotype)
+
+    def timeout_set(self, name, timeout, func, *args):
+        self.timeouts.add(name)
+        self.rstatus.wheel.set((self, name), timeout, func, *args)
+
+    def drop_ioerror(self, fd, condition, data=None):
+        if self.dropped or self.conn.fileno() != fd:
+            return False
 
-    if tnick not in tmsg:
+        if condition == irssi.IO_HUP:
+            reason = "IO Hangup"
+        elif condition == irssi.IO_ERR:
+            reason = "IO Error"
+        else:
+            reason = "IO Error (U)"
+
+        self.drop(reason)
         return False
 
-    # extract the bit that matched
-    p = tmsg.find(tnick) - 1 + 1
-    match = msg[p:p + len(nick)]
+    def drop(self, reason, notify=False):
+        rstatus = self.rstatus
+
+        if rstatus.debug:
+            irssi.prnt("RStatus: Dropping client: '{0}'".format(reason))
+        rstatus.last_set("drop", reason)
+
+        rstatus.client_unsubscribe(self)
+        del rstatus.clients[self.conn]
+        self.dropped = True
+
+        for tag in self.watches.itervalues():
+            irssi.get_script().source_remove(tag)
+        for name in self.timeouts:
+            rstatus.wheel.remove((self, name))
+
+        if notify and len(self.send_queue) == 0:
+            try:
+                self.conn.send(encode_line({"type": "disconnect_notice"}))
+            except:
+                rstatus.client_conn_close(self.conn)
+            else:
+                irssi.get_script().timeout_add(
+                        rstatus.timeout_drop_notify * 1000,
+                        rstatus.client_conn_close, self.conn)
+        else:
+            rstatus.client_conn_close(self.conn)
+
+    def try_recv(self, fd, condition, data=None):
+        if self.dropped or self.conn.fileno() != fd:
+            return False
+
+        rstatus = self.rstatus
+        recv_buffer = self.recv_buffer
+
+        try:
+            received = recv_buffer.recv_into(self.conn)
+        except Exception, e:
+            if would_block(e):
+                return True
+
+            if rstatus.debug:
+                irssi.prnt("RStatus: Client IO error:")
+                irssi.prnt(traceback.format_exc())
+
+            self.drop("RECV IO Error")
+            return False
+
+        if not received:
+            if rstatus.debug:
+                irssi.prnt("RStatus: Client read failed")
+
+            self.drop("RECV failed (EOF)")
+            return False
+
+        for line in recv_buffer.lines():
+            if len(line) == 0:
+                continue
+
+            try:
+                data = decode_line(line.tobytes())
+                assert isinstance(data, dict)
+                rstatus.client_recv(self, data)
+
+                # Happens when we receive a disconnect request
+                if self.dropped:
+                    return False
+            except:
+                if rstatus.debug:
+                    irssi.prnt("RStatus: Client parse failed")
+                    irssi.prnt(traceback.format_exc())
+
+                self.drop("RECV BAD JSON", notify=True)
+                return False
+
+        if recv_buffer.full():
+            self.drop("RECV Buffer Overflow", notify=True)
+            return False
+
+        if not self.authed:
+            timeout = rstatus.timeout_txrx
+            reason = "Auth"
+        elif len(recv_buffer) > 0:
+            timeout = rstatus.timeout_txrx
+            reason = "RX"
+        else:
+            timeout = rstatus.timeout_heartbeat
+            reason = "HB"
+        reason = "RECV Timeout ({0})".format(reason)
+
+        self.timeout_set("recv", timeout, self.drop, reason)
+
+        # TLS may have decrypted more than was read, which IO_IN won't
+        # report
+        if self.tls and self.conn.pending():
+            return self.try_recv(fd, condition)
+
+        return True
+
+    def try_send(self, fd, condition, data=None, init=False):
+        if self.dropped or (not init and self.conn.fileno() != fd):
+            return False
+
+        rstatus = self.rstatus
+        send_queue = self.send_queue
+
+        try:
+            sent = send_queue.send(self.conn)
+            if not init:
+                assert sent > 0
+        except Exception, e:
+            if would_block(e) and init:
+                sent = 0
+            else:
+                if rstatus.debug:
+                    irssi.prnt("RStatus: Client send failed")
+                    irssi.prnt(traceback.format_exc())
+
+                self.drop("SEND IO Error")
+                return False
+
+        if len(send_queue) > 0:
+            self.timeout_set("send", rstatus.timeout_txrx,
+                             self.drop, "SEND Timeout (TX)")
+
+            if "send" not in self.watches:
+                self.watch_add("send", self.try_send, irssi.IO_OUT)
+
+            return True
+        else:
+            # Returning False removes the watch, if there is one
+            self.watches.pop("send", None)
+            self.timeout_set("send", rstatus.timeout_heartbeat,
+                             self.heartbeat_send)
+
+            if self.resync:
+                self.resync = False
+                rstatus.client_reset(self)
+
+            return False
 
-    if match in other_channel_nicks:
+    def send(self, data):
+        self.send_frame(self.rstatus.encode(data, self.encoding))
+
+    def send_frame(self, data, key=None):
+        send_queue = self.send_queue
+
+        if self.resync:
+            # The snapshot will cover it
+            return
+        elif len(send_queue) != 0:
+            if send_queue.append(data, key):
+                self.rstatus.slow_consumers["conflated"] += 1
+            if len(send_queue) > self.rstatus.cbuffer_limit:
+                self.overflow()
+        else:
+            send_queue.append(data, key)
+            self.try_send(None, None, init=True)
+
+    def overflow(self):
+        rstatus = self.rstatus
+        policy = rstatus.settings["slow_consumer"]
+        counters = rstatus.slow_consumers
+
+        if policy in ("resync", "conflate"):
+            counters["resyncs"] += 1
+            self.send_queue.truncate()
+
+            if len(self.send_queue) == 0:
+                # Nothing was part written, so the reset can be queued
+                # now; the send watch is still waiting to write it
+                self.send_queue.append(rstatus.reset_frame(self))
+            else:
+                self.resync = True
+        else:
+            counters["disconnects"] += 1
+            self.drop("SEND Buffer Overflow")
+
+    def heartbeat_send(self):
+        assert len(self.send_queue) == 0
+        self.send_queue.append("\n")
+        self.try_send(None, None, init=True)
         return False
 
-    return True
 
-fuzzymatch_trtbl = fuzzymatch_trtbl_gen()
+class HelperLink:
+    """
+    One end of the socketpair between the plugin and its helper process
+
+    Either end sends (method name, arguments) calls, which the other end
+    makes on its RStatus if the name is one it accepts.
+    """
+
+    def __init__(self, rstatus, sock, calls, pid=None):
+        self.rstatus = rstatus
+        self.sock = sock
+        self.calls = calls
+        self.pid = pid
+        self.send_queue = FrameQueue()
+        self.reader = CallReader(rstatus.helper_buffer_limit)
+        self.watches = {}
+        self.closed = False
+
+        sock.setblocking(False)
+        for (name, func, iotype) in [("recv", self.try_recv, irssi.IO_IN),
+                                     ("err", self.lost_ioerror, irssi.IO_ERR),
+                                     ("hup", self.lost_ioerror, irssi.IO_HUP)]:
+            self.watch_add(name, func, iotype)
+
+    def watch_add(self, name, func, iotype):
+        self.watches[name] = \
+            irssi.get_script().io_add_watch(self.sock, func, None, iotype)
+
+    def call(self, name, *args):
+        if self.closed:
+            return
+
+        send_queue = self.send_queue
+        send_queue.append(pack_call(name, args))
+
+        if len(send_queue) > self.rstatus.helper_buffer_limit:
+            self.lost("SEND Buffer Overflow")
+        elif "send" not in self.watches:
+            self.try_send(None, None)
+
+    def try_send(self, fd, condition, data=None):
+        if self.closed:
+            return False
+
+        try:
+            self.send_queue.send(self.sock)
+        except Exception, e:
+            if not would_block(e):
+                self.lost("SEND IO Error")
+                return False
+
+        if len(self.send_queue) > 0:
+            if "send" not in self.watches:
+                self.watch_add("send", self.try_send, irssi.IO_OUT)
+            return True
+        else:
+            self.watches.pop("send", None)
+            return False
+
+    def try_recv(self, fd, condition, data=None):
+        if self.closed:
+            return False
+
+        try:
+            data = self.sock.recv(65536)
+        except Exception, e:
+            if would_block(e):
+                return True
+            self.lost("RECV IO Error")
+            return False
+
+        if not data:
+            self.lost("RECV failed (EOF)")
+            return False
+
+        try:
+            calls = self.reader.feed(data)
+        except:
+            irssi.prnt(traceback.format_exc())
+            self.lost("RECV Bad Call")
+            return False
+
+        for (name, args) in calls:
+            if name not in self.calls:
+                irssi.prnt("RStatus: Ignoring helper call {0!r}".format(name))
+                continue
+
+            getattr(self.rstatus, name)(*args)
+            if self.closed:
+                return False
+
+        return True
+
+    def lost_ioerror(self, fd, condition, data=None):
+        if not self.closed:
+            self.lost("IO Error")
+        return False
+
+    def lost(self, reason):
+        self.closed = True
+        for tag in self.watches.itervalues():
+            irssi.get_script().source_remove(tag)
+        self.watches = {}
+        self.rstatus.client_conn_close(self.sock)
+        self.rstatus.helper_lost(self, reason)
 
 
 class RStatus:
     timeout_txrx = 60
     timeout_heartbeat = 60 * 10
     timeout_drop_notify = 10
+    timeout_daemon_retry = 10
+    timeout_accept_retry = 1
     cbuffer_limit = 8192
-
-    def __init__(self, debug=False):
+    recv_size = 1024
+    history_limit = 512
+    flood_lines = 5
+    buckets_limit = 1024
+    helper_buffer_limit = 1 << 20
+    # What each end of the helper link may ask the other to do
+    helper_parent_calls = frozenset(["helper_prnt"])
+    helper_child_calls = frozenset(["broadcast", "window_level_set",
+                                    "window_level_remove", "helper_sync",
+                                    "status"])
+
+    def __init__(self, debug=False, daemon_path=None):
         self.debug = debug
         self.lasts = {}
+        self.nick_matchers = {}
+        self.channel_nicks = {}
+        self.text_decoder = TextDecoder()
+        self.coalesced = collections.OrderedDict()
+        self.coalesce_timeout = None
+        self.window_levels_timeout = None
+        self.buckets = {}
+        self.floods = {}
+        self.slow_consumers = {"conflated": 0, "resyncs": 0,
+                               "disconnects": 0}
+        # Client deadlines move on nearly every read and write
+        self.wheel = TimerWheel()
+        # Starting from the time means sequence numbers from before a
+        # restart are always too old to resync from
+        self.seq = int(time.time() * 1000)
+        self.history = collections.deque(maxlen=self.history_limit)
+        # The link to the helper process or daemon, in the plugin, or to
+        # the plugin, in the helper or daemon
+        self.helper = None
+        self.upstream = None
+        self.upstream_listener = None
+        self.clients = {}
+        self.subscribers = {}
+        self.listeners = {}
+        self.handshakes = {}
+        self.socket = None
+
+        if daemon_path is not None:
+            # Serving clients for a plugin that connects to daemon_path;
+            # everything else arrives from it
+            self.daemon_listen(daemon_path)
+            return
+
         self.create_settings()
         self.load_settings()
-        self.create_socket()
+        self.window_levels_reload()
+
+        if self.settings["fanout_daemon"]:
+            self.daemon_start()
+        else:
+            self.create_socket()
+            if self.settings["fanout_helper"]:
+                self.helper_start()
+            else:
+                self.listeners_watch()
 
         if self.debug:
             irssi.prnt("RStatus loaded. Windows:")
-            irssi.prnt(pprint.pformat(self.window_all()))
+            irssi.prnt(pprint.pformat(self.window_levels.values()))
 
         irssi.signal_add("setup changed", self.load_settings)
         irssi.signal_add("setup reread", self.load_settings)
@@ -85,15 +935,44 @@ class RStatus:
         irssi.signal_add("message private", self.privmsg)
         irssi.signal_add("message public", self.pubmsg)
 
+        irssi.signal_add("channel created", self.channelcreated)
         irssi.signal_add("channel destroyed", self.channeldestroyed)
         irssi.signal_add("query destroyed", self.querydestroyed)
 
+        irssi.signal_add("query nick changed", self.windows_changed)
+        irssi.signal_add("window item new", self.windows_changed)
+        irssi.signal_add("window item changed", self.windows_changed)
+        irssi.signal_add("window item remove", self.windows_changed)
+
+        irssi.signal_add("nicklist new", self.nicklistnew)
+        irssi.signal_add("nicklist remove", self.nicklistremove)
+        irssi.signal_add("nicklist changed", self.nicklistchanged)
+        irssi.signal_add("server nick changed", self.servernickchanged)
+
         irssi.command_bind("rstatus", self.status)
 
     def status(self, data, server, window):
+        if self.helper is not None:
+            if self.helper.pid is None:
+                irssi.prnt("RStatus: Clients are served by the fan-out "
+                           "daemon")
+            else:
+                irssi.prnt("RStatus: Clients are served by helper process "
+                           "{0}".format(self.helper.pid))
+            self.helper.call("status", None, None, None)
+            return
+
         irssi.prnt("RStatus: Current Status: ")
         irssi.prnt("Connected clients: {0}".format(len(self.clients)))
         irssi.prnt("Server Socket OK? {0}".format(self.socket != False))
+        irssi.prnt("Listening on: {0}".format(", ".join(
+            l["name"] for l in self.listeners.values())))
+        irssi.prnt("Sequence: {0}, history: {1}".format(self.seq,
+                                                        len(self.history)))
+        irssi.prnt("Slow clients ({0}): {1[conflated]} frames conflated, "
+                   "{1[resyncs]} resyncs, {1[disconnects]} disconnects"
+                   .format(self.settings["slow_consumer"],
+                           self.slow_consumers))
 
         for key, (info, etime) in self.lasts.items():
             etime = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(etime))
@@ -109,23 +988,146 @@ class RStatus:
         if self.debug:
             irssi.prnt("RStatus update: " + pprint.pformat(info))
 
-        for conn, client_info in self.clients.items():
-            if info["type"] == "message" and not client_info["send_messages"]:
-                continue
+        if info["type"] == "window_level" and self.settings["coalesce_time"]:
+            self.coalesce(info)
+        elif info["type"] == "message" and self.settings["message_burst"]:
+            self.rate_limit(info)
+        else:
+            self.broadcast(info)
 
-            self.client_send(conn, info)
+    def coalesce(self, info):
+        # Only the latest level for each window survives until the flush;
+        # replacing a value keeps the window's place in the OrderedDict
+        self.coalesced[window_key(info)] = info
 
-    def windowhilight(self, window):
-        self.update(self.window_info(window))
+        if self.coalesce_timeout is None:
+            self.coalesce_timeout = irssi.get_script().timeout_add(
+                    self.settings["coalesce_time"], self.coalesce_flush)
 
-    def try_unicode(self, text):
-        for enc in ["ascii", "utf8", "iso-8859-1", "windows-1252"]:
-            try:
-                return unicode(text, enc)
-            except:
-                pass
+    def coalesce_flush(self):
+        self.coalesce_timeout = None
+        (coalesced, self.coalesced) = \
+            (self.coalesced, collections.OrderedDict())
+
+        for info in coalesced.itervalues():
+            self.broadcast(info)
+
+        return False
+
+    def rate_limit(self, info):
+        # Each sender in each window may send message_burst messages, then
+        # one every message_refill ms. Anything beyond that is folded into
+        # a single frame, sent when the next token is due, carrying the
+        # count and the last few lines.
+        key = window_key(info) + (info["nick"], )
+
+        flood = self.floods.get(key)
+        if flood is not None:
+            flood["info"] = info
+            flood["count"] += 1
+            flood["lines"].append(info["message"])
+        elif self.bucket_take(key):
+            self.broadcast(info)
+        else:
+            tokens = self.buckets[key][0]
+            wait = (1 - tokens) * self.settings["message_refill"]
+            self.floods[key] = {
+                "info": info,
+                "count": 1,
+                "lines": collections.deque([info["message"]],
+                                           self.flood_lines),
+                "timeout": irssi.get_script().timeout_add(
+                        int(math.ceil(wait)), self.flood_flush, (key, ))
+            }
+
+    def bucket_take(self, key):
+        burst = self.settings["message_burst"]
+        refill = self.settings["message_refill"] / 1000.0
+        now = time.time()
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.buckets_limit:
+                self.buckets_prune(now)
+            bucket = self.buckets[key] = [burst, now]
+
+        tokens = min(burst, bucket[0] + (now - bucket[1]) / refill)
+        bucket[1] = now
+
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        else:
+            bucket[0] = tokens
+            return False
+
+    def buckets_prune(self, now):
+        # Buckets that would have refilled by now are as good as new
+        burst = self.settings["message_burst"]
+        refill = self.settings["message_refill"] / 1000.0
+
+        for key, (tokens, stamp) in self.buckets.items():
+            if tokens + (now - stamp) / refill >= burst:
+                del self.buckets[key]
 
-        return unicode(text, "ascii", "ignore")
+    def flood_flush(self, key):
+        flood = self.floods.pop(key)
+        self.bucket_take(key)
+
+        info = flood["info"].copy()
+        info["count"] = flood["count"]
+        info["lines"] = list(flood["lines"])
+        self.broadcast(info)
+
+        return False
+
+    def broadcast(self, info):
+        if self.helper is not None:
+            self.helper.call("broadcast", info)
+            return
+
+        # info may be the very dict held in window_levels, whose entries
+        # must not carry a seq
+        self.seq += 1
+        info = dict(info, seq=self.seq)
+        self.history.append(info)
+
+        if info["type"] == "window_level":
+            self.snapshots = {}
+
+        # Serialise once per encoding and share the frames between clients
+        frames = {}
+
+        # Only clients subscribed to this type, wtype and server (or any
+        # server) are visited
+        event_type = info["type"]
+        wtype = info["wtype"]
+        keys = [(event_type, None, wtype),
+                (event_type, info["server"].lower(), wtype)]
+
+        # Lets a slow client's queue drop window levels that are stale
+        if event_type == "window_level":
+            conflate_key = window_key(info)
+        else:
+            conflate_key = None
+
+        for key in keys:
+            for client in list(self.subscribers.get(key, ())):
+                if not client.subscription.matches(info):
+                    continue
+
+                encoding = client.encoding
+                frame = frames.get(encoding)
+                if frame is None:
+                    frame = frames[encoding] = self.encode(info, encoding)
+
+                client.send_frame(frame, conflate_key)
+
+    def windowhilight(self, window):
+        info = self.window_info(window)
+        if info:
+            self.window_level_set(info)
+        self.update(info)
 
     def privmsg(self, server, msg, nick, address):
         info = {
@@ -133,18 +1135,24 @@ class RStatus:
             "server": server.tag,
             "type": "message",
             "wtype": "query",
-            "message": self.try_unicode(msg)
+            "message": self.text_decoder.decode(msg, (server.tag, nick))
         }
         self.update(info)
 
     def pubmsg(self, server, msg, nick, address, target):
-        channel = server.channel_find(target)
-        if channel:
-            nicks = channel.nicks()
-        else:
-            nicks = []
+        matcher = self.nick_matchers.get(server.nick)
+        if matcher is None:
+            matcher = fuzzymatch_compile(server.nick)
+            self.nick_matchers[server.nick] = matcher
+
+        match = matcher.search(msg)
+        if not match:
+            return
 
-        if not fuzzymatch(msg, server.nick, nicks):
+        # Something that merely looks like us may be another user's nick
+        match = match.group(0)
+        if match != server.nick and \
+           match in self.channel_nicks_get(server, target):
             return
 
         info = {
@@ -153,11 +1161,54 @@ class RStatus:
             "server": server.tag,
             "type": "message",
             "wtype": "channel",
-            "message": self.try_unicode(msg)
+            "message": self.text_decoder.decode(msg, (server.tag, nick))
         }
         self.update(info)
 
+    def channel_nicks_get(self, server, name):
+        key = (server.tag, name.lower())
+        nicks = self.channel_nicks.get(key)
+        if nicks is not None:
+            return nicks
+
+        # Channels joined before we were loaded are indexed on first use,
+        # after which the nicklist signals keep them up to date
+        channel = server.channel_find(name)
+        if not channel:
+            return ()
+
+        nicks = set(n.nick for n in channel.nicks())
+        self.channel_nicks[key] = nicks
+        return nicks
+
+    def channelcreated(self, channel, automatic=None):
+        key = (channel.server.tag, channel.name.lower())
+        self.channel_nicks[key] = set()
+
+    def nicklistnew(self, channel, nick):
+        key = (channel.server.tag, channel.name.lower())
+        if key in self.channel_nicks:
+            self.channel_nicks[key].add(nick.nick)
+
+    def nicklistremove(self, channel, nick):
+        key = (channel.server.tag, channel.name.lower())
+        if key in self.channel_nicks:
+            self.channel_nicks[key].discard(nick.nick)
+
+    def nicklistchanged(self, channel, nick, old_nick):
+        key = (channel.server.tag, channel.name.lower())
+        if key in self.channel_nicks:
+            self.channel_nicks[key].discard(old_nick)
+            self.channel_nicks[key].add(nick.nick)
+
+    def servernickchanged(self, server):
+        # Drop our old nick; matchers are cheap to rebuild for the others
+        self.nick_matchers.clear()
+
     def channeldestroyed(self, channel):
+        key = (channel.server.tag, channel.name.lower())
+        self.channel_nicks.pop(key, None)
+
         info = {
             "channel": channel.name,
             "server": channel.server.tag,
@@ -165,6 +1216,7 @@ class RStatus:
             "level": 0,
             "type": "window_level"
         }
+        self.window_level_remove(info)
         self.update(info)
 
     def querydestroyed(self, query):
@@ -175,11 +1227,47 @@ class RStatus:
             "level": 0,
             "type": "window_level"
         }
+        self.window_level_remove(info)
         self.update(info)
 
+    def windows_changed(self, *args):
+        # Renames, new windows and items moving between windows aren't
+        # followed one by one: the table is read again once irssi is done
+        if self.window_levels_timeout is None:
+            self.window_levels_timeout = irssi.get_script().timeout_add(
+                    0, self.window_levels_timeout_run)
+
+    def window_levels_timeout_run(self):
+        self.window_levels_timeout = None
+        self.window_levels_reload()
+        return False
+
     def window_all(self):
         return map(self.window_info, irssi.windows())
 
+    # window_levels mirrors window_all(), kept current from the signals
+    # above, so that new clients don't cost a scan of every window.
+    # snapshots caches its filtered and encoded form for each encoding.
+    def window_levels_reload(self):
+        self.window_levels = collections.OrderedDict()
+        for info in self.window_all():
+            if info:
+                self.window_levels[window_key(info)] = info
+        self.snapshots = {}
+        self.helper_sync_send()
+
+    def window_level_set(self, info):
+        self.window_levels[window_key(info)] = info
+        self.snapshots = {}
+        if self.helper is not None:
+            self.helper.call("window_level_set", info)
+
+    def window_level_remove(self, info):
+        self.window_levels.pop(window_key(info), None)
+        self.snapshots = {}
+        if self.helper is not None:
+            self.helper.call("window_level_remove", info)
+
     def window_info(self, window):
         if not window.active:
             return False
@@ -210,21 +1298,7 @@ class RStatus:
         if info == False:
             return False
 
-        if info["wtype"] == "channel":
-            default = self.settings["default_channels"]
-            name = info["channel"].lower()
-        elif info["wtype"] == "query":
-            default = self.settings["default_queries"]
-            name = info["nick"].lower()
-        else:
-            return False
-
-        if name in self.settings["override_notify"]:
-            return True
-        if name in self.settings["override_ignore"]:
-            return False
-
-        return default
+        return self.filter.allows(info)
 
     def create_settings(self):
         irssi.settings_add_str("rstatus", "socket", "~/.irssi/rstatus_sock")
@@ -232,11 +1306,22 @@ class RStatus:
         irssi.settings_add_str("rstatus", "default_queries", "notify")
         irssi.settings_add_str("rstatus", "override_notify", "")
         irssi.settings_add_str("rstatus", "override_ignore", "")
+        irssi.settings_add_int("rstatus", "coalesce_time", 0)
+        irssi.settings_add_int("rstatus", "message_burst", 0)
+        irssi.settings_add_int("rstatus", "message_refill", 2000)
+        irssi.settings_add_str("rstatus", "listen_tcp", "")
+        irssi.settings_add_str("rstatus", "tls_cert", "")
+        irssi.settings_add_str("rstatus", "auth_token", "")
+        irssi.settings_add_int("rstatus", "listen_backlog", 128)
+        irssi.settings_add_str("rstatus", "slow_consumer", "disconnect")
+        irssi.settings_add_int("rstatus", "fanout_helper", 0)
+        irssi.settings_add_str("rstatus", "fanout_daemon", "")
 
     def load_settings(self, *args):
         nikeys = ["default_channels", "default_queries"]
         setkeys = ["override_notify", "override_ignore"]
-        keys = nikeys + setkeys + ["socket"]
+        keys = nikeys + setkeys + ["socket", "listen_tcp", "tls_cert",
+                                   "auth_token", "slow_consumer"]
 
         settings = {}
 
@@ -244,7 +1329,7 @@ class RStatus:
             settings[key] = irssi.settings_get_str(key)
 
         for key in setkeys:
-            settings[key] = set([i.lower() for i in settings[key].split()])
+            settings[key] = settings[key].split()
 
         for key in nikeys:
             if settings[key] not in ["notify", "ignore"]:
@@ -252,277 +1337,594 @@ class RStatus:
 
             settings[key] = (settings[key] == "notify")
 
+        self.filter = FilterPolicy(settings["default_channels"],
+                                   settings["default_queries"],
+                                   settings["override_notify"],
+                                   settings["override_ignore"])
+
+        for key in setkeys:
+            settings[key] = set([i.lower() for i in settings[key]])
+
         settings["socket"] = os.path.expanduser(settings["socket"])
+        if settings["tls_cert"]:
+            settings["tls_cert"] = os.path.expanduser(settings["tls_cert"])
+        self.snapshots = {}
+
+        settings["coalesce_time"] = irssi.settings_get_int("coalesce_time")
+        if settings["coalesce_time"] < 0:
+            irssi.prnt("RStatus: Warning: option coalesce_time is invalid")
+            settings["coalesce_time"] = 0
+
+        settings["message_burst"] = irssi.settings_get_int("message_burst")
+        if settings["message_burst"] < 0:
+            irssi.prnt("RStatus: Warning: option message_burst is invalid")
+            settings["message_burst"] = 0
+
+        settings["message_refill"] = irssi.settings_get_int("message_refill")
+        if settings["message_refill"] <= 0:
+            irssi.prnt("RStatus: Warning: option message_refill is invalid")
+            settings["message_refill"] = 2000
+
+        settings["listen_backlog"] = irssi.settings_get_int("listen_backlog")
+        if settings["listen_backlog"] <= 0:
+            irssi.prnt("RStatus: Warning: option listen_backlog is invalid")
+            settings["listen_backlog"] = 128
+
+        if settings["slow_consumer"] not in slow_consumer_policies:
+            irssi.prnt("RStatus: Warning: option slow_consumer is invalid")
+            settings["slow_consumer"] = "disconnect"
+
+        # Like the sockets, this only takes effect when the script loads
+        settings["fanout_helper"] = irssi.settings_get_int("fanout_helper")
+        if settings["fanout_helper"] not in (0, 1):
+            irssi.prnt("RStatus: Warning: option fanout_helper is invalid")
+            settings["fanout_helper"] = 0
+
+        settings["fanout_daemon"] = irssi.settings_get_str("fanout_daemon")
+        if settings["fanout_daemon"]:
+            settings["fanout_daemon"] = \
+                os.path.expanduser(settings["fanout_daemon"])
 
         self.settings = settings
+        self.helper_sync_send()
 
     def create_socket(self):
-        self.clients = {}
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket = self.unix_listen(self.settings["socket"],
+                                       self.settings["listen_backlog"])
+        self.listener_add(self.socket, "UNIX Socket")
+
+        if self.settings["listen_tcp"]:
+            self.create_tcp_socket(self.settings["listen_tcp"])
+
+    def unix_listen(self, path, backlog, private=False):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
         try:
-            os.unlink(self.settings["socket"])
+            os.unlink(path)
         except OSError, e:
             if e.errno != errno.ENOENT:
                 raise
-        self.socket.bind(self.settings["socket"])
-
-        self.socket.setblocking(0)
-        self.socket.listen(5)
 
-        irssi.get_script().io_add_watch(self.socket, self.socket_activity,
-                                        self.socket)
+        # A private socket is created 0600, rather than chmod()ed once
+        # someone else may already have connected
+        umask = os.umask(0177) if private else None
+        try:
+            sock.bind(path)
+        finally:
+            if umask is not None:
+                os.umask(umask)
+
+        sock.setblocking(0)
+        sock.listen(backlog)
+        return sock
+
+    def create_tcp_socket(self, address):
+        # Anyone can connect to a TCP port, so clients must authenticate
+        if not self.settings["auth_token"]:
+            irssi.prnt("RStatus: Warning: not listening on {0}: auth_token "
+                       "is not set".format(address))
+            return
 
-    def socket_activity(self, fd, condition, sock):
-        if sock != self.socket or sock.fileno() != fd:
-            return False
+        tls = bool(self.settings["tls_cert"])
+        (host, sep, port) = address.rpartition(":")
+        host = host.strip("[]") or None
 
         try:
-            (conn, address) = self.socket.accept()
+            (family, stype, proto, name, sockaddr) = \
+                socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)[0]
+
+            # Without TLS, the token and every message would cross the
+            # network in the clear
+            if not tls and not loopback(family, sockaddr):
+                irssi.prnt("RStatus: Warning: not listening on {0}: only "
+                           "loopback addresses are allowed without tls_cert"
+                           .format(address))
+                return
+
+            # Loaded once here, rather than for each connection
+            if tls:
+                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                context.load_cert_chain(self.settings["tls_cert"])
+            else:
+                context = None
+
+            sock = socket.socket(family, stype)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(sockaddr)
+            sock.setblocking(0)
+            sock.listen(self.settings["listen_backlog"])
         except:
-            irssi.prnt("RStatus: Socket error:")
+            irssi.prnt("RStatus: Could not listen on {0}:".format(address))
             irssi.prnt(traceback.format_exc())
+            return
 
-            self.socket.close()
-            self.socket = None
-            return False
-
-        if self.debug:
-            irssi.prnt("RStatus: new client connected")
-
-        if address == '':
-            address = 'UNIX Socket'
-        self.last_set("connect", address)
-
-        conn.setblocking(False)
+        name = "TCP{0} {1}".format(" (TLS)" if tls else "", address)
+        self.listener_add(sock, name, tls=context, auth=True)
 
-        clientinfo = {
-            "send_queue": "",
-            "recv_buffer": "",
-            "send_messages": False,
-            "watches": {},
-            "timeouts": {}
-        }
+    def listener_add(self, sock, name, tls=None, auth=False):
+        # tls is the listener's SSLContext, if it has one
+        self.listeners[sock] = {"name": name, "tls": tls, "auth": auth,
+                                "accept_error": None}
 
-        clientinfo["watches"]["recv"] = \
-            irssi.get_script().io_add_watch(conn, self.client_try_recv,
-                                            conn, irssi.IO_IN)
-        clientinfo["watches"]["err"] = \
-            irssi.get_script().io_add_watch(conn, self.client_drop_ioerror,
-                                            conn, irssi.IO_ERR)
-        clientinfo["watches"]["hup"] = \
-            irssi.get_script().io_add_watch(conn, self.client_drop_ioerror,
-                                            conn, irssi.IO_HUP)
+    def listeners_watch(self):
+        for sock in self.listeners:
+            irssi.get_script().io_add_watch(sock, self.socket_activity, sock)
 
-        self.clients[conn] = clientinfo
+    def listener_rewatch(self, sock):
+        if sock in self.listeners:
+            irssi.get_script().io_add_watch(sock, self.socket_activity, sock)
+        return False
 
-        self.client_timeout_set(conn, "recv", self.timeout_heartbeat,
-                self.client_drop_timeout, (conn, "RECV Timeout (HB, F)"))
-        self.client_new(conn)
+    def helper_start(self):
+        try:
+            (ours, theirs) = socket.socketpair(socket.AF_UNIX,
+                                               socket.SOCK_STREAM)
+            pid = os.fork()
+        except:
+            irssi.prnt("RStatus: Could not start helper process:")
+            irssi.prnt(traceback.format_exc())
+            self.listeners_watch()
+            return
 
-        return True
+        if pid == 0:
+            # Whatever happens, never return into irssi
+            try:
+                ours.close()
+                self.helper_main(theirs)
+            finally:
+                os._exit(0)
+
+        theirs.close()
+        self.helper = HelperLink(self, ours, self.helper_parent_calls, pid)
+        self.helper_sync_send()
+
+    def helper_main(self, upstream):
+        loop = PollLoop(prnt=self.helper_prnt_upstream)
+        self.helper_child(upstream, loop)
+        loop.run()
+
+    def helper_child(self, upstream, loop):
+        global irssi
+
+        self.helper_close_fds([upstream.fileno()] +
+                              [sock.fileno() for sock in self.listeners])
+        irssi = loop
+        self.helper_loop = loop
+        self.helper = None
+        self.upstream = HelperLink(self, upstream, self.helper_child_calls)
+        self.listeners_watch()
+
+    def helper_close_fds(self, keep):
+        # The child must not hold irssi's IRC connections open, or write
+        # to its terminal
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+
+        start = 3
+        for fd in sorted(keep) + [os.sysconf("SC_OPEN_MAX")]:
+            if fd >= start:
+                os.closerange(start, fd)
+                start = fd + 1
+
+    def helper_prnt_upstream(self, text):
+        if self.upstream is not None:
+            self.upstream.call("helper_prnt", text)
+
+    def helper_prnt(self, text):
+        irssi.prnt(text)
+
+    def helper_sync_send(self):
+        if self.helper is not None:
+            self.helper.call("helper_sync", settings_plain(self.settings),
+                             self.filter.args, self.window_levels.values())
+
+    def helper_sync(self, settings, filter_args, windows):
+        self.settings = settings_native(settings)
+        self.filter = FilterPolicy(*filter_args)
+        self.window_levels = collections.OrderedDict(
+                (window_key(info), info) for info in windows)
+        self.snapshots = {}
+
+        # The daemon only learns where to listen from the plugin
+        if self.upstream_listener is not None and not self.listeners:
+            try:
+                self.create_socket()
+            except:
+                irssi.prnt("RStatus: Could not listen for clients:")
+                irssi.prnt(traceback.format_exc())
+                self.helper_loop.stop()
+                return
 
-    def client_timeout_set(self, conn, name, timeout, func, data=None):
-        clientinfo = self.clients[conn]
+            self.listeners_watch()
 
-        if name in clientinfo["timeouts"]:
-            irssi.get_script().source_remove(clientinfo["timeouts"][name])
+    def helper_lost(self, link, reason):
+        if link is self.upstream:
+            self.upstream = None
+            if self.upstream_listener is None:
+                # The plugin has gone (or been unloaded); so do we
+                self.helper_loop.stop()
+            else:
+                irssi.prnt("RStatus: Lost plugin ({0}); waiting for it to "
+                           "reconnect".format(reason))
+            return
 
-        clientinfo["timeouts"][name] = \
-            irssi.get_script().timeout_add(timeout * 1000, func, data)
+        self.helper = None
 
-    def client_sendwatch_add(self, conn, watch):
-        clientinfo = self.clients[conn]
-        assert "send" not in clientinfo["watches"]
+        if link.pid is None:
+            irssi.prnt("RStatus: Lost fan-out daemon ({0})".format(reason))
+            self.daemon_start()
+            return
 
-        clientinfo["watches"]["send"] = \
-            irssi.get_script().io_add_watch(conn, self.client_try_send,
-                                            conn, irssi.IO_OUT)
+        irssi.prnt("RStatus: Lost helper process ({0}); serving clients "
+                   "from irssi".format(reason))
+        self.listeners_watch()
 
-    def client_drop_timeout(self, conn, reason):
-        self.client_drop(conn, reason)
-        return False
+        if self.helper_reap(link.pid):
+            irssi.get_script().timeout_add(1000, self.helper_reap,
+                                           (link.pid, ))
 
-    def client_drop_ioerror(self, fd, condition, conn):
-        if conn not in self.clients or conn.fileno() != fd:
+    def helper_reap(self, pid):
+        # True (try again later) until the helper has exited
+        try:
+            (reaped, status) = os.waitpid(pid, os.WNOHANG)
+        except OSError:
             return False
 
-        if condition == irssi.IO_HUP:
-            reason = "IO Hangup"
-        elif condition == irssi.IO_ERR:
-            reason = "IO Error"
-        else:
-            reason = "IO Error (U)"
+        return reaped == 0
+
+    def daemon_start(self):
+        if self.daemon_connect():
+            irssi.prnt("RStatus: Warning: could not connect to the fan-out "
+                       "daemon at {0}; retrying every {1}s"
+                       .format(self.settings["fanout_daemon"],
+                               self.timeout_daemon_retry))
+            irssi.get_script().timeout_add(self.timeout_daemon_retry * 1000,
+                                           self.daemon_connect)
+
+    def daemon_connect(self):
+        # True (try again later) until connected. The daemon's backlog is
+        # small, so rather than block irssi when it isn't accepting, the
+        # connect fails with EAGAIN and is retried on the next timer
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(self.settings["fanout_daemon"])
+        except socket.error:
+            sock.close()
+            return True
 
-        self.client_drop(conn, reason)
-        return False
+        # Whoever bound the path first would otherwise be sent everything
+        uid = peer_uid(sock)
+        if uid is not None and uid != os.getuid():
+            irssi.prnt("RStatus: Warning: the fan-out daemon at {0} belongs "
+                       "to uid {1}; not using it"
+                       .format(self.settings["fanout_daemon"], uid))
+            self.client_conn_close(sock)
+            return True
 
-    def client_conn_close(self, conn):
-        conn.shutdown(socket.SHUT_RDWR)
-        conn.close()
+        irssi.prnt("RStatus: Connected to the fan-out daemon")
+        self.helper = HelperLink(self, sock, self.helper_parent_calls)
+        self.helper_sync_send()
+        return False
 
-    def client_drop(self, conn, reason, notify=False):
-        if self.debug:
-            irssi.prnt("RStatus: Dropping client: '{0}'".format(reason))
-        self.last_set("drop", reason)
+    def daemon_listen(self, path):
+        self.helper_loop = irssi
+        self.upstream_listener = self.unix_listen(path, 1, private=True)
+        irssi.get_script().io_add_watch(self.upstream_listener,
+                                        self.daemon_accept,
+                                        self.upstream_listener)
 
-        clientinfo = self.clients[conn]
-        del self.clients[conn]
+    def daemon_accept(self, fd, condition, sock):
+        try:
+            (conn, address) = sock.accept()
+        except Exception, e:
+            if would_block(e):
+                return True
 
-        tags = clientinfo["watches"].values() + clientinfo["timeouts"].values()
-        for tag in tags:
-            irssi.get_script().source_remove(tag)
+            irssi.prnt("RStatus: Upstream socket error:")
+            irssi.prnt(traceback.format_exc())
+            self.helper_loop.stop()
+            return False
 
-        if notify and len(clientinfo["send_queue"]) == 0:
-            try:
-                conn.send(json.dumps({"type": "disconnect_notice"}) + "\n")
-            except:
-                self.client_conn_close(conn)
-            else:
-                irssi.get_script().timeout_add(self.timeout_drop_notify * 1000,
-                                               self.client_conn_close, conn)
-        else:
+        uid = peer_uid(conn)
+        if uid is not None and uid != os.getuid():
+            irssi.prnt("RStatus: Refused a plugin connection from uid {0}"
+                       .format(uid))
             self.client_conn_close(conn)
+            return True
 
-    def client_try_recv(self, fd, condition, conn):
-        if conn not in self.clients or conn.fileno() != fd:
-            return False
+        # Only the newest plugin (e.g., after a reload) is listened to
+        if self.upstream is not None:
+            self.upstream.lost("Replaced")
 
-        try:
-            data = conn.recv(1024)
-        except:
-            if self.debug:
-                irssi.prnt("RStatus: Client IO error:")
-                irssi.prnt(traceback.format_exc())
+        irssi.prnt("RStatus: Plugin connected")
+        self.upstream = HelperLink(self, conn, self.helper_child_calls)
+        return True
 
-            self.client_drop(conn, "RECV IO Error")
+    def socket_activity(self, fd, condition, sock):
+        if sock not in self.listeners or sock.fileno() != fd:
             return False
 
-        if not data:
-            if self.debug:
-                irssi.prnt("RStatus: Client read failed")
+        listener = self.listeners[sock]
 
-            self.client_drop(conn, "RECV failed (EOF)")
-            return False
+        # Take everything that is waiting rather than one connection per
+        # trip around the main loop, e.g. when every client reconnects
+        # after a restart
+        while True:
+            try:
+                (conn, address) = sock.accept()
+            except Exception, e:
+                if would_block(e):
+                    return True
 
-        self.clients[conn]["recv_buffer"] += data
+                if isinstance(e, socket.error) and e.errno in accept_skip:
+                    continue
 
-        if len(self.clients[conn]["recv_buffer"]) > self.cbuffer_limit:
-            self.client_drop(conn, "RECV Buffer Overflow", notify=True)
-            return False
+                # e.g. out of file descriptors during a reconnect storm:
+                # the rest stay queued, and as the watch is level triggered
+                # it is dropped for a while rather than firing again at
+                # once. Only the first of a run of these is reported.
+                if isinstance(e, socket.error) and \
+                        e.errno in accept_transient:
+                    if listener["accept_error"] != e.errno:
+                        listener["accept_error"] = e.errno
+                        irssi.prnt("RStatus: Could not accept ({0}): {1}"
+                                   .format(listener["name"], e))
+                    irssi.get_script().timeout_add(
+                            self.timeout_accept_retry * 1000,
+                            self.listener_rewatch, sock)
+                    return False
 
-        if "\n" in self.clients[conn]["recv_buffer"]:
-            data_parts = self.clients[conn]["recv_buffer"].split("\n")
-            self.clients[conn]["recv_buffer"] = data_parts[-1]
-            data_parts = data_parts[:-1]
+                irssi.prnt("RStatus: Socket error ({0}):"
+                           .format(listener["name"]))
+                irssi.prnt(traceback.format_exc())
 
-            for data in data_parts:
-                if data == "":
-                    continue
+                sock.close()
+                del self.listeners[sock]
+                if sock is self.socket:
+                    self.socket = None
+                return False
 
-                try:
-                    data = json.loads(data)
-                    assert isinstance(data, dict)
-                    self.client_recv(conn, data)
+            listener["accept_error"] = None
 
-                    # Happens when we receive a disconnect request
-                    if conn not in self.clients:
-                        return False
-                except:
-                    if self.debug:
-                        irssi.prnt("RStatus: Client parse failed")
-                        irssi.prnt(traceback.format_exc())
+            if self.debug:
+                irssi.prnt("RStatus: new client connected")
 
-                    self.client_drop(conn, "RECV BAD JSON", notify=True)
-                    return False
+            if address == '':
+                address = 'UNIX Socket'
+            self.last_set("connect", address)
 
-        if len(self.clients[conn]["recv_buffer"]) > 0:
-            timeout = self.timeout_txrx
-            reason = "RX"
-        else:
-            timeout = self.timeout_heartbeat
-            reason = "HB"
-        reason = "RECV Timeout ({0})".format(reason)
+            conn.setblocking(False)
 
-        self.client_timeout_set(conn, "recv", timeout,
-                                self.client_drop_timeout, (conn, reason))
+            if listener["tls"]:
+                self.tls_accept(conn, listener)
+            else:
+                self.client_add(conn, listener)
 
-        return True
+    def tls_accept(self, conn, listener):
+        try:
+            conn = listener["tls"].wrap_socket(conn, server_side=True,
+                                               do_handshake_on_connect=False)
+        except:
+            irssi.prnt("RStatus: TLS error:")
+            irssi.prnt(traceback.format_exc())
+            self.client_conn_close(conn)
+            return
+
+        timeout = irssi.get_script().timeout_add(self.timeout_txrx * 1000,
+                self.tls_handshake_drop, (conn, "TLS Handshake Timeout"))
+        self.handshakes[conn] = {"listener": listener, "watch": None,
+                                 "timeout": timeout}
+        self.tls_handshake(None, None, conn)
 
-    def client_try_send(self, fd, condition, conn, init=False):
-        if conn not in self.clients or (not init and conn.fileno() != fd):
+    def tls_handshake(self, fd, condition, conn):
+        handshake = self.handshakes.get(conn)
+        if handshake is None:
             return False
+        handshake["watch"] = None
 
         try:
-            sent = conn.send(self.clients[conn]["send_queue"])
-            if not init:
-                assert sent > 0
+            conn.do_handshake()
         except Exception, e:
-            if isinstance(e, socket.error) and e.errno == errno.EAGAIN and \
-               init:
-                sent = 0
-            else:
+            if not would_block(e):
                 if self.debug:
-                    irssi.prnt("RStatus: Client send failed")
                     irssi.prnt(traceback.format_exc())
-
-                self.client_drop(conn, "SEND IO Error")
+                self.tls_handshake_drop(conn, "TLS Handshake Failed")
                 return False
 
-        self.clients[conn]["send_queue"] = \
-            self.clients[conn]["send_queue"][sent:]
+            if e.errno == ssl.SSL_ERROR_WANT_READ:
+                iotype = irssi.IO_IN
+            else:
+                iotype = irssi.IO_OUT
 
-        if len(self.clients[conn]["send_queue"]) > 0:
-            self.client_timeout_set(conn, "send", self.timeout_txrx,
-                    self.client_drop_timeout, (conn, "SEND Timeout (TX)"))
+            handshake["watch"] = irssi.get_script().io_add_watch(conn,
+                    self.tls_handshake, conn, iotype)
+            return False
 
-            if "send" not in self.clients[conn]["watches"]:
-                self.client_sendwatch_add(conn, True)
+        del self.handshakes[conn]
+        irssi.get_script().source_remove(handshake["timeout"])
+        self.client_add(conn, handshake["listener"])
+        return False
 
-            return True
+    def tls_handshake_drop(self, conn, reason):
+        if self.debug:
+            irssi.prnt("RStatus: Dropping client: '{0}'".format(reason))
+        self.last_set("drop", reason)
+
+        handshake = self.handshakes.pop(conn)
+        for tag in (handshake["watch"], handshake["timeout"]):
+            if tag is not None:
+                irssi.get_script().source_remove(tag)
+
+        self.client_conn_close(conn)
+        return False
+
+    def client_add(self, conn, listener):
+        client = Client(self, conn, tls=bool(listener["tls"]),
+                        authed=not listener["auth"])
+
+        client.watch_add("recv", client.try_recv, irssi.IO_IN)
+        client.watch_add("err", client.drop_ioerror, irssi.IO_ERR)
+        client.watch_add("hup", client.drop_ioerror, irssi.IO_HUP)
+
+        self.clients[conn] = client
+
+        # Clients that must authenticate have little time to do so, and
+        # are sent nothing until they have
+        if client.authed:
+            client.timeout_set("recv", self.timeout_heartbeat,
+                               client.drop, "RECV Timeout (HB, F)")
+            self.client_new(client)
         else:
-            self.client_timeout_set(conn, "send", self.timeout_heartbeat,
-                                    self.client_heartbeat_send, conn)
-            return False
+            client.timeout_set("recv", self.timeout_txrx,
+                               client.drop, "RECV Timeout (Auth)")
+
+    def client_conn_close(self, conn):
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+
+    def client_reset(self, client):
+        client.send_frame(self.reset_frame(client))
+
+    def reset_frame(self, client):
+        encoding = client.encoding
+        reset = self.encode({"type": "reset"}, encoding)
+        return reset + self.snapshot_frame(client)
+
+    def client_resync(self, client, seq):
+        # The client has seen everything up to seq. If everything after
+        # that is still in history, send just that; otherwise start over.
+        if not isinstance(seq, (int, long)) or seq > self.seq or \
+           (seq < self.seq and
+            (not self.history or seq < self.history[0]["seq"] - 1)):
+            self.client_reset(client)
+            return
+
+        frames = []
+
+        for info in self.history:
+            if info["seq"] <= seq:
+                continue
+            if not client.subscription.allows(info):
+                continue
+            frames.append(self.encode(info, client.encoding))
+
+        if frames:
+            client.send_frame("".join(frames))
 
-    def client_reset(self, conn):
-        self.client_send(conn, {"type": "reset"})
-        self.client_new(conn)
+    def client_new(self, client):
+        self.client_subscribe(client)
 
-    def client_new(self, conn):
-        for window in filter(self.filter_event, self.window_all()):
-            self.client_send(conn, window)
+        client.send_frame(self.snapshot_frame(client))
 
-    def client_recv(self, conn, data):
-        if data["type"] == "settings":
+    def client_subscribe(self, client, spec=None):
+        subscription = Subscription(client.send_messages, spec)
+
+        self.client_unsubscribe(client)
+        client.subscription = subscription
+        for key in subscription.keys():
+            self.subscribers.setdefault(key, set()).add(client)
+
+    def client_unsubscribe(self, client):
+        subscription = client.subscription
+        if subscription is None:
+            return
+
+        for key in subscription.keys():
+            subscribers = self.subscribers[key]
+            subscribers.discard(client)
+            if not subscribers:
+                del self.subscribers[key]
+
+    def snapshot_frame(self, client):
+        # Snapshot entries don't carry a seq, so a marker after them says
+        # where in the sequence the client now is
+        return self.snapshot(client.encoding, client.subscription) + \
+            self.encode({"type": "seq", "seq": self.seq}, client.encoding)
+
+    def snapshot(self, encoding, subscription):
+        # Only the unrestricted snapshot is shared, and so cached
+        if subscription.restricted:
+            windows = filter(subscription.allows,
+                             filter(self.filter_event,
+                                    self.window_levels.values()))
+            return "".join(self.encode(w, encoding) for w in windows)
+
+        snapshot = self.snapshots.get(encoding)
+
+        if snapshot is None:
+            windows = filter(self.filter_event, self.window_levels.values())
+            snapshot = "".join(self.encode(w, encoding) for w in windows)
+            self.snapshots[encoding] = snapshot
+
+        return snapshot
+
+    def client_recv(self, client, data):
+        if not client.authed:
+            self.client_auth(client, data)
+        elif data["type"] == "settings":
             if data["send_messages"]:
-                self.clients[conn]["send_messages"] = True
+                client.send_messages = True
             else:
-                self.clients[conn]["send_messages"] = False
+                client.send_messages = False
+
+            # Clients that don't ask, or ask for something we don't have,
+            # get JSON
+            encoding = data.get("encoding", "json")
+            if encoding not in encoders:
+                encoding = "json"
+            client.encoding = encoding
+
+            self.client_subscribe(client, data.get("subscribe"))
         elif data["type"] == "reset_request":
-            self.client_reset(conn)
+            if "seq" in data:
+                self.client_resync(client, data["seq"])
+            else:
+                self.client_reset(client)
         elif data["type"] == "disconnect":
-            self.client_drop(conn, "Graceful Disconnect", notify=True)
+            client.drop("Graceful Disconnect", notify=True)
 
-    def client_send(self, conn, data):
-        data = json.dumps(data)
-        assert "\n" not in data and len(data) < self.cbuffer_limit
-        data += "\n"
+    def client_auth(self, client, data):
+        token = data.get("token") if data["type"] == "auth" else None
+        if isinstance(token, unicode):
+            token = token.encode("utf8")
 
-        if len(self.clients[conn]["send_queue"]) != 0:
-            self.clients[conn]["send_queue"] += data
-            if len(self.clients[conn]["send_queue"]) > self.cbuffer_limit:
-                self.client_drop(conn, "SEND Buffer Overflow")
-        else:
-            self.clients[conn]["send_queue"] = data
-            self.client_try_send(None, None, conn, init=True)
-
-    def client_heartbeat_send(self, conn):
-        clientinfo = self.clients[conn]
-        assert len(clientinfo["send_queue"]) == 0
-        clientinfo["send_queue"] = "\n"
-        self.client_try_send(None, None, conn, init=True)
-        return False
+        expect = self.settings["auth_token"]
+        if not expect or not isinstance(token, str) or \
+           not hmac.compare_digest(token, expect):
+            client.drop("Authentication Failed", notify=True)
+            return
+
+        client.authed = True
+        self.client_new(client)
+
+    def encode(self, data, encoding="json"):
+        data = encoders[encoding](data)
+        assert len(data) <= self.cbuffer_limit
+        return data
 
-if not getattr(irssi, "test_mode", False):
+# The fan-out daemon imports this module with a PollLoop as irssi
+if not getattr(irssi, "test_mode", False) and \
+   not isinstance(irssi, PollLoop):
     rstatus = RStatus()
@@ -0,0 +1,365 @@
+# Copyright 2011 (C) Daniel Richman
+#
+# This file is part of irssi_rstatus
+#
+# irssi_rstatus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# irssi_rstatus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with irssi_rstatus.  If not, see <http://www.gnu.org/licenses/>.
+
+# With fanout_helper set, rstatus forks once it has loaded, and the child
+# owns the listening sockets and every client. The plugin only sends it
+# (method, arguments) calls over a socketpair, so what a signal costs irssi
+# doesn't depend on how many clients there are. The child runs the same
+# rstatus code, with a PollLoop standing in for the irssi module.
+#
+# `python rstatus_helper.py daemon PATH` does the same as a process of its
+# own: the plugin, with fanout_daemon set to PATH, connects to it, and can
+# be reloaded (or irssi restarted) without clients noticing.
+#
+# Calls are JSON lines rather than pickles: whatever arrives on the link can
+# at most name a call that the receiving end accepts.
+
+import os
+import sys
+import time
+import heapq
+import errno
+import select
+import traceback
+import collections
+
+from rstatus_proto import encode_line, decode_line
+
+def pack_call(name, args):
+    return encode_line([name, list(args)])
+
+class CallReader:
+    """
+    Splits what arrives on the socketpair back into (name, args) calls
+
+    Each call is a [name, [args...]] JSON list on a line of its own, so
+    arguments arrive as lists, dicts, unicode strings and numbers only.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+        if "\n" not in data:
+            if self.size > self.limit:
+                raise ValueError("call too long ({0} bytes)"
+                                 .format(self.size))
+            return []
+
+        lines = "".join(self.chunks).split("\n")
+        rest = lines.pop()
+        self.chunks = [rest]
+        self.size = len(rest)
+
+        calls = []
+        for line in lines:
+            if len(line) > self.limit:
+                raise ValueError("call too long ({0} bytes)"
+                                 .format(len(line)))
+
+            call = decode_line(line)
+            if not isinstance(call, list) or len(call) != 2 or \
+               not isinstance(call[0], basestring) or \
+               not isinstance(call[1], list):
+                raise ValueError("bad call {0!r}".format(line[:64]))
+
+            calls.append((call[0], call[1]))
+
+        return calls
+
+class PollLoop:
+    """
+    The parts of irssi's main loop that rstatus uses, on select.poll
+
+    IO_* are poll's flags, which have the same values as GLib's. As in
+    irssi, a source whose callback returns something false is removed,
+    and tuple data is passed as several arguments.
+    """
+
+    IO_IN = select.POLLIN
+    IO_OUT = select.POLLOUT
+    IO_ERR = select.POLLERR
+    IO_HUP = select.POLLHUP
+
+    def __init__(self, prnt=None):
+        self.poll = select.poll()
+        self.print_func = prnt
+        self.next_tag = 1
+        # tag -> (fd, func, data, condition); fd -> tags
+        self.watches = {}
+        self.fds = collections.defaultdict(set)
+        # tag -> [interval, func, data], with (due, tag) in a heap
+        self.timeouts = {}
+        self.due = []
+        self.running = False
+
+    def get_script(self):
+        return self
+
+    def prnt(self, text):
+        if self.print_func is not None:
+            self.print_func(text)
+
+    def tag_new(self):
+        tag = self.next_tag
+        self.next_tag += 1
+        return tag
+
+    def io_add_watch(self, fd, func, data=None, condition=IO_IN):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+
+        tag = self.tag_new()
+        self.watches[tag] = (fd, func, data, condition)
+        self.fds[fd].add(tag)
+        self.fd_update(fd)
+        return tag
+
+    def timeout_add(self, msecs, func, data=None):
+        tag = self.tag_new()
+        self.timeouts[tag] = [msecs, func, data]
+        heapq.heappush(self.due, (time.time() + msecs / 1000.0, tag))
+        return tag
+
+    def source_remove(self, tag):
+        if tag in self.watches:
+            fd = self.watches.pop(tag)[0]
+            self.fds[fd].discard(tag)
+            self.fd_update(fd)
+        else:
+            self.timeouts.pop(tag, None)
+
+    def fd_update(self, fd):
+        mask = 0
+        for tag in self.fds[fd]:
+            mask |= self.watches[tag][3]
+
+        if mask:
+            self.poll.register(fd, mask)
+        else:
+            del self.fds[fd]
+            try:
+                self.poll.unregister(fd)
+            except KeyError:
+                pass
+
+    def call(self, func, args):
+        try:
+            return func(*args)
+        except:
+            self.prnt("RStatus: Helper callback error:")
+            self.prnt(traceback.format_exc())
+            return False
+
+    def run_once(self):
+        if self.due:
+            wait = max(0, int((self.due[0][0] - time.time()) * 1000))
+        else:
+            wait = -1
+
+        try:
+            events = self.poll.poll(wait)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for (fd, revents) in events:
+            for tag in list(self.fds.get(fd, ())):
+                watch = self.watches.get(tag)
+                if watch is None or not revents & watch[3]:
+                    continue
+
+                (fd, func, data, condition) = watch
+                if data is None:
+                    args = (fd, condition)
+                elif isinstance(data, tuple):
+                    args = (fd, condition) + data
+                else:
+                    args = (fd, condition, data)
+
+                if not self.call(func, args):
+                    self.source_remove(tag)
+
+        now = time.time()
+        while self.due and self.due[0][0] <= now:
+            (due, tag) = heapq.heappop(self.due)
+            timeout = self.timeouts.get(tag)
+            if timeout is None:
+                continue
+
+            (msecs, func, data) = timeout
+            if data is None:
+                args = ()
+            elif isinstance(data, tuple):
+                args = data
+            else:
+                args = (data, )
+
+            if self.call(func, args) and tag in self.timeouts:
+                heapq.heappush(self.due, (now + msecs / 1000.0, tag))
+            else:
+                self.timeouts.pop(tag, None)
+
+    def run(self):
+        self.running = True
+        while self.running and (self.watches or self.timeouts):
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+def log(text):
+    sys.stderr.write(time.strftime("%Y-%m-%d %H:%M:%S ") + text + "\n")
+
+def daemon_main(path):
+    loop = PollLoop(prnt=log)
+    sys.modules["irssi"] = loop
+    import rstatus
+
+    daemon = rstatus.RStatus(daemon_path=path)
+
+    def prnt(text):
+        # /rstatus and the like are answered in irssi, while it's connected
+        if daemon.upstream is not None:
+            daemon.helper_prnt_upstream(text)
+        else:
+            log(text)
+
+    loop.print_func = prnt
+    loop.run()
+
+def loadtest(clients=2000, updates=200):
+    import socket
+    import shutil
+    import signal
+    import resource
+    import tempfile
+
+    # Each client costs a descriptor here and another in the daemon
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        clients = min(clients, hard - 64)
+    if soft != resource.RLIM_INFINITY and soft < clients + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (clients + 64, hard))
+
+    tmp = tempfile.mkdtemp()
+    upstream_path = os.path.join(tmp, "upstream")
+    clients_path = os.path.join(tmp, "clients")
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            daemon_main(upstream_path)
+        finally:
+            os._exit(0)
+
+    try:
+        upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for i in xrange(100):
+            try:
+                upstream.connect(upstream_path)
+                break
+            except socket.error:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError("the daemon didn't start")
+
+        settings = {"socket": clients_path, "listen_tcp": "",
+                    "listen_backlog": clients, "auth_token": "",
+                    "tls_cert": "", "slow_consumer": "disconnect"}
+        policy = [True, True, [], []]
+        window = {"nick": "somebody", "server": "loadtest", "level": 1,
+                  "wtype": "query", "type": "window_level"}
+        upstream.sendall(pack_call("helper_sync",
+                                   (settings, policy, [window])))
+
+        while not os.path.exists(clients_path):
+            time.sleep(0.01)
+
+        start = time.time()
+        socks = []
+        for i in xrange(clients):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(clients_path)
+            sock.setblocking(False)
+            socks.append(sock)
+
+        # Everyone has been accepted once they have the snapshot
+        received = wait_lines(socks, 1)
+        print "{0} clients connected in {1:.2f}s".format(
+            received, time.time() - start)
+
+        start = time.time()
+        for i in xrange(updates):
+            info = dict(window, nick="somebody{0}".format(i), level=2)
+            upstream.sendall(pack_call("broadcast", (info, )))
+        upstream_time = time.time() - start
+
+        received = wait_lines(socks, updates)
+        total_time = time.time() - start
+        print "{0} updates to {1} clients: {2:.0f} frames/s; " \
+              "upstream took {3:.1f}ms, delivery {4:.2f}s".format(
+            updates, received, updates * received / total_time,
+            upstream_time * 1000, total_time)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        shutil.rmtree(tmp)
+
+def wait_lines(socks, count, timeout=60):
+    # Returns how many sockets have received count lines
+    poll = select.poll()
+    lines = dict((sock.fileno(), 0) for sock in socks)
+    by_fd = dict((sock.fileno(), sock) for sock in socks)
+    for fd in lines:
+        poll.register(fd, select.POLLIN)
+
+    waiting = len(socks)
+    done = 0
+    deadline = time.time() + timeout
+    while waiting and time.time() < deadline:
+        for (fd, event) in poll.poll(1000):
+            data = by_fd[fd].recv(65536)
+            lines[fd] += data.count("\n")
+            if lines[fd] >= count:
+                done += 1
+            elif data:
+                continue
+
+            poll.unregister(fd)
+            waiting -= 1
+
+    return done
+
+if __name__ == "__main__":
+    # rstatus imports this module by name, and must see the same PollLoop
+    import rstatus_helper
+
+    if len(sys.argv) == 3 and sys.argv[1] == "daemon":
+        rstatus_helper.daemon_main(os.path.expanduser(sys.argv[2]))
+    elif 2 <= len(sys.argv) <= 4 and sys.argv[1] == "loadtest":
+        rstatus_helper.loadtest(*[int(arg) for arg in sys.argv[2:]])
+    else:
+        print "Usage: {0} daemon PATH | loadtest [CLIENTS [UPDATES]]" \
+              .format(sys.argv[0])
+        sys.exit(1)
@@ -24,26 +24,32 @@ import fcntl
 import select
 import atexit
 import time
-import json
 import logging
 import glib
 import gtk
 import pynotify
 
+from rstatus_proto import encode_line, StreamDecoder
+
 class RStatusNotify:
     heartbeat = 60 * 10
     heartbeat_leeway = 60
     nobj_prune = 20
     txtimeout = 60
+    reconnect_delay = 10
     level_names = ["none", "none", "message", "hilight"]
 
     def __init__(self, config):
         self.config = config
 
     def cleanup(self):
+        if self._p is None:
+            return
+
         self._p.stdout.close()
         self._p.stdin.close()
         self._p.terminate()
+        self._p = None
 
     def set_nb(self, f):
         flags = fcntl.fcntl(f, fcntl.F_GETFL)
@@ -51,9 +57,9 @@ class RStatusNotify:
         fcntl.fcntl(f, fcntl.F_SETFL)
 
     def prepare(self):
-        self.write_buffer = ""
-        self.read_buffer = ""
-        self.read_watch = None
+        self._p = None
+        self.seq = None
+        self.watches = []
         self.timeouts = {}
         self.windows = {}
         self.notifications = {}
@@ -71,34 +77,71 @@ class RStatusNotify:
         self._p = subprocess.Popen(config["connect_command"],
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE)
-        atexit.register(self.cleanup)
 
         self.set_nb(self._p.stdin)
         self.set_nb(self._p.stdout)
 
     def cb_io_problem(self, source, condition):
         logging.info("io_problem: " + repr(condition))
-        gtk.main_quit()
+        self.disconnect()
+        return False
 
     def run(self):
         self.prepare()
-        self.open_ssh()
+        atexit.register(self.cleanup)
         self.create_icon()
+        self.connect()
+        gtk.main()
 
-        glib.io_add_watch(self._p.stdout, glib.IO_ERR | glib.IO_HUP,
-                          self.cb_io_problem)
-        glib.io_add_watch(self._p.stdin, glib.IO_ERR | glib.IO_HUP,
-                          self.cb_io_problem)
+    def connect(self):
+        self.write_buffer = ""
+        self.write_watch = None
+        self.decoder = StreamDecoder()
+        self.open_ssh()
 
-        glib.io_add_watch(self._p.stdout, glib.IO_IN,
-                          self.cb_io_in)
+        self.watches = [
+            glib.io_add_watch(self._p.stdout, glib.IO_ERR | glib.IO_HUP,
+                              self.cb_io_problem),
+            glib.io_add_watch(self._p.stdin, glib.IO_ERR | glib.IO_HUP,
+                              self.cb_io_problem),
+            glib.io_add_watch(self._p.stdout, glib.IO_IN,
+                              self.cb_io_in)
+        ]
 
         self.update_hb_timeout("read", 1, self.timeout_drop, "READ (F)")
         self.update_hb_timeout("sendhb", -1, self.send_heartbeat)
 
-        self.output({"type": "settings", "send_messages": True})
+        # Needed when connecting straight to a TCP listener
+        if self.config.get("auth_token"):
+            self.output({"type": "auth", "token": self.config["auth_token"]})
 
-        gtk.main()
+        self.output({"type": "settings", "send_messages": True,
+                     "encoding": self.config["encoding"],
+                     "subscribe": self.config.get("subscribe")})
+
+        # After a reconnect, ask only for what we missed. The server sends
+        # a reset and everything if it no longer has that.
+        if self.seq is not None:
+            self.output({"type": "reset_request", "seq": self.seq})
+
+        return False
+
+    def disconnect(self):
+        logging.info("Reconnecting in {0}s".format(self.reconnect_delay))
+
+        for name in self.timeouts.keys():
+            self.update_timeout(name, None, None)
+
+        watches = self.watches
+        if self.write_watch != None:
+            watches.append(self.write_watch)
+        for watch in watches:
+            glib.source_remove(watch)
+        self.watches = []
+        self.write_watch = None
+
+        self.cleanup()
+        glib.timeout_add_seconds(self.reconnect_delay, self.connect)
 
     def update_timeout(self, name, t, callback, *args):
         if name in self.timeouts:
@@ -114,7 +157,8 @@ class RStatusNotify:
 
     def timeout_drop(self, reason):
         logging.error("Heartbeat timed out: " + reason)
-        gtk.main_quit()
+        self.disconnect()
+        return False
 
     def send_heartbeat(self):
         self.update_hb_timeout("sendhb", -1, self.send_heartbeat)
@@ -123,22 +167,18 @@ class RStatusNotify:
 
     def cb_io_in(self, source, condition):
         data = os.read(self._p.stdout.fileno(), 1024)
-        self.read_buffer += data
 
         if data:
             self.update_hb_timeout("read", 1, self.timeout_drop, "READ")
 
-        if "\n" in self.read_buffer:
-            lines = self.read_buffer.split("\n")
-            self.read_buffer = lines[-1]
-
-            for line in lines[:-1]:
-                if line:
-                    logging.debug("Processing obj: " + line)
-                    obj = json.loads(line)
-                    self.handle_input(obj)
-                else:
-                    logging.debug("Received HB")
+        # Old servers ignore the encoding setting and keep sending JSON, and
+        # the decoder accepts either
+        for obj in self.decoder.feed(data):
+            if obj is not None:
+                logging.debug("Processing obj: " + repr(obj))
+                self.handle_input(obj)
+            else:
+                logging.debug("Received HB")
 
         return True
 
@@ -164,10 +204,17 @@ class RStatusNotify:
     def output(self, obj):
         logging.debug("Sending obj: " + repr(obj))
         self.update_hb_timeout("sendhb", -1, self.send_heartbeat)
-        self.write_buffer += json.dumps(obj) + "\n"
+        self.write_buffer += encode_line(obj)
         self.cb_io_out(None, None)
 
     def handle_input(self, obj):
+        # Events carry their seq; after a snapshot, a marker says where
+        # the server is
+        if obj["type"] == "seq":
+            self.seq = obj["seq"]
+        elif "seq" in obj:
+            self.seq = max(self.seq, obj["seq"])
+
         if obj["type"] == "reset":
             self.handle_reset()
         if obj["type"] == "message":
@@ -182,10 +229,19 @@ class RStatusNotify:
         if obj["wtype"] == "query":
             key = (obj["server"], "query", obj["nick"])
             title = "{nick} ({server})".format(**obj)
-            message = obj["message"]
         elif obj["wtype"] == "channel":
             key = (obj["server"], "channel", obj["channel"], obj["nick"])
             title = "{nick} in {channel} ({server})".format(**obj)
+
+        # During a flood the server folds messages together, sending how
+        # many there were and the last few lines
+        if "lines" in obj:
+            lines = obj["lines"]
+            skipped = obj["count"] - len(lines)
+            if skipped > 0:
+                lines = ["({0} more)".format(skipped)] + lines
+            message = "\n".join(lines)
+        else:
             message = obj["message"]
 
         self.show_notification(key, title, message)
@@ -286,7 +342,8 @@ if __name__ == "__main__":
         "connect_command": ("ssh", server, "socat", "-T", "700",
                             "unix-client:.irssi/rstatus_sock",
                             "stdin!!stdout"),
-        "icons_dir": os.path.realpath(os.path.dirname(__file__))
+        "icons_dir": os.path.realpath(os.path.dirname(__file__)),
+        "encoding": "compact"
     }
 
     logging.basicConfig(level=logging.INFO,
@@ -0,0 +1,416 @@
+# Copyright 2011 (C) Daniel Richman
+#
+# This file is part of irssi_rstatus
+#
+# irssi_rstatus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# irssi_rstatus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with irssi_rstatus.  If not, see <http://www.gnu.org/licenses/>.
+
+# Wire protocol helpers shared by rstatus.py and the clients. This file
+# must not import irssi.
+
+import sys
+import re
+import time
+import struct
+
+# Fastest first; both escape newlines inside strings, which the newline
+# delimited framing relies on. (simplejson benchmarked slower than json, and
+# orjson does not support Python 2.)
+codec_preference = ["ujson", "json"]
+
+def codec_find(names):
+    for name in names:
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+
+    raise ImportError("No JSON codec available from " + repr(names))
+
+codec = codec_find(codec_preference)
+
+def encode_line(obj, codec=codec):
+    data = codec.dumps(obj)
+    assert "\n" not in data
+    return data + "\n"
+
+def decode_line(line, codec=codec):
+    return codec.loads(line)
+
+# Compact frames are COMPACT_MARKER, a 16 bit big endian body length and the
+# body. Neither a JSON object nor a heartbeat can start with the marker, so
+# both kinds of frame can share a stream. The body is a sequence of fields:
+# a key code (or 0xff and the key as a string), a value tag and the value.
+# Common keys and string values are sent as their index in these tables.
+COMPACT_MARKER = "\x01"
+compact_keys = ["type", "wtype", "server", "channel", "nick", "level",
+                "message"]
+compact_strings = ["message", "window_level", "reset", "disconnect_notice",
+                   "channel", "query"]
+
+(COMPACT_SMALLINT, COMPACT_INT, COMPACT_INTERNED, COMPACT_STRING,
+ COMPACT_TRUE, COMPACT_FALSE, COMPACT_NONE, COMPACT_LIST) = range(8)
+
+compact_key_codes = dict((k, i) for (i, k) in enumerate(compact_keys))
+compact_string_codes = dict((v, i) for (i, v) in enumerate(compact_strings))
+
+def compact_string(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf8")
+    return struct.pack("!H", len(value)) + value
+
+def compact_value(value):
+    if value is True:
+        return chr(COMPACT_TRUE)
+    elif value is False:
+        return chr(COMPACT_FALSE)
+    elif value is None:
+        return chr(COMPACT_NONE)
+    elif isinstance(value, (int, long)):
+        if 0 <= value < 256:
+            return chr(COMPACT_SMALLINT) + chr(value)
+        else:
+            return chr(COMPACT_INT) + struct.pack("!q", value)
+    elif isinstance(value, (list, tuple)):
+        return chr(COMPACT_LIST) + struct.pack("!H", len(value)) + \
+               "".join(compact_value(v) for v in value)
+    elif value in compact_string_codes:
+        return chr(COMPACT_INTERNED) + chr(compact_string_codes[value])
+    else:
+        return chr(COMPACT_STRING) + compact_string(value)
+
+def encode_compact(obj):
+    body = []
+
+    for key, value in obj.iteritems():
+        if key in compact_key_codes:
+            body.append(chr(compact_key_codes[key]))
+        else:
+            body.append("\xff" + compact_string(key))
+        body.append(compact_value(value))
+
+    body = "".join(body)
+    assert len(body) < 65536
+    return COMPACT_MARKER + struct.pack("!H", len(body)) + body
+
+def decode_compact_string(body, pos):
+    (length, ) = struct.unpack_from("!H", body, pos)
+    pos += 2
+    value = body[pos:pos + length].decode("utf8", "replace")
+    return (value, pos + length)
+
+def decode_compact_value(body, pos):
+    tag = ord(body[pos])
+    pos += 1
+
+    if tag == COMPACT_SMALLINT:
+        return (ord(body[pos]), pos + 1)
+    elif tag == COMPACT_INT:
+        return (struct.unpack_from("!q", body, pos)[0], pos + 8)
+    elif tag == COMPACT_INTERNED:
+        return (unicode(compact_strings[ord(body[pos])]), pos + 1)
+    elif tag == COMPACT_STRING:
+        return decode_compact_string(body, pos)
+    elif tag == COMPACT_TRUE:
+        return (True, pos)
+    elif tag == COMPACT_FALSE:
+        return (False, pos)
+    elif tag == COMPACT_NONE:
+        return (None, pos)
+    elif tag == COMPACT_LIST:
+        (count, ) = struct.unpack_from("!H", body, pos)
+        pos += 2
+        values = []
+        for i in xrange(count):
+            (value, pos) = decode_compact_value(body, pos)
+            values.append(value)
+        return (values, pos)
+    else:
+        raise ValueError("Bad compact value tag {0}".format(tag))
+
+def decode_compact(body):
+    obj = {}
+    pos = 0
+
+    while pos < len(body):
+        code = ord(body[pos])
+        pos += 1
+
+        if code == 0xff:
+            (key, pos) = decode_compact_string(body, pos)
+        else:
+            key = unicode(compact_keys[code])
+
+        (obj[key], pos) = decode_compact_value(body, pos)
+
+    if pos != len(body):
+        raise ValueError("Truncated compact frame")
+
+    return obj
+
+encoders = {
+    "json": encode_line,
+    "compact": encode_compact
+}
+
+class StreamDecoder:
+    """
+    Splits the server's output into objects
+
+    Accepts newline terminated JSON, compact frames and heartbeats (which
+    are returned as None) in any mix.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        self.buffer += data
+        objs = []
+        pos = 0
+
+        while pos < len(self.buffer):
+            if self.buffer[pos] == COMPACT_MARKER:
+                if len(self.buffer) - pos < 3:
+                    break
+
+                (length, ) = struct.unpack_from("!H", self.buffer, pos + 1)
+                end = pos + 3 + length
+                if end > len(self.buffer):
+                    break
+
+                objs.append(decode_compact(self.buffer[pos + 3:end]))
+                pos = end
+            else:
+                end = self.buffer.find("\n", pos)
+                if end == -1:
+                    break
+
+                if end == pos:
+                    objs.append(None)
+                else:
+                    objs.append(decode_line(self.buffer[pos:end]))
+                pos = end + 1
+
+        self.buffer = self.buffer[pos:]
+        return objs
+
+class LineFramer:
+    """
+    Splits a stream of bytes into newline terminated lines
+
+    Reads go straight into a preallocated bytearray with recv_into(), and
+    only the newly arrived bytes are searched for newlines. Complete lines
+    are handed out as memoryview slices of that buffer; they are only valid
+    until the next call to recv_into().
+    """
+
+    def __init__(self, limit, read_size=1024):
+        self.buffer = bytearray(limit)
+        self.view = memoryview(self.buffer)
+        self.read_size = read_size
+        self.start = 0
+        self.scanned = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def full(self):
+        return len(self) == len(self.buffer)
+
+    def compact(self):
+        if self.start == 0:
+            return
+
+        pending = self.end - self.start
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.scanned -= self.start
+        self.end = pending
+        self.start = 0
+
+    def recv_into(self, conn):
+        self.compact()
+        space = len(self.buffer) - self.end
+        assert space > 0
+
+        nbytes = conn.recv_into(self.view[self.end:],
+                                min(self.read_size, space))
+        self.end += nbytes
+        return nbytes
+
+    def lines(self):
+        while True:
+            newline = self.buffer.find("\n", self.scanned, self.end)
+            if newline == -1:
+                self.scanned = self.end
+                return
+
+            line = self.view[self.start:newline]
+            self.start = self.scanned = newline + 1
+            yield line
+
+# Well formed UTF-8, as accepted by Python 2's decoder (which lets
+# surrogates through). Each byte can only be matched one way, so a mismatch
+# never backtracks far.
+utf8_valid = re.compile(r"""\A(?:
+    [\x00-\x7f]
+  | [\xc2-\xdf][\x80-\xbf]
+  | \xe0[\xa0-\xbf][\x80-\xbf]
+  | [\xe1-\xef][\x80-\xbf]{2}
+  | \xf0[\x90-\xbf][\x80-\xbf]{2}
+  | [\xf1-\xf3][\x80-\xbf]{3}
+  | \xf4[\x80-\x8f][\x80-\xbf]{2}
+)*\Z""", re.VERBOSE)
+# Any non-ASCII UTF-8 has a lead byte followed by a continuation byte
+utf8_pair = re.compile(r"[\xc2-\xf4][\x80-\xbf]")
+# Text without any of these is ASCII
+class TextDecoder:
+    """
+    Decodes IRC text that might be ASCII, UTF-8 or Latin-1
+
+    Gives the same result as trying each codec in turn, but without raising
+    and catching an exception per failed codec. Most lines are ASCII, so
+    that is tried first, unless the sender (keyed by, e.g., server and
+    nick) has sent high bytes before; other lines are sorted into UTF-8 or
+    Latin-1 by matching byte patterns. The codec each sender last needed is
+    remembered, so a sender known to use UTF-8 skips the ASCII attempt and
+    the sniff for UTF-8 byte sequences.
+    """
+
+    memo_limit = 4096
+
+    def __init__(self):
+        self.memo = {}
+
+    def decode(self, text, key=None):
+        codec = self.memo.get(key)
+        if codec is None:
+            try:
+                return unicode(text, "ascii")
+            except UnicodeDecodeError:
+                pass
+
+        # Decoding with replacement can't fail; the result is only checked
+        # against the slower pattern if it contains a replacement character
+        decoded = None
+        if codec == "utf8" or utf8_pair.search(text):
+            decoded = unicode(text, "utf8", "replace")
+            if u"\ufffd" in decoded and not utf8_valid.match(text):
+                decoded = None
+
+        if decoded is None:
+            result = "latin-1"
+            decoded = unicode(text, "latin-1")
+        else:
+            result = "utf8"
+
+        if key is not None and result != codec:
+            if len(self.memo) >= self.memo_limit:
+                self.memo.clear()
+            self.memo[key] = result
+
+        return decoded
+
+def decode_by_exceptions(text):
+    # What TextDecoder replaced; kept for benchmark() and the tests
+    for enc in ["ascii", "utf8", "iso-8859-1"]:
+        try:
+            return unicode(text, enc)
+        except UnicodeDecodeError:
+            pass
+
+def benchmark_decode(rounds=20000):
+    lines = {
+        "ascii": "mynick: have you seen the new release yet? it's out",
+        "utf8": u"mynick: \u00e7a marche tr\u00e8s bien, merci \u263a"
+                .encode("utf8"),
+        "latin-1": u"mynick: \u00e7a marche tr\u00e8s bien, \u00e0 demain"
+                   .encode("latin-1")
+    }
+    corpora = [(name, [line]) for (name, line) in sorted(lines.items())]
+    corpora.append(("mixed", [lines["ascii"]] * 6 +
+                             [lines["utf8"]] * 2 + [lines["latin-1"]] * 2))
+
+    for name, corpus in corpora:
+        decoder = TextDecoder()
+        keyed = [(line, ("freenode", "nick{0}".format(i % 7)))
+                 for (i, line) in enumerate(corpus)]
+        count = rounds * len(corpus)
+
+        start = time.time()
+        for i in xrange(rounds):
+            for line in corpus:
+                decode_by_exceptions(line)
+        old_time = time.time() - start
+
+        start = time.time()
+        for i in xrange(rounds):
+            for line, key in keyed:
+                decoder.decode(line, key)
+        new_time = time.time() - start
+
+        print "{0:12} exceptions {1:6.2f}us TextDecoder {2:6.2f}us".format(
+            name, old_time * 1e6 / count, new_time * 1e6 / count)
+
+def benchmark(rounds=20000):
+    events = {
+        "message": {
+            "channel": "#irssi",
+            "nick": "somebody",
+            "server": "freenode",
+            "type": "message",
+            "wtype": "channel",
+            "message": u"mynick: have you seen the new release? \u00e9\u00e8"
+        },
+        "window_level": {
+            "nick": "somebody",
+            "server": "freenode",
+            "level": 3,
+            "wtype": "query",
+            "type": "window_level"
+        }
+    }
+
+    for name in codec_preference:
+        try:
+            module = codec_find([name])
+        except ImportError:
+            print "{0:12} not installed".format(name)
+            continue
+
+        for event_name, event in sorted(events.items()):
+            line = encode_line(event, module)
+
+            start = time.time()
+            for i in xrange(rounds):
+                encode_line(event, module)
+            encode_time = time.time() - start
+
+            start = time.time()
+            for i in xrange(rounds):
+                decode_line(line, module)
+            decode_time = time.time() - start
+
+            print "{0:12} {1:14} encode {2:6.2f}us decode {3:6.2f}us".format(
+                name, event_name,
+                encode_time * 1e6 / rounds, decode_time * 1e6 / rounds)
+
+    benchmark_decode(rounds)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        print "Usage: {0} benchmark".format(sys.argv[0])
+        sys.exit(1)
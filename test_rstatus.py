@@ -16,9 +16,17 @@
 # along with irssi_rstatus.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import string
 import json
 import collections
 import errno
+import time
+import socket
+import pickle
+import struct
+import os
+import shutil
+import tempfile
 
 class FakeIrssiWindow:
     def __init__(self, name, data_level):
@@ -41,10 +49,15 @@ class FakeIrssiServer:
         else:
             return self.channels[name]
 
+class FakeIrssiNick:
+    def __init__(self, nick):
+        self.nick = nick
+
 class FakeIrssiIrcChannel:
     def __init__(self, name, nicks=None, server=None):
         self.name = name
         self._nicks = []
+        self.nicks_calls = 0
 
         if nicks:
             self._nicks += nicks
@@ -55,7 +68,8 @@ class FakeIrssiIrcChannel:
             self.server = FakeIrssiServer()
 
     def nicks(self):
-        return self._nicks
+        self.nicks_calls += 1
+        return [FakeIrssiNick(nick) for nick in self._nicks]
 
 class FakeIrssiQuery:
     def __init__(self, name, server=None):
@@ -83,11 +97,14 @@ class FakeIrssiModule:
     def reset(self):
         self.signals = {}
         self.timeouts = {}
+        self.intervals = {}
         self.settings = {}
         self.iowatches = {}
         self._windows = []
         self.commands = {}
         self.sourceid = 1
+        self.presets = {}
+        self.stopped = False
 
     def signal_add(self, name, func):
         assert name not in self.signals
@@ -97,6 +114,7 @@ class FakeIrssiModule:
         i = self.sourceid
         self.sourceid += 1
         self.timeouts[i] = [time, func, data]
+        self.intervals[i] = time
         return i
 
     def io_add_watch(self, fd, func, data=None, iotype=None):
@@ -116,19 +134,35 @@ class FakeIrssiModule:
         self.settings[name] = {
             "section": section,
             "default": default,
-            "value": default
+            "value": self.presets.get(name, default)
         }
 
     def settings_get_str(self, name):
+        assert isinstance(self.settings[name]["value"], str)
         return self.settings[name]["value"]
 
     def settings_set_str(self, name, value):
+        assert isinstance(self.settings[name]["value"], str)
+        self.settings[name]["value"] = value
+
+    settings_add_int = settings_add_str
+
+    def settings_get_int(self, name):
+        assert isinstance(self.settings[name]["value"], int)
+        return self.settings[name]["value"]
+
+    def settings_set_int(self, name, value):
+        assert isinstance(self.settings[name]["value"], int)
         self.settings[name]["value"] = value
 
     def prnt(self, text):
         for line in text.split("\n"):
             print "Irssi: " + line
 
+    def stop(self):
+        # As PollLoop, in the helper
+        self.stopped = True
+
     def add_window(self, window):
         self._windows.append(window)
 
@@ -143,12 +177,14 @@ class FakeIrssiModule:
             timeouts.sort(key=lambda x: x[1][0])
 
             if len(timeouts) == 0:
+                fakes["time"].now += amount / 1000.0
                 break
 
             (first_id, first_timeout) = timeouts[0]
             step = min(amount, first_timeout[0])
 
             amount -= step
+            fakes["time"].now += step / 1000.0
             for tid in self.timeouts:
                 self.timeouts[tid][0] -= step
 
@@ -160,12 +196,16 @@ class FakeIrssiModule:
                 if not isinstance(data, collections.Sequence):
                     data = (data, )
 
-                first_timeout[1](*data)
+                ret = first_timeout[1](*data)
             else:
-                first_timeout[1]()
+                ret = first_timeout[1]()
 
+            # Like GLib, a true return value means "call me again"
             if first_id in self.timeouts:
-                del self.timeouts[first_id]
+                if ret:
+                    first_timeout[0] = self.intervals[first_id]
+                else:
+                    del self.timeouts[first_id]
 
     def proc_io(self):
         remove = []
@@ -218,10 +258,11 @@ class FakeSocketClass:
         cls.next_fd += 1
         return cls.next_fd
     
-    def __init__(self, family=None, stype=None, client=False):
+    def __init__(self, family=None, stype=None, client=False, paired=False):
         self.family = family
         self.stype = stype
         self.client = client
+        self.paired = paired
         self.called_bind = False
         self.called_listen = False
         self.called_setblocking = False
@@ -232,6 +273,9 @@ class FakeSocketClass:
         self.recvable = []
         self.closed = False
         self.send_error = False
+        self.sockopts = {}
+        self.handshake_wants = []
+        self.peer_uid = fakes["socket"].peer_uid
         self._fd = self.get_fd()
 
     def fileno(self):
@@ -245,6 +289,17 @@ class FakeSocketClass:
         self.called_bind = True
         self.addr = addr
 
+    def connect(self, addr):
+        assert not self.client
+        assert not self.called_bind
+        assert not self.closed
+        self.connect_nonblocking = self.called_setblocking
+        if fakes["socket"].connect_error:
+            raise fakes["socket"].connect_error
+        self.client = True
+        self.sendable = 10 ** 6
+        self.addr = addr
+
     def setblocking(self, v):
         assert v == False
         assert not self.closed
@@ -256,11 +311,17 @@ class FakeSocketClass:
         assert not self.closed
         assert num > 0
         self.called_listen = True
+        self.backlog = num
 
     def accept(self):
         assert not self.client
         assert not self.closed
-        return self.acceptable.pop(0)
+        if not self.acceptable:
+            raise FakeSocketError()
+        result = self.acceptable.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
 
     def send(self, data):
         assert self.client
@@ -268,6 +329,7 @@ class FakeSocketClass:
         assert not self.closed
         if self.send_error:
             raise self.send_error
+        data = str(data)
         sent = min(self.sendable, len(data))
         self.sendable = max(0, self.sendable - len(data))
         self.sent.append((sent, data, data[:sent]))
@@ -279,21 +341,90 @@ class FakeSocketClass:
         assert not self.closed
         return self.recvable.pop(0)
 
+    def recv_into(self, buf, nbytes):
+        assert self.client
+        assert self.called_setblocking
+        assert not self.closed
+        assert 0 < nbytes <= len(buf)
+        data = self.recvable.pop(0)
+        if not data:
+            return 0
+        if len(data) > nbytes:
+            self.recvable.insert(0, data[nbytes:])
+            data = data[:nbytes]
+        buf[:len(data)] = data
+        return len(data)
+
+    def setsockopt(self, level, option, value):
+        self.sockopts[(level, option)] = value
+
+    def getsockopt(self, level, option, size):
+        # SO_PEERCRED: pid, uid, gid
+        assert (level, option, size) == (1, 17, 12)
+        return struct.pack("3i", 4242, self.peer_uid, 100)
+
+    def do_handshake(self):
+        assert self.tls_kwargs
+        if self.handshake_wants:
+            raise FakeSSLError(self.handshake_wants.pop(0))
+
+    def pending(self):
+        return 0
+
     def shutdown(self, arg):
         assert arg == FakeSocketModule.SHUT_RDWR
         self.called_shutdown = True
 
     def close(self):
-        assert not self.client or self.called_shutdown
+        assert not self.client or self.called_shutdown or self.paired
         self.closed = True
 
 class FakeSocketError(Exception):
     errno = errno.EAGAIN
 
+class FakeSSLError(Exception):
+    def __init__(self, errno):
+        Exception.__init__(self, errno)
+        self.errno = errno
+
+class FakeSSLContext:
+    def __init__(self, purpose):
+        self.purpose = purpose
+        self.certfile = None
+
+    def load_cert_chain(self, certfile):
+        self.certfile = certfile
+
+    def wrap_socket(self, sock, **kwargs):
+        assert self.certfile
+        sock.tls_context = self
+        sock.tls_kwargs = kwargs
+        return sock
+
+class FakeSSLModule:
+    SSL_ERROR_WANT_READ = 2
+    SSL_ERROR_WANT_WRITE = 3
+
+    SSLError = FakeSSLError
+
+    class Purpose:
+        CLIENT_AUTH = "client_auth"
+
+    def reset(self):
+        self.contexts = []
+
+    def create_default_context(self, purpose):
+        context = FakeSSLContext(purpose)
+        self.contexts.append(context)
+        return context
+
 class FakeSocketModule:
     AF_UNIX = 123346
+    AF_INET = 2
     SOCK_STREAM = 1244356
     SHUT_RDWR = 99
+    SOL_SOCKET = 1
+    SO_REUSEADDR = 2
 
     error = FakeSocketError
 
@@ -302,12 +433,27 @@ class FakeSocketModule:
 
     def reset(self):
         self.sockets = []
+        self.pairs = []
+        self.connect_error = None
+        # Of the process at the other end of new sockets
+        self.peer_uid = FakeOSModule.uid
+
+    def socketpair(self, family, stype):
+        pair = (FakeSocketClass(family, stype, client=True, paired=True),
+                FakeSocketClass(family, stype, client=True, paired=True))
+        for sock in pair:
+            sock.sendable = 10 ** 6
+        self.pairs.append(pair)
+        return pair
 
     def socket(self, family, stype):
         s = FakeSocketClass(family, stype)
         self.sockets.append(s)
         return s
 
+    def getaddrinfo(self, host, port, family, stype):
+        return [(self.AF_INET, stype, 0, "", (host or "0.0.0.0", port))]
+
 class FakeOSPathModule:
     def expanduser(self, path):
         if len(path) and path[0:2] == '~/':
@@ -316,25 +462,88 @@ class FakeOSPathModule:
             return path
 
 class FakeOSModule:
+    devnull = "/dev/null"
+    O_RDWR = 2
+    WNOHANG = 1
+    uid = 1000
+
     def __init__(self):
         self.path = FakeOSPathModule()
         self.reset()
 
     def reset(self):
         self.unlinked_files = []
+        self.fork_result = 4242
+        self.waitpids = []
+        self.exited = []
+        self.fd_calls = []
+        self.umasks = []
+
+    def getuid(self):
+        return self.uid
+
+    def umask(self, mask):
+        self.umasks.append(mask)
+        return 022
 
     def unlink(self, name):
         self.unlinked_files.append(name)
 
+    def fork(self):
+        if isinstance(self.fork_result, Exception):
+            raise self.fork_result
+        return self.fork_result
+
+    def waitpid(self, pid, options):
+        assert options == self.WNOHANG
+        self.waitpids.append(pid)
+        # Not exited the first time round
+        return (pid if len(self.waitpids) > 1 else 0, 0)
+
+    def _exit(self, status):
+        self.exited.append(status)
+
+    def open(self, name, flags):
+        self.fd_calls.append(("open", name))
+        return 99
+
+    def dup2(self, fd, fd2):
+        self.fd_calls.append(("dup2", fd, fd2))
+
+    def closerange(self, low, high):
+        self.fd_calls.append(("closerange", low, high))
+
+    def sysconf(self, name):
+        assert name == "SC_OPEN_MAX"
+        return 65536
+
+class FakeTimeModule:
+    strftime = staticmethod(time.strftime)
+    localtime = staticmethod(time.localtime)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.now = 1300000000.0
+
+    def time(self):
+        return self.now
+
 fakes = {}
 
 # Irssi will fail to import so we have to add it manually beforehand...
 sys.modules["irssi"] = fakes["irssi"] = FakeIrssiModule()
 import rstatus
+import rstatus_proto
+import rstatus_helper
+import relay
 
 # The other modules can be swapped out
 rstatus.socket = fakes["socket"] = FakeSocketModule()
 rstatus.os = fakes["os"] = FakeOSModule()
+rstatus.time = fakes["time"] = FakeTimeModule()
+rstatus.ssl = fakes["ssl"] = FakeSSLModule()
 
 # And now some constants
 HEARTBEAT = 60 * 10
@@ -342,12 +551,35 @@ TXRX = 60
 DROP_NOTIFY = 10
 CBUFFER_LIMIT = 8192
 
+def queued(send_queue):
+    return "".join(send_queue.frames)[send_queue.offset:]
+
+def seq_marker(rs):
+    return json.dumps({"type": "seq", "seq": rs.seq},
+                      separators=(",", ":")) + "\n"
+
+def snapshot_objs(frame):
+    # The windows in a snapshot frame, less the seq marker ending it
+    objs = map(json.loads, frame.strip().split("\n"))
+    assert objs.pop()["type"] == "seq"
+    return objs
+
+def pop_seqs(objs):
+    seqs = [obj.pop("seq") for obj in objs]
+    assert seqs == sorted(set(seqs))
+    return objs
+
 def prepare_rstatus():
     for name, module in fakes.items():
         module.reset()
 
     return rstatus.RStatus(debug=True)
 
+def change_settings(rs, **settings):
+    for key, value in settings.items():
+        fakes["irssi"].settings_set_str(key, value)
+    rs.load_settings()
+
 class TestSetup:
     def setup(self):
         self.rstatus = prepare_rstatus()
@@ -362,7 +594,17 @@ class TestSetup:
             "default_channels": "notify",
             "default_queries": "notify",
             "override_notify": "",
-            "override_ignore": ""
+            "override_ignore": "",
+            "coalesce_time": 0,
+            "message_burst": 0,
+            "message_refill": 2000,
+            "listen_tcp": "",
+            "tls_cert": "",
+            "auth_token": "",
+            "listen_backlog": 128,
+            "slow_consumer": "disconnect",
+            "fanout_helper": 0,
+            "fanout_daemon": ""
         }
 
     def test_creates_socket(self):
@@ -381,8 +623,17 @@ class TestSetup:
             "window hilight": self.rstatus.windowhilight,
             "message private": self.rstatus.privmsg,
             "message public": self.rstatus.pubmsg,
+            "channel created": self.rstatus.channelcreated,
             "channel destroyed": self.rstatus.channeldestroyed,
-            "query destroyed": self.rstatus.querydestroyed
+            "query destroyed": self.rstatus.querydestroyed,
+            "query nick changed": self.rstatus.windows_changed,
+            "window item new": self.rstatus.windows_changed,
+            "window item changed": self.rstatus.windows_changed,
+            "window item remove": self.rstatus.windows_changed,
+            "nicklist new": self.rstatus.nicklistnew,
+            "nicklist remove": self.rstatus.nicklistremove,
+            "nicklist changed": self.rstatus.nicklistchanged,
+            "server nick changed": self.rstatus.servernickchanged
         }
         assert fakes["irssi"].commands == {
             "rstatus": self.rstatus.status
@@ -399,7 +650,17 @@ class TestConfig:
             "default_channels": True,
             "default_queries": True,
             "override_notify": set(),
-            "override_ignore": set()
+            "override_ignore": set(),
+            "coalesce_time": 0,
+            "message_burst": 0,
+            "message_refill": 2000,
+            "listen_tcp": "",
+            "tls_cert": "",
+            "auth_token": "",
+            "listen_backlog": 128,
+            "slow_consumer": "disconnect",
+            "fanout_helper": 0,
+            "fanout_daemon": ""
         }
 
     def test_other(self):
@@ -419,7 +680,17 @@ class TestConfig:
             "default_channels": False,
             "default_queries": True,
             "override_notify": set(["#supercoolchannel", "mum"]),
-            "override_ignore": set(["sibling", "#spam"])
+            "override_ignore": set(["sibling", "#spam"]),
+            "coalesce_time": 0,
+            "message_burst": 0,
+            "message_refill": 2000,
+            "listen_tcp": "",
+            "tls_cert": "",
+            "auth_token": "",
+            "listen_backlog": 128,
+            "slow_consumer": "disconnect",
+            "fanout_helper": 0,
+            "fanout_daemon": ""
         }
 
 class TestSignals:
@@ -501,6 +772,99 @@ class TestSignals:
         self.rstatus.pubmsg(server, "mynick!name", "good", None, "#fff")
         assert map(lambda x: x["nick"], self.infos) == ["good"]
 
+    def test_fuzzymatch_compile(self):
+        # The translation table implementation that the regex replaced
+        table = list("." * 256)
+        for c in string.digits + string.ascii_letters:
+            table[ord(c)] = c.lower()
+        table = "".join(table)
+
+        def reference(msg, nick):
+            tmsg = "." + msg.translate(table) + "."
+            tnick = "." + nick.translate(table) + "."
+            p = tmsg.find(tnick)
+            if p == -1:
+                return None
+            return msg[p:p + len(nick)]
+
+        nicks = ["mynick", "MyNick", "my_nick", "_nick", "nick_", "n1ck[]",
+                 "a", "x-y", "mynick,name"]
+        msgs = ["mynick: hi", "hi MYNICK", "mynicks", "amynick", "my_nick",
+                "my-nick!", "my nick", "__nick__", "nick__", "[n1ck{}",
+                "a", "b a c", "ab", "x y", "xy", "", "mynick!name?",
+                "\xffmynick\xff", "mynick\nmynick"]
+
+        for nick in nicks:
+            matcher = rstatus.fuzzymatch_compile(nick)
+            for msg in msgs:
+                match = matcher.search(msg)
+                if match:
+                    match = match.group(0)
+                assert match == reference(msg, nick), (nick, msg)
+
+    def test_nicklist(self):
+        server = FakeIrssiServer("my_nick")
+        channel = FakeIrssiIrcChannel("#Chan", [], server)
+        server.channels["#chan"] = channel
+
+        self.rstatus.channelcreated(channel, 0)
+        for nick in ["my_nick", "My-Nick", "other"]:
+            self.rstatus.nicklistnew(channel, FakeIrssiNick(nick))
+
+        self.rstatus.pubmsg(server, "My-Nick: hi", "other", None, "#chan")
+        assert self.infos == []
+        self.rstatus.pubmsg(server, "my_nick: hi", "other", None, "#chan")
+        assert len(self.infos) == 1
+
+        self.rstatus.nicklistchanged(channel, FakeIrssiNick("away"), "My-Nick")
+        self.rstatus.pubmsg(server, "My-Nick: hi", "other", None, "#chan")
+        assert len(self.infos) == 2
+
+        self.rstatus.nicklistnew(channel, FakeIrssiNick("My-Nick"))
+        self.rstatus.pubmsg(server, "My-Nick: hi", "other", None, "#chan")
+        self.rstatus.nicklistremove(channel, FakeIrssiNick("My-Nick"))
+        self.rstatus.pubmsg(server, "My-Nick: hi", "other", None, "#chan")
+        assert len(self.infos) == 3
+
+        server.nick = "newnick"
+        self.rstatus.servernickchanged(server)
+        self.rstatus.pubmsg(server, "my_nick: hi", "other", None, "#chan")
+        self.rstatus.pubmsg(server, "newnick: hi", "other", None, "#chan")
+        assert map(lambda x: x["message"], self.infos[3:]) == ["newnick: hi"]
+
+        self.rstatus.channeldestroyed(channel)
+        assert self.rstatus.channel_nicks == {}
+
+    def test_nicks_lookups(self):
+        server = FakeIrssiServer("mynick")
+        nicks = ["user{0}".format(i) for i in xrange(2000)] + ["MyNick"]
+        channel = FakeIrssiIrcChannel("#big", nicks, server)
+        server.channels["#big"] = channel
+
+        for i in xrange(100):
+            self.rstatus.pubmsg(server, "chatter", "user1", None, "#big")
+        assert channel.nicks_calls == 0
+        assert self.infos == []
+
+        self.rstatus.pubmsg(server, "MyNick: hi", "user1", None, "#big")
+        assert channel.nicks_calls == 1
+        assert self.infos == []
+
+        for i in xrange(10):
+            self.rstatus.pubmsg(server, "mynick: hi", "user1", None, "#big")
+            self.rstatus.pubmsg(server, "MyNick: hi", "user1", None, "#big")
+        assert channel.nicks_calls == 1
+        assert len(self.infos) == 10
+
+        self.rstatus.nicklistremove(channel, FakeIrssiNick("MyNick"))
+        self.rstatus.pubmsg(server, "MyNick: hi", "user1", None, "#big")
+        assert channel.nicks_calls == 1
+        assert len(self.infos) == 11
+
+        self.rstatus.channeldestroyed(channel)
+        self.rstatus.pubmsg(server, "MyNick: hi", "user1", None, "#big")
+        assert channel.nicks_calls == 2
+
     def test_channeldestroyed(self):
         channel = FakeIrssiIrcChannel("#sYm")
         self.rstatus.channeldestroyed(channel)
@@ -519,16 +883,29 @@ class TestSignals:
         self.rstatus.last_set("blah", {"whatever": True})
         self.rstatus.status(None, None, None)
 
+class FakeClient:
+    def __init__(self, name, grab_frame):
+        self.name = name
+        self.grab_frame = grab_frame
+        self.send_messages = False
+        self.encoding = "json"
+        self.subscription = None
+
+    def send_frame(self, frame, key=None):
+        self.grab_frame(self.name, frame)
+
 class TestFiltering:
     def setup(self):
         self.rstatus = prepare_rstatus()
-        self.rstatus.client_send = self.grab_info
 
-        self.rstatus.clients["msgs"] = {"send_messages": True}
-        self.rstatus.clients["nomsgs"] = {"send_messages": False}
+        for (name, send_messages) in (("msgs", True), ("nomsgs", False)):
+            client = FakeClient(name, self.grab_frame)
+            client.send_messages = send_messages
+            self.rstatus.client_subscribe(client)
 
-    def grab_info(self, client, info):
-        self.infos.append((client, info))
+    def grab_frame(self, client, frame):
+        assert frame[-1] == "\n"
+        self.infos.append((client, json.loads(frame[:-1])))
 
     def example_messages(self):
         server = FakeIrssiServer("mynickname")
@@ -547,13 +924,13 @@ class TestFiltering:
         assert map(lambda x: x[0], self.infos) == ["msgs"] * 4
 
         self.infos = []
-        self.rstatus.settings["default_queries"] = False
+        change_settings(self.rstatus, default_queries="ignore")
         self.example_messages()
         assert map(lambda x: x[1]["wtype"], self.infos) == ["channel"] * 2
 
         self.infos = []
-        self.rstatus.settings["default_queries"] = True
-        self.rstatus.settings["default_channels"] = False
+        change_settings(self.rstatus, default_queries="notify",
+                        default_channels="ignore")
         self.example_messages()
         assert map(lambda x: x[1]["wtype"], self.infos) == ["query"] * 2
 
@@ -565,19 +942,60 @@ class TestFiltering:
 
     def test_override_ignore(self):
         self.infos = []
-        self.rstatus.settings["default_queries"] = False
-        self.rstatus.settings["override_ignore"] = ["#spam"]
+        change_settings(self.rstatus, default_queries="ignore",
+                        override_ignore="#spam")
         self.example_messages()
         assert map(lambda x: x[1]["channel"], self.infos) == ["#ch4nnel"]
 
         self.infos = []
-        self.rstatus.settings["default_queries"] = True
-        self.rstatus.settings["default_channels"] = False
-        self.rstatus.settings["override_ignore"] = ["blah"]
-        self.rstatus.settings["override_notify"] = ["#spam"]
+        change_settings(self.rstatus, default_queries="notify",
+                        default_channels="ignore", override_ignore="blah",
+                        override_notify="#spam")
         self.example_messages()
         assert map(self.get_name, self.infos) == ["Sibling", "#spaM"]
 
+    def test_patterns(self):
+        change_settings(self.rstatus, default_channels="ignore",
+                        override_notify="#ch?nnel #Proj-* re:^#b(ar|az)$ "
+                                        "OtherNet/#local #a/b")
+        allows = lambda server, name: self.rstatus.filter_event(
+                {"server": server, "wtype": "channel", "channel": name})
+
+        assert allows("TheServer", "#CHANNEL")
+        assert not allows("TheServer", "#chaannel")
+        assert allows("TheServer", "#proj-x")
+        assert not allows("TheServer", "#proj")
+        assert allows("TheServer", "#baz") and not allows("TheServer", "#bazz")
+        assert not allows("TheServer", "#local")
+        assert allows("othernet", "#local")
+        assert allows("TheServer", "#a/b")
+
+    def test_bad_pattern(self):
+        change_settings(self.rstatus, override_ignore="re:( #spam")
+        info = {"server": "s", "wtype": "channel", "channel": "#spam"}
+        assert not self.rstatus.filter_event(info)
+
+    def test_decision_cache(self):
+        policy = self.rstatus.filter
+        calls = []
+        real_decide = policy.decide
+        policy.decide = lambda *args: calls.append(args) or real_decide(*args)
+        policy.cache_limit = 2
+
+        a = {"server": "s", "wtype": "channel", "channel": "#a"}
+        b = {"server": "s", "wtype": "query", "nick": "b"}
+        c = {"server": "s", "wtype": "channel", "channel": "#c"}
+
+        for info in [a, b, a, c, a, b]:
+            assert policy.allows(info)
+
+        assert calls == [("s", "channel", "#a"), ("s", "query", "b"),
+                         ("s", "channel", "#c"), ("s", "query", "b")]
+
+        self.rstatus.load_settings()
+        assert self.rstatus.filter is not policy
+        assert len(self.rstatus.filter.cache) == 0
+
     def test_client_msgs(self):
         self.infos = []
         self.example_hilights()
@@ -587,6 +1005,319 @@ class TestFiltering:
         nmis = filter(lambda x: x[0] == "nomsgs", self.infos)
         assert map(lambda x: x[1]["type"], nmis) == ["window_level"] * 2
 
+class TestCodec:
+    def test_codec_find(self):
+        assert rstatus_proto.codec_find(["no_such_codec", "json"]) is json
+        try:
+            rstatus_proto.codec_find(["no_such_codec"])
+        except ImportError:
+            pass
+        else:
+            raise AssertionError
+
+    def test_lines(self):
+        obj = {"type": "message", "message": u"multi\nline \u00fe"}
+        for name in rstatus_proto.codec_preference:
+            try:
+                codec = rstatus_proto.codec_find([name])
+            except ImportError:
+                continue
+
+            line = rstatus_proto.encode_line(obj, codec)
+            assert line.count("\n") == 1 and line[-1] == "\n"
+            assert json.loads(line) == obj
+            assert rstatus_proto.decode_line(line[:-1], codec) == obj
+
+    def test_compact(self):
+        objs = [
+            {"type": "window_level", "wtype": "channel", "level": 3,
+             "server": "TheServer", "channel": "#blah"},
+            {"type": "message", "wtype": "query", "nick": "Sibling",
+             "server": "TheServer", "message": u"He\u00fello\n\x01"},
+            {"type": "reset"},
+            {"unknown key": [1, 70000, -2, None, True, False, "x" * 300]}
+        ]
+
+        for obj in objs:
+            frame = rstatus_proto.encode_compact(obj)
+            assert frame[0] == rstatus_proto.COMPACT_MARKER
+            assert rstatus_proto.decode_compact(frame[3:]) == obj
+
+        assert len(rstatus_proto.encode_compact(objs[0])) < \
+               len(rstatus_proto.encode_line(objs[0])) / 2
+
+    def test_text_decoder(self):
+        samples = ["", "plain", "\xc3\xa9t\xc3\xa9", "\xe9t\xe9",
+                   "\xef\xbf\xbd", "\xef\xbf\xbd\xe9", "\xed\xa0\x80",
+                   "\xc0\xaf", "\xe0\x80\xaf", "\xf4\x90\x80\x80",
+                   "\xf0\x9f\x98\x80 ok", "\xc3", "x" * 1000 + "\xff",
+                   "\xc3\xa9" * 500 + "\xe9"]
+        samples += ["".join(chr((i * 37 + j * 101) % 256) for j in xrange(i))
+                    for i in xrange(64)]
+
+        decoder = rstatus_proto.TextDecoder()
+        for key in [None, ("s", "a"), ("s", "b")]:
+            for sample in samples + samples[::-1]:
+                expect = rstatus_proto.decode_by_exceptions(sample)
+                assert decoder.decode(sample, key) == expect
+
+        decoder.decode("\xe9", ("s", "latin"))
+        decoder.decode("\xc3\xa9", ("s", "utf8"))
+        assert decoder.memo[("s", "latin")] == "latin-1"
+        assert decoder.memo[("s", "utf8")] == "utf8"
+
+        decoder.memo_limit = len(decoder.memo)
+        decoder.decode("\xe9", ("s", "another"))
+        assert decoder.memo == {("s", "another"): "latin-1"}
+
+    def test_stream_decoder(self):
+        objs = [
+            {"type": "window_level", "wtype": "query", "level": 1,
+             "server": "TheServer", "nick": "asdf"},
+            {"type": "reset"},
+            {"type": "message", "wtype": "channel", "nick": "dude",
+             "server": "TheServer", "channel": "#bleh",
+             "message": u"\n{\x01}"}
+        ]
+        stream = rstatus_proto.encode_line(objs[0]) + "\n" + \
+                 rstatus_proto.encode_compact(objs[1]) + \
+                 rstatus_proto.encode_compact(objs[2]) + "\n" + \
+                 rstatus_proto.encode_line(objs[1])
+        expect = [objs[0], None, objs[1], objs[2], None, objs[1]]
+
+        for chunk in [1, 2, 3, 7, len(stream)]:
+            decoder = rstatus_proto.StreamDecoder()
+            decoded = []
+            for i in xrange(0, len(stream), chunk):
+                decoded += decoder.feed(stream[i:i + chunk])
+            assert decoded == expect
+            assert decoder.buffer == ""
+
+class TestBroadcast:
+    def setup(self):
+        self.rstatus = prepare_rstatus()
+        self.socket = fakes["socket"].sockets[0]
+
+        self.encodes = 0
+        real_encode = self.rstatus.encode
+        def counting_encode(*args):
+            self.encodes += 1
+            return real_encode(*args)
+        self.rstatus.encode = counting_encode
+
+    def client_recv(self, client, data):
+        self.rstatus.client_recv(self.rstatus.clients[client], data)
+
+    def add_clients(self, count):
+        clients = []
+        for i in xrange(count):
+            client = FakeSocketClass(client=True)
+            client.sendable = 10 ** 6
+            self.socket.acceptable.append((client, ''))
+            self.rstatus.socket_activity(self.socket._fd, None, self.socket)
+            client.sent = []
+            clients.append(client)
+        return clients
+
+    def test_encode_once(self):
+        info = {"nick": "Sibling", "server": "TheServer", "level": 3,
+                "wtype": "query", "type": "window_level"}
+        clients = []
+        encodes = {}
+
+        for count in [1, 10, 100, 500]:
+            clients += self.add_clients(count - len(clients))
+            self.encodes = 0
+            self.rstatus.update(info)
+            encodes[count] = self.encodes
+
+            frames = [client.sent[0][1] for client in clients]
+            assert pop_seqs([json.loads(frames[0])]) == [info]
+            assert all(frame is frames[0] for frame in frames)
+            for client in clients:
+                client.sent = []
+
+        assert encodes == {1: 1, 10: 1, 100: 1, 500: 1}
+
+    def test_encode_per_encoding(self):
+        clients = self.add_clients(10)
+        for client in clients[:4]:
+            self.client_recv(client, {"type": "settings",
+                                      "send_messages": True,
+                                      "encoding": "compact"})
+        self.client_recv(clients[4], {"type": "settings",
+                                      "send_messages": True,
+                                      "encoding": "whatever"})
+
+        info = {"nick": "Sibling", "server": "TheServer", "level": 3,
+                "wtype": "query", "type": "window_level"}
+        self.encodes = 0
+        self.rstatus.update(info)
+        assert self.encodes == 2
+
+        for i, client in enumerate(clients):
+            decoder = rstatus_proto.StreamDecoder()
+            assert pop_seqs(decoder.feed(client.sent[0][1])) == [info]
+            if i < 4:
+                assert client.sent[0][1][0] == rstatus_proto.COMPACT_MARKER
+            else:
+                assert pop_seqs([json.loads(client.sent[0][1])]) == [info]
+
+    def test_coalesce(self):
+        fakes["irssi"].settings_set_int("coalesce_time", 50)
+        self.rstatus.load_settings()
+        (client, ) = self.add_clients(1)
+        self.client_recv(client, {"type": "settings",
+                                  "send_messages": True})
+
+        for i in xrange(100):
+            self.rstatus.windowhilight(FakeIrssiWindow("#busy", i % 4))
+            self.rstatus.windowhilight(FakeIrssiWindow("quiet", 1))
+        self.rstatus.windowhilight(FakeIrssiWindow("#busy", 2))
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "quiet", None)
+
+        assert [json.loads(s[1])["type"] for s in client.sent] == ["message"]
+        assert self.rstatus.coalesce_timeout in fakes["irssi"].timeouts
+        client.sent = []
+
+        fakes["irssi"].time_advance(0.05)
+        assert pop_seqs([json.loads(s[1]) for s in client.sent]) == [
+            {"channel": "#busy", "server": "TheServer", "level": 2,
+             "wtype": "channel", "type": "window_level"},
+            {"nick": "quiet", "server": "TheServer", "level": 1,
+             "wtype": "query", "type": "window_level"}
+        ]
+        assert self.rstatus.coalesce_timeout is None
+
+        client.sent = []
+        self.rstatus.querydestroyed(FakeIrssiQuery("quiet"))
+        fakes["irssi"].time_advance(0.05)
+        assert [json.loads(s[1])["level"] for s in client.sent] == [0]
+
+    def test_encode_skipped(self):
+        for client in self.add_clients(20):
+            self.client_recv(client, {"type": "settings",
+                                      "send_messages": False})
+
+        self.encodes = 0
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "Sibling", None)
+        assert self.encodes == 0
+
+    def test_subscriptions(self):
+        (everything, phone, other) = self.add_clients(3)
+        subscribe = lambda client, spec: self.client_recv(client,
+            {"type": "settings", "send_messages": True, "subscribe": spec})
+        subscribe(everything, None)
+        subscribe(phone, {"wtypes": ["query"], "min_level": 3,
+                          "servers": ["theserver"]})
+        subscribe(other, {"servers": ["OtherNet"], "channels": ["#a*"]})
+
+        assert self.rstatus.subscribers[("message", "theserver", "query")] \
+                == set([self.rstatus.clients[phone]])
+        assert ("window_level", "theserver", "channel") \
+                not in self.rstatus.subscribers
+
+        server = FakeIrssiServer("me")
+        self.rstatus.windowhilight(FakeIrssiWindow("#chan", 3))
+        self.rstatus.windowhilight(FakeIrssiWindow("Sibling", 1))
+        self.rstatus.windowhilight(FakeIrssiWindow("Sibling", 3))
+        self.rstatus.privmsg(server, "Hello", "Sibling", None)
+        self.rstatus.windowhilight(FakeIrssiWindow("Sibling", 0))
+        self.rstatus.windowhilight(FakeIrssiWindow("#chan", 0))
+
+        received = lambda client: [(o["type"], o.get("level"))
+                                   for o in [json.loads(s[1])
+                                             for s in client.sent]]
+
+        assert received(everything) == \
+            [("window_level", 3), ("window_level", 1), ("window_level", 3),
+             ("message", None), ("window_level", 0), ("window_level", 0)]
+        assert received(phone) == \
+            [("window_level", 3), ("message", None), ("window_level", 0)]
+        assert received(other) == []
+
+        server = FakeIrssiServer("me", tag="OtherNet")
+        self.rstatus.pubmsg(server, "me: hi", "x", None, "#abc")
+        self.rstatus.pubmsg(server, "me: hi", "x", None, "#bcd")
+        assert [json.loads(s[1])["channel"] for s in other.sent] == ["#abc"]
+
+        for client in (everything, phone, other):
+            client.sent = []
+            self.client_recv(client, {"type": "reset_request"})
+
+        # reset, the windows and the seq marker
+        assert everything.sent[0][1].count("\n") == 4
+        assert phone.sent[0][1].count("\n") == 3
+        assert other.sent[0][1].count("\n") == 2
+
+        for client in (everything, phone, other):
+            self.rstatus.clients[client].drop("Test")
+        assert self.rstatus.subscribers == {}
+
+    def test_rate_limit(self):
+        fakes["irssi"].settings_set_int("message_burst", 3)
+        fakes["irssi"].settings_set_int("message_refill", 1000)
+        self.rstatus.load_settings()
+        (client, ) = self.add_clients(1)
+        self.client_recv(client, {"type": "settings",
+                                  "send_messages": True})
+
+        server = FakeIrssiServer("me")
+        def received():
+            objs = pop_seqs([json.loads(s[1]) for s in client.sent])
+            client.sent = []
+            return [(o["nick"], o["message"], o.get("count"), o.get("lines"))
+                    for o in objs]
+
+        for i in xrange(10):
+            self.rstatus.privmsg(server, "flood {0}".format(i), "flood", None)
+        self.rstatus.privmsg(server, "hi", "other", None)
+        self.rstatus.pubmsg(server, "me: flood", "flood", None, "#chan")
+
+        assert received() == \
+            [("flood", "flood {0}".format(i), None, None) for i in xrange(3)] \
+            + [("other", "hi", None, None), ("flood", "me: flood", None, None)]
+
+        fakes["irssi"].time_advance(0.999)
+        assert received() == []
+        fakes["irssi"].time_advance(0.001)
+        lines = ["flood {0}".format(i) for i in xrange(5, 10)]
+        assert received() == [("flood", "flood 9", 7, lines)]
+        assert self.rstatus.floods == {}
+
+        # The flush spent the token that had refilled
+        self.rstatus.privmsg(server, "more", "flood", None)
+        assert received() == []
+        fakes["irssi"].time_advance(1)
+        assert received() == [("flood", "more", 1, ["more"])]
+
+        fakes["irssi"].time_advance(3)
+        for i in xrange(3):
+            self.rstatus.privmsg(server, "again", "flood", None)
+        assert len(received()) == 3
+
+    def test_rate_limit_buckets_pruned(self):
+        fakes["irssi"].settings_set_int("message_burst", 5)
+        self.rstatus.load_settings()
+        self.rstatus.buckets_limit = 10
+        server = FakeIrssiServer("me")
+        for i in xrange(10):
+            self.rstatus.privmsg(server, "hi", "nick{0}".format(i), None)
+        assert len(self.rstatus.buckets) == 10
+
+        fakes["irssi"].time_advance(2)
+        self.rstatus.privmsg(server, "hi", "another", None)
+        assert self.rstatus.buckets.keys() == \
+            [("TheServer", "query", "another", "another")]
+
+    def test_subscription_invalid(self):
+        (client, ) = self.add_clients(1)
+        client.recvable.append(json.dumps({"type": "settings",
+            "send_messages": True, "subscribe": {"wtypes": ["dcc"]}}) + "\n")
+        self.rstatus.clients[client].try_recv(client._fd, None)
+        assert client not in self.rstatus.clients
+        assert self.rstatus.subscribers == {}
+
 class TestIO:
     def setup(self):
         self.rstatus = prepare_rstatus()
@@ -597,52 +1328,124 @@ class TestIO:
         client = FakeSocketClass(client=True)
         if sendable:
             client.sendable = sendable
+        else:
+            # Let the seq marker through, so the client starts out idle
+            client.sendable = 10 ** 6
         self.socket.acceptable.append((client, ''))
         assert self.rstatus.socket_activity(self.socket._fd, None, self.socket)
         clientinfo = self.rstatus.clients[client]
+        if not sendable:
+            assert [s[1] for s in client.sent] == [seq_marker(self.rstatus)]
+            client.sendable = 0
+            client.sent = []
         return (client, clientinfo)
 
     def client_nop(self, *args, **kwargs):
         self.nops += 1
 
     def test_accept(self):
-        self.rstatus.new_client = self.client_nop
-        (client, clientinfo) = self.create_client()
+        (client, clientinfo) = self.create_client(sendable=10 ** 6)
         assert not self.socket.closed and self.rstatus.socket
         assert self.socket.acceptable == []
         assert client.called_setblocking
 
-        assert set(clientinfo["watches"].keys()) == \
+        # Even with no windows, the client is told the current seq
+        marker = seq_marker(self.rstatus)
+        assert client.sent == [(len(marker), marker, marker)]
+
+        assert set(clientinfo.watches.keys()) == \
             set(["recv", "err", "hup"])
         assert len(fakes["irssi"].iowatches) == 4
 
-        for watch_what, watch_id in clientinfo["watches"].items():
+        for watch_what, watch_id in clientinfo.watches.items():
             if watch_what == "recv":
-                func = self.rstatus.client_try_recv
+                func = clientinfo.try_recv
                 iotype = FakeIrssiModule.IO_IN
             else:
-                func = self.rstatus.client_drop_ioerror
+                func = clientinfo.drop_ioerror
                 iotype = getattr(FakeIrssiModule, "IO_" + watch_what.upper())
 
             watch = fakes["irssi"].iowatches[watch_id]
-            assert watch == (client, func, client, iotype)
-
-        assert len(clientinfo["timeouts"])
-        assert len(fakes["irssi"].timeouts) == 1
-        (a, b, c) = fakes["irssi"].timeouts[clientinfo["timeouts"]["recv"]]
-        assert (a, b, c[0]) == \
-            (HEARTBEAT * 1000, self.rstatus.client_drop_timeout, client)
-
-        del clientinfo["watches"]
-        del clientinfo["timeouts"]
-        assert self.rstatus.clients[client] == \
-            {"send_queue": "", "recv_buffer": "", "send_messages": False}
+            assert watch == (client, func, None, iotype)
+
+        assert clientinfo.timeouts == set(["recv", "send"])
+        assert fakes["irssi"].timeouts.values() == \
+            [[1000, self.rstatus.wheel.advance, None]]
+        self.check_timeout("recv", HEARTBEAT, clientinfo)
+        self.check_timeout("send", HEARTBEAT, clientinfo,
+                           func=clientinfo.heartbeat_send)
+
+        assert clientinfo.subscription.types == ("window_level", )
+        assert not clientinfo.subscription.restricted
+
+        assert queued(clientinfo.send_queue) == ""
+        assert len(clientinfo.recv_buffer) == 0
+        assert clientinfo.conn is client and clientinfo.rstatus is self.rstatus
+        assert (clientinfo.send_messages, clientinfo.encoding,
+                clientinfo.authed, clientinfo.tls, clientinfo.dropped) == \
+            (False, "json", True, False, False)
+        assert not hasattr(clientinfo, "__dict__")
 
     def test_accept_err(self):
+        self.socket.acceptable.append(Exception("Accept failed"))
         self.rstatus.socket_activity(self.socket._fd, None, self.socket)
         assert self.socket.closed
         assert self.rstatus.socket == None
 
+    def test_accept_err_transient(self, capsys):
+        client = FakeSocketClass(client=True)
+        for code in [errno.EMFILE, errno.EMFILE, errno.ECONNABORTED]:
+            e = FakeSocketError()
+            e.errno = code
+            self.socket.acceptable.append(e)
+        self.socket.acceptable.append((client, ''))
+
+        iowatches = fakes["irssi"].iowatches
+
+        def watches():
+            return [i for (i, w) in iowatches.items() if w[0] is self.socket]
+
+        # Out of descriptors: the listener is kept, but not watched (which,
+        # level triggered, would fire again at once) until a second later
+        for i in xrange(2):
+            [watch] = watches()
+            assert not self.rstatus.socket_activity(self.socket._fd, None,
+                                                    self.socket)
+            del iowatches[watch]
+            assert not self.socket.closed and self.rstatus.socket
+            assert self.rstatus.clients == {} and watches() == []
+            fakes["irssi"].time_advance(1)
+        assert capsys.readouterr()[0].count("Could not accept") == 1
+
+        # A connection that went away before it was accepted is skipped
+        assert self.rstatus.socket_activity(self.socket._fd, None, self.socket)
+        assert client in self.rstatus.clients
+        assert len(watches()) == 1
+        assert self.rstatus.listeners[self.socket]["accept_error"] is None
+
+    def test_accept_many(self):
+        fakes["irssi"]._windows.append(FakeIrssiWindow("#blah", 3))
+        self.rstatus.window_levels_reload()
+        assert self.socket.backlog == 128
+
+        clients = []
+        for i in xrange(500):
+            client = FakeSocketClass(client=True)
+            client.sendable = 10 ** 6
+            self.socket.acceptable.append((client, ''))
+            clients.append(client)
+
+        assert self.rstatus.socket_activity(self.socket._fd, None, self.socket)
+        assert self.socket.acceptable == [] and not self.socket.closed
+        assert len(self.rstatus.clients) == 500
+        assert len(fakes["irssi"].iowatches) == 1 + 500 * 3
+        for client in clients:
+            assert snapshot_objs(client.sent[0][1])[0]["channel"] == "#blah"
+
+        # A wakeup with nothing to accept is harmless
+        assert self.rstatus.socket_activity(self.socket._fd, None, self.socket)
+        assert self.rstatus.socket is self.socket
+
     def test_accept_other(self):
         assert not self.rstatus.socket_activity(FakeSocketClass()._fd, None,
                                                 self.socket)
@@ -652,35 +1455,68 @@ class TestIO:
         assert not self.socket.closed
 
     def test_client_timeout_set(self):
-        self.rstatus.clients["c"] = { "timeouts": {} }
-        self.rstatus.client_timeout_set("c", "test", 100, "function", 123)
-        tid = self.rstatus.clients["c"]["timeouts"]["test"]
-        assert fakes["irssi"].timeouts[tid] == \
-            [100000, "function", 123]
-        self.rstatus.client_timeout_set("c", "test", 10, "function", 4)
-        assert tid not in fakes["irssi"].timeouts
-        tid2 = self.rstatus.clients["c"]["timeouts"]["test"]
-        assert fakes["irssi"].timeouts[tid2] == \
-            [10000, "function", 4]
+        c = rstatus.Client(self.rstatus, FakeSocketClass(client=True))
+        c.timeout_set("test", 100, "function", 123)
+        wheel = self.rstatus.wheel
+        assert c.timeouts == set(["test"])
+        assert wheel.remaining((c, "test")) == 100
+        assert wheel.entries[(c, "test")][2:4] == ["function", (123, )]
+        c.timeout_set("test", 10, "function", 4)
+        assert wheel.remaining((c, "test")) == 10
+        assert wheel.entries[(c, "test")][2:4] == ["function", (4, )]
+        assert len(fakes["irssi"].timeouts) == 1
+
+    def test_timer_wheel(self):
+        wheel = rstatus.TimerWheel(slots=8)
+        fired = []
+        def fire(name):
+            fired.append((name, wheel.now))
+            if name == "again":
+                wheel.set("again2", 3, fire, "again2")
+                wheel.remove("removed")
+
+        wheel.set("a", 5, fire, "a")
+        wheel.set("late", 3, fire, "late")
+        wheel.set("late", 20, fire, "late")    # pushed back: same entry
+        wheel.set("early", 30, fire, "early")
+        wheel.set("early", 2, fire, "early")   # brought forward: re-slotted
+        wheel.set("removed", 6, fire, "removed")
+        wheel.set("again", 4, fire, "again")
+        assert len(fakes["irssi"].timeouts) == 1
+        assert sum(len(slot) for slot in wheel.slots) == 6
+
+        fakes["irssi"].time_advance(30)
+        assert fired == [("early", 2), ("again", 4), ("a", 5),
+                         ("again2", 7), ("late", 20)]
+        assert len(wheel) == 0
+        assert fakes["irssi"].timeouts == {}
+        assert wheel.slots == [[]] * 8
+
+        wheel.set("x", 1, fire, "x")
+        wheel.remove("x")
+        assert fakes["irssi"].timeouts == {}
 
     def test_client_drop(self):
         fakes["irssi"]._windows.append(FakeIrssiWindow("asdf", 0))
+        self.rstatus.window_levels_reload()
         (client, clientinfo) = self.create_client(sendable=1)
 
-        self.rstatus.client_timeout_set(client, "test", 10, "function", 4)
-        self.rstatus.client_timeout_set(client, "tes2", 10, "function", 4)
-        self.rstatus.client_timeout_set(client, "tes3", 10, "function", 4)
-        assert len(fakes["irssi"].timeouts) == 5
+        clientinfo.timeout_set("test", 10, "function", 4)
+        clientinfo.timeout_set("tes2", 10, "function", 4)
+        clientinfo.timeout_set("tes3", 10, "function", 4)
+        assert len(self.rstatus.wheel) == 5
+        assert len(fakes["irssi"].timeouts) == 1
         assert len(fakes["irssi"].iowatches) == 5
-        assert self.rstatus.clients[client]["send_queue"] != ""
+        assert queued(clientinfo.send_queue) != ""
 
-        self.rstatus.client_drop(client, "TEST", notify=True)
+        clientinfo.drop("TEST", notify=True)
+        assert len(self.rstatus.wheel) == 0
         assert len(fakes["irssi"].timeouts) == 0
         assert len(fakes["irssi"].iowatches) == 1
         assert self.rstatus.clients == {}
 
         (client, clientinfo) = self.create_client(sendable=90000)
-        self.rstatus.client_drop(client, "TEST", notify=True)
+        clientinfo.drop("TEST", notify=True)
 
         assert not client.closed
         fakes["irssi"].time_advance(DROP_NOTIFY)
@@ -689,48 +1525,50 @@ class TestIO:
     def test_client_drop_notify(self):
         (client, clientinfo) = self.create_client()
 
-        self.rstatus.client_drop(client, "TEST", notify=True)
+        clientinfo.drop("TEST", notify=True)
         assert len(fakes["irssi"].iowatches) == 1
         assert self.rstatus.clients == {}
         assert fakes["irssi"].timeouts.values()[0] == \
             [DROP_NOTIFY * 1000, self.rstatus.client_conn_close, client]
 
-    def check_timeout(self, name, time, client, clientinfo, func=None):
-        tid = clientinfo["timeouts"][name]
-        (a, b, c) = fakes["irssi"].timeouts[tid]
+    def check_timeout(self, name, time, clientinfo, func=None):
+        assert name in clientinfo.timeouts
+        wheel = self.rstatus.wheel
+        (due, slotted, b, c, key) = wheel.entries[(clientinfo, name)]
         if func == None:
-            func = self.rstatus.client_drop_timeout
-            assert (a, b, c[0]) == (time * 1000, func, client)
+            func = clientinfo.drop
+        assert (wheel.remaining(key), b) == (time, func)
 
     def test_client_try_recv(self):
-        client = FakeSocketClass(client=True)
-        rargs = (client._fd, None, client)
-        assert self.rstatus.client_try_recv(*rargs) == False
+        (client, clientinfo) = self.create_client()
+        assert clientinfo.try_recv(FakeSocketClass()._fd, None) == False
+        clientinfo.drop("TEST")
+        assert clientinfo.try_recv(client._fd, None) == False
 
         for i in [None, (client.recvable.append, None)]:
             (client, clientinfo) = self.create_client()
-            rargs = (client._fd, None, client)
+            rargs = (client._fd, None)
             if i: i[0](i[1])
             assert client in self.rstatus.clients
-            assert self.rstatus.client_try_recv(*rargs) == False
+            assert clientinfo.try_recv(*rargs) == False
             assert client.closed
             assert client not in self.rstatus.clients
 
         data = []
         self.rstatus.client_recv = lambda x,y: data.append(y)
         (client, clientinfo) = self.create_client()
-        rargs = (client._fd, None, client)
+        rargs = (client._fd, None)
 
         o1 = {"asdf": "Hello World", "abc": 123}
         o2 = {"whatever": "you say", "boo": True}
         o3 = {"a long string": "of random garbagewarbagewarble"}
 
         client.recvable.append(json.dumps(o1) + "\n")
-        assert self.rstatus.client_try_recv(*rargs) == True
+        assert clientinfo.try_recv(*rargs) == True
         assert data == [o1]
-        assert clientinfo["recv_buffer"] == ""
+        assert len(clientinfo.recv_buffer) == 0
 
-        self.check_timeout("recv", HEARTBEAT, client, clientinfo)
+        self.check_timeout("recv", HEARTBEAT, clientinfo)
 
         s2 = json.dumps(o2) + "\n"
         s3 = json.dumps(o3) + "\n"
@@ -739,75 +1577,189 @@ class TestIO:
         client.recvable.append(s[:p])
         client.recvable.append(s[p:])
 
-        assert self.rstatus.client_try_recv(*rargs) == True
-        assert clientinfo["recv_buffer"] != ""
+        assert clientinfo.try_recv(*rargs) == True
+        assert len(clientinfo.recv_buffer) != 0
         assert data == [o1, o2]
 
-        self.check_timeout("recv", TXRX, client, clientinfo)
+        self.check_timeout("recv", TXRX, clientinfo)
 
-        assert self.rstatus.client_try_recv(*rargs) == True
-        assert clientinfo["recv_buffer"] == ""
+        assert clientinfo.try_recv(*rargs) == True
+        assert len(clientinfo.recv_buffer) == 0
         assert data == [o1, o2, o3]
 
-        self.check_timeout("recv", HEARTBEAT, client, clientinfo)
+        self.check_timeout("recv", HEARTBEAT, clientinfo)
 
         client.recvable.append(s)
-        assert self.rstatus.client_try_recv(*rargs) == True
+        assert clientinfo.try_recv(*rargs) == True
         assert data == [o1, o2, o3, o2, o3]
         assert client in self.rstatus.clients
 
-        self.check_timeout("recv", HEARTBEAT, client, clientinfo)
+        self.check_timeout("recv", HEARTBEAT, clientinfo)
 
         client.recvable.append("json, what][dsf[a]sd[f\n\nasdfSDFGDS\n")
-        assert self.rstatus.client_try_recv(*rargs) == False
+        assert clientinfo.try_recv(*rargs) == False
         fakes["irssi"].time_advance(DROP_NOTIFY)
         assert client.closed
         assert client not in self.rstatus.clients
         assert len(data) == 5
 
-    def test_client_try_send(self):
+    def test_line_framer(self):
         client = FakeSocketClass(client=True)
-        sargs = (client._fd, None, client)
-        assert self.rstatus.client_try_send(*sargs) == False
+        client.setblocking(False)
+        framer = rstatus.LineFramer(16, read_size=6)
+
+        client.recvable.append("ab\ncd\n\nef")
+        lines = []
+        while client.recvable:
+            assert framer.recv_into(client) <= 6
+            lines += [line.tobytes() for line in framer.lines()]
+        assert lines == ["ab", "cd", ""]
+        assert len(framer) == 2
+
+        client.recvable.append("ghijklmnopqrstuvwxyz")
+        while not framer.full():
+            framer.recv_into(client)
+            assert list(framer.lines()) == []
+        assert framer.buffer == "efghijklmnopqrst"
+
+    def test_client_recv_overflow(self):
+        (client, clientinfo) = self.create_client()
+        rargs = (client._fd, None)
+
+        client.recvable.append("{" + "a" * CBUFFER_LIMIT)
+        while client in self.rstatus.clients:
+            assert clientinfo.try_recv(*rargs) == \
+                (client in self.rstatus.clients)
+        assert len(client.recvable) == 1
+
+    def test_client_try_send(self):
+        (client, clientinfo) = self.create_client()
+        assert clientinfo.try_send(FakeSocketClass()._fd, None) == False
+        clientinfo.drop("TEST")
+        assert clientinfo.try_send(client._fd, None) == False
 
         for i in [("send_error", Exception), ("sendable", 0),
                   ("send_error", fakes["socket"].error)]:
             (client, clientinfo) = self.create_client()
-            sargs = (client._fd, None, client)
+            sargs = (client._fd, None)
             setattr(client, i[0], i[1])
             assert client in self.rstatus.clients
-            assert self.rstatus.client_try_send(*sargs) == False
+            assert clientinfo.try_send(*sargs) == False
             assert client.closed
             assert client not in self.rstatus.clients
 
         (client, clientinfo) = self.create_client()
-        sargs = (client._fd, None, client)
+        sargs = (client._fd, None)
         client.send_error = fakes["socket"].error()
-        clientinfo["send_queue"] = "aaacbbbbbb"
-        assert self.rstatus.client_try_send(*sargs, init=True) == True
-        self.rstatus.client_drop(client, "TEST")
+        clientinfo.send_queue.append("aaacbbbbbb")
+        assert clientinfo.try_send(*sargs, init=True) == True
+        clientinfo.drop("TEST")
 
         (client, clientinfo) = self.create_client()
-        sargs = (client._fd, None, client)
-        clientinfo["send_queue"] = "aaacbbbbbb"
+        sargs = (client._fd, None)
+        clientinfo.send_queue.append("aaacbbbbbb")
 
         client.sendable = 4
-        assert self.rstatus.client_try_send(*sargs) == True
+        assert clientinfo.try_send(*sargs) == True
 
-        self.check_timeout("send", TXRX, client, clientinfo)
+        self.check_timeout("send", TXRX, clientinfo)
 
-        assert "send" in clientinfo["watches"]
+        assert "send" in clientinfo.watches
         assert len(fakes["irssi"].iowatches) == 5
 
         client.sendable = 100
-        assert self.rstatus.client_try_send(*sargs) == False
-        self.check_timeout("send", HEARTBEAT, client, clientinfo,
-                           func=self.rstatus.client_heartbeat_send)
+        assert clientinfo.try_send(*sargs) == False
+        assert "send" not in clientinfo.watches
+        self.check_timeout("send", HEARTBEAT, clientinfo,
+                           func=clientinfo.heartbeat_send)
         assert client.sent == [
             (4, "aaacbbbbbb", "aaac"),
             (6, "bbbbbb", "bbbbbb")
         ]
 
+    def test_frame_queue(self):
+        client = FakeSocketClass(client=True)
+        client.setblocking(False)
+        send_queue = rstatus.FrameQueue()
+        frames = ["frame {0}\n".format(i) for i in xrange(100)]
+
+        for frame in frames:
+            send_queue.append(frame)
+        assert len(send_queue) == len("".join(frames))
+
+        client.sendable = 15
+        assert send_queue.send(client) == 15
+        assert len(send_queue.frames) == 1
+        assert send_queue.offset == 15
+
+        frames.append("late frame\n")
+        send_queue.append(frames[-1])
+        while len(send_queue):
+            client.sendable = 7
+            assert send_queue.send(client) == 7 or len(send_queue) == 0
+
+        assert "".join(s[2] for s in client.sent) == "".join(frames)
+        assert queued(send_queue) == ""
+
+        client.sent = []
+        send_queue.append("first\n")
+        client.sendable = 3
+        assert send_queue.send(client) == 3
+        send_queue.append("second\n")
+        client.sendable = 100
+        real_send = client.send
+        def send_once(data):
+            sent = real_send(data)
+            client.send_error = fakes["socket"].error()
+            return sent
+        client.send = send_once
+        assert send_queue.send(client) == 3
+        assert queued(send_queue) == "second\n"
+
+    def test_frame_queue_conflate(self):
+        send_queue = rstatus.FrameQueue()
+        superseded = [send_queue.append(frame, key) for (frame, key) in
+                      [("a1\n", "a"), ("m1\n", None), ("b1\n", "b"),
+                       ("a2\n", "a"), ("m2\n", None), ("b2\n", "b"),
+                       ("a3\n", "a")]]
+
+        assert superseded == [False] * 3 + [True, False, True, True]
+        assert queued(send_queue) == "m1\nm2\nb2\na3\n"
+        assert len(send_queue) == len(queued(send_queue))
+
+        # Once writing has started, nothing queued can be superseded
+        client = FakeSocketClass(client=True)
+        client.setblocking(False)
+        client.sendable = 2
+        send_queue.send(client)
+        assert not send_queue.append("a4\n", "a")
+        assert queued(send_queue) == "\nm2\nb2\na3\na4\n"
+
+        send_queue.append("c\n", "c")
+        send_queue.truncate()
+        assert queued(send_queue) == "\nm2\nb2\na3\n"
+        client.sendable = 100
+        send_queue.send(client)
+        send_queue.append("c\n", "c")
+        send_queue.truncate()
+        assert len(send_queue) == 0 and not send_queue.latest
+
+    def test_frame_queue_compact(self):
+        send_queue = rstatus.FrameQueue()
+        for i in xrange(1000):
+            send_queue.append("a{0}\n".format(i), "a")
+            send_queue.append("b{0}\n".format(i), "b")
+            if i % 100 == 0:
+                send_queue.append("m{0}\n".format(i))
+
+        assert len(send_queue.frames) < 200
+        assert send_queue.latest == {"a": len(send_queue.frames) - 2,
+                                     "b": len(send_queue.frames) - 1}
+        assert queued(send_queue) == \
+            "".join("m{0}\n".format(i) for i in xrange(0, 1000, 100)) + \
+            "a999\nb999\n"
+        assert len(send_queue) == len(queued(send_queue))
+
     def test_client_send(self):
         test_object = {
             "avalue": "a quite long string of data data num num num num",
@@ -821,26 +1773,25 @@ class TestIO:
         (client, clientinfo) = self.create_client()
 
         client.sendable = 8192
-        assert clientinfo["send_queue"] == ""
-        self.rstatus.client_send(client, test_object)
+        assert queued(clientinfo.send_queue) == ""
+        clientinfo.send(test_object)
         assert len(client.sent) == 1
         test_strings.append(client.sent[0][1])
 
-        self.rstatus.client_try_send = self.client_nop
-
-        client.sendable = 8192
-        assert clientinfo["send_queue"] == ""
-        self.rstatus.client_send(client, test_object)
-        test_strings.append(clientinfo["send_queue"])
-        assert self.nops == 1
+        # Nothing gets through from here on; count the attempts
+        client.sendable = 0
+        client.sent = []
+        assert queued(clientinfo.send_queue) == ""
+        clientinfo.send(test_object)
+        test_strings.append(queued(clientinfo.send_queue))
+        assert len(client.sent) == 1
 
-        client.sendable = 10
-        clientinfo["send_queue"] = ""
-        self.rstatus.client_send(client, test_object)
-        assert self.nops == 2
-        self.rstatus.client_send(client, test_object)
-        assert self.nops == 2
-        p = clientinfo["send_queue"].split("\n")
+        clientinfo.send_queue = rstatus.FrameQueue()
+        clientinfo.send(test_object)
+        assert len(client.sent) == 2
+        clientinfo.send(test_object)
+        assert len(client.sent) == 2
+        p = queued(clientinfo.send_queue).split("\n")
         assert len(p) == 3 and p[2] == ""
         test_strings_nonewl += p[:2]
 
@@ -851,9 +1802,9 @@ class TestIO:
         for s in test_strings_nonewl:
             assert json.loads(s) == test_object
 
-        while len(clientinfo["send_queue"]) <= CBUFFER_LIMIT:
-            assert self.nops == 2
-            self.rstatus.client_send(client, test_object)
+        while len(clientinfo.send_queue) <= CBUFFER_LIMIT:
+            assert len(client.sent) == 2
+            clientinfo.send(test_object)
 
         # Test dropped
         assert client.closed
@@ -861,8 +1812,8 @@ class TestIO:
 
     def test_client_recv(self):
         (client, clientinfo) = self.create_client()
-        assert clientinfo["send_queue"] == ""
-        self.rstatus.client_recv(client, {"type": "disconnect"})
+        assert queued(clientinfo.send_queue) == ""
+        self.rstatus.client_recv(clientinfo, {"type": "disconnect"})
         assert not client.closed
         assert client not in self.rstatus.clients
 
@@ -879,13 +1830,13 @@ class TestIO:
         false_object["send_messages"] = False
 
         (client, clientinfo) = self.create_client()
-        assert clientinfo["send_messages"] == False
+        assert clientinfo.send_messages == False
 
         for test in [true_object, false_object, true_object, false_object]:
-            self.rstatus.client_recv(client, test)
-            assert clientinfo["send_messages"] == test["send_messages"]
+            self.rstatus.client_recv(clientinfo, test)
+            assert clientinfo.send_messages == test["send_messages"]
 
-        rargs = (client._fd, None, client)
+        rargs = (client._fd, None)
 
         for test in [(True, true_object), (False, false_object),
                      (False, true_object), (True, false_object)]:
@@ -895,58 +1846,241 @@ class TestIO:
                 client.recvable.append(s[:p])
                 client.recvable.append(s[p:])
 
-                assert self.rstatus.client_try_recv(*rargs) == True
-                assert self.rstatus.client_try_recv(*rargs) == True
+                assert clientinfo.try_recv(*rargs) == True
+                assert clientinfo.try_recv(*rargs) == True
             else:
                 client.recvable.append(s)
-                assert self.rstatus.client_try_recv(*rargs) == True
+                assert clientinfo.try_recv(*rargs) == True
 
             assert client.recvable == []
-            assert clientinfo["send_messages"] == test[1]["send_messages"]
+            assert clientinfo.send_messages == test[1]["send_messages"]
 
         client.sendable = 60000
         test_object = {"type": "reset_request"}
-        self.rstatus.client_recv(client, test_object)
-        assert json.loads(client.sent[0][1]) == {"type": "reset"}
+        self.rstatus.client_recv(clientinfo, test_object)
+        assert client.sent[0][1] == \
+            '{"type":"reset"}\n' + seq_marker(self.rstatus)
 
         client.sent = []
         self.newtest_windows_create()
-        self.rstatus.client_recv(client, test_object)
-        assert json.loads(client.sent.pop(0)[1]) == {"type": "reset"}
-        self.newtest_windows_check(client)
+        self.rstatus.client_recv(clientinfo, test_object)
+        self.newtest_windows_check(client, [{"type": "reset"}])
 
     def test_client_heartbeat_send(self):
         (client, clientinfo) = self.create_client()
 
         client.sendable = 1
-        self.rstatus.client_heartbeat_send(client)
+        clientinfo.heartbeat_send()
         assert client.sent == [(1, "\n", "\n")]
-        assert clientinfo["send_queue"] == ""
+        assert queued(clientinfo.send_queue) == ""
 
-        self.rstatus.client_try_send = self.client_nop
-        self.rstatus.client_heartbeat_send(client)
-        assert clientinfo["send_queue"] == "\n"
-        assert self.nops == 1
+        clientinfo.heartbeat_send()
+        assert queued(clientinfo.send_queue) == "\n"
+        assert len(client.sent) == 2
 
     def newtest_windows_create(self):
         fakes["irssi"]._windows.append(FakeIrssiWindow("asdf", 1))
         fakes["irssi"]._windows.append(FakeIrssiWindow("#spam", 0))
         fakes["irssi"]._windows.append(FakeIrssiWindow("#blah", 3))
-        self.rstatus.settings["override_ignore"].add("#spam")
+        self.rstatus.window_levels_reload()
+        change_settings(self.rstatus, override_ignore="#spam")
 
     def test_client_new(self):
         self.newtest_windows_create()
         (client, clientinfo) = self.create_client(sendable=20000)
         self.newtest_windows_check(client)
 
-    def newtest_windows_check(self, client):
-        assert map(lambda x: x[1][-1], client.sent) == ["\n"] * 2
-        assert map(lambda x: json.loads(x[1][:-1]), client.sent) == \
+    def test_window_levels(self):
+        self.newtest_windows_create()
+        # Connecting clients must not scan irssi's windows
+        fakes["irssi"].windows = None
+
+        try:
+            self.rstatus.windowhilight(FakeIrssiWindow("asdf", 2))
+            self.rstatus.windowhilight(FakeIrssiWindow("#new", 1))
+            self.rstatus.channeldestroyed(FakeIrssiIrcChannel("#blah"))
+
+            snapshots = []
+            for i in xrange(3):
+                (client, clientinfo) = self.create_client(sendable=20000)
+                assert len(client.sent) == 1
+                snapshots.append(client.sent[0][1])
+        finally:
+            del fakes["irssi"].windows
+
+        # The windows are encoded once; they carry no seq of their own
+        cached = self.rstatus.snapshots["json"]
+        assert all(s == cached + seq_marker(self.rstatus) for s in snapshots)
+        assert snapshot_objs(snapshots[0]) == \
+            [ { "nick": "asdf", "level": 2, "server": "TheServer",
+                "wtype": "query", "type": "window_level" },
+              { "channel": "#new", "level": 1, "server": "TheServer",
+                "wtype": "channel", "type": "window_level" } ]
+
+    def test_windows_changed(self):
+        self.newtest_windows_create()
+        query = fakes["irssi"]._windows[0].active
+
+        # A renamed query and a new, quiet window
+        query.name = "fdsa"
+        self.rstatus.windows_changed(query, "asdf")
+        fakes["irssi"]._windows.append(FakeIrssiWindow("#quiet", 0))
+        self.rstatus.windows_changed(fakes["irssi"]._windows[-1], None)
+        assert len(fakes["irssi"].timeouts) == 1
+
+        fakes["irssi"].time_advance(0)
+        assert fakes["irssi"].timeouts == {}
+        assert [info.get("nick", info.get("channel"))
+                for info in self.rstatus.window_levels.values()] == \
+            ["fdsa", "#spam", "#blah", "#quiet"]
+
+    def test_client_resync(self):
+        self.newtest_windows_create()
+        (client, clientinfo) = self.create_client(sendable=10 ** 6)
+        self.rstatus.client_recv(clientinfo, {"type": "settings",
+                                              "send_messages": True})
+        first_seq = self.rstatus.seq
+
+        for i in xrange(rstatus.RStatus.history_limit + 10):
+            self.rstatus.windowhilight(FakeIrssiWindow("asdf", i % 4))
+            self.rstatus.privmsg(FakeIrssiServer(), "Hello", "asdf", None)
+        seqs = [json.loads(s[1])["seq"] for s in client.sent[1:]]
+        assert seqs == range(first_seq + 1, self.rstatus.seq + 1)
+
+        def resync(seq):
+            client.sent = []
+            self.rstatus.client_recv(clientinfo, {"type": "reset_request",
+                                                  "seq": seq})
+            if not client.sent:
+                return []
+            assert len(client.sent) == 1
+            return map(json.loads, client.sent[0][1].strip().split("\n"))
+
+        assert resync(self.rstatus.seq) == []
+        assert [o["seq"] for o in resync(self.rstatus.seq - 3)] == \
+            range(self.rstatus.seq - 2, self.rstatus.seq + 1)
+
+        oldest = self.rstatus.seq - rstatus.RStatus.history_limit + 1
+        assert resync(oldest - 1)[0]["seq"] == oldest
+        for seq in [oldest - 2, first_seq, self.rstatus.seq + 1, "x"]:
+            frames = resync(seq)
+            assert frames[0] == {"type": "reset"}
+            assert map(rstatus.window_key, frames[1:-1]) == \
+                [("TheServer", "query", "asdf"),
+                 ("TheServer", "channel", "#blah")]
+            assert frames[-1] == {"type": "seq", "seq": self.rstatus.seq}
+
+        self.rstatus.client_recv(clientinfo, {"type": "settings",
+                                              "send_messages": False})
+        assert [o["type"] for o in resync(self.rstatus.seq - 4)] == \
+            ["window_level"] * 2
+
+    def newtest_windows_check(self, client, before=[]):
+        # One batched write
+        assert len(client.sent) == 1
+        assert snapshot_objs(client.sent[0][1]) == \
+            before + \
             [ { "nick": "asdf", "level": 1, "server": "TheServer",
                 "wtype": "query", "type": "window_level" },
             { "channel": "#blah", "level": 3, "server": "TheServer",
                 "wtype": "channel", "type": "window_level" } ]
 
+    def slow_client(self, policy, sendable=10):
+        self.newtest_windows_create()
+        change_settings(self.rstatus, slow_consumer=policy)
+
+        (client, clientinfo) = self.create_client(sendable=20000)
+        self.rstatus.client_recv(clientinfo, {"type": "settings",
+                                              "send_messages": True})
+        client.sent = []
+        client.sendable = sendable
+        return (client, clientinfo)
+
+    def slow_hilights(self, count=200):
+        for i in xrange(count):
+            self.rstatus.windowhilight(FakeIrssiWindow("asdf", i % 4))
+            self.rstatus.windowhilight(FakeIrssiWindow("#blah", i % 3))
+
+    def slow_messages(self, count=200):
+        for i in xrange(count):
+            self.rstatus.privmsg(FakeIrssiServer(), "Hello", "asdf", None)
+
+    def slow_drain(self, client):
+        client.sendable = 10 ** 6
+        fakes["irssi"].proc_io()
+        stream = "".join(s[2] for s in client.sent)
+        frames = map(json.loads, stream.strip().split("\n"))
+        seqs = [frame.pop("seq") for frame in frames if "seq" in frame]
+        assert seqs == sorted(seqs)
+        return frames
+
+    def test_slow_consumer_conflate(self):
+        (client, clientinfo) = self.slow_client("disconnect")
+        self.slow_hilights()
+        assert not clientinfo.dropped
+        assert len(clientinfo.send_queue) < 400
+        assert self.rstatus.slow_consumers == \
+            {"conflated": 397, "resyncs": 0, "disconnects": 0}
+
+        # The first was already being written
+        frames = self.slow_drain(client)
+        assert map(rstatus.window_key, frames) == \
+            [("TheServer", "query", "asdf"), ("TheServer", "query", "asdf"),
+             ("TheServer", "channel", "#blah")]
+        assert [f["level"] for f in frames] == [0, 199 % 4, 199 % 3]
+
+        # Messages are never conflated
+        client.sent = []
+        client.sendable = 10
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "asdf", None)
+        self.slow_hilights(2)
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "asdf", None)
+        self.slow_hilights(3)
+        assert [(f["type"], f.get("level")) for f in self.slow_drain(client)] \
+            == [("message", None), ("message", None),
+                ("window_level", 2), ("window_level", 2)]
+
+    def test_slow_consumer_disconnect(self):
+        (client, clientinfo) = self.slow_client("disconnect")
+        self.slow_messages()
+        assert clientinfo.dropped and client.closed
+        assert self.rstatus.slow_consumers == \
+            {"conflated": 0, "resyncs": 0, "disconnects": 1}
+
+    def test_slow_consumer_conflate_setting(self):
+        # A policy of its own, falling back to resync, before conflation
+        # was always on
+        self.test_slow_consumer_resync("conflate")
+
+    def test_slow_consumer_resync(self, policy="resync"):
+        (client, clientinfo) = self.slow_client(policy)
+        assert self.rstatus.settings["slow_consumer"] == policy
+        self.slow_messages()
+        assert clientinfo.resync and not clientinfo.dropped
+        assert len(clientinfo.send_queue) < 200
+        assert self.rstatus.slow_consumers == \
+            {"conflated": 0, "resyncs": 1, "disconnects": 0}
+
+        # Finishes the message it was part way through, then starts over
+        self.slow_hilights(1)
+        frames = self.slow_drain(client)
+        assert not clientinfo.resync
+        assert [f["type"] for f in frames] == \
+            ["message", "reset", "window_level", "window_level", "seq"]
+        assert [f["level"] for f in frames[2:-1]] == [0, 0]
+
+        # With nothing part written, the reset is queued straight away
+        client.sent = []
+        client.sendable = 0
+        self.slow_messages()
+        assert not clientinfo.resync
+        assert self.rstatus.slow_consumers["resyncs"] > 1
+        assert self.slow_drain(client)[0] == {"type": "reset"}
+
+    def test_slow_consumer_invalid(self):
+        change_settings(self.rstatus, slow_consumer="whatever")
+        assert self.rstatus.settings["slow_consumer"] == "disconnect"
+
     def test_hup(self):
         (client, clientinfo) = self.create_client(sendable=20000)
         client.closed = True
@@ -954,6 +2088,502 @@ class TestIO:
 
         assert client not in self.rstatus.clients
 
+class TestListeners:
+    def setup(self):
+        self.rstatus = prepare_rstatus()
+        fakes["irssi"]._windows.append(FakeIrssiWindow("#blah", 3))
+        self.rstatus.window_levels_reload()
+
+    def listen(self, address="127.0.0.1:7777", **settings):
+        change_settings(self.rstatus, **settings)
+        self.rstatus.create_tcp_socket(address)
+        if len(fakes["socket"].sockets) == 2:
+            return fakes["socket"].sockets[1]
+
+    def connect(self, sock):
+        client = FakeSocketClass(client=True)
+        client.sendable = 10 ** 6
+        sock.acceptable.append((client, ("127.0.0.1", 40000)))
+        assert self.rstatus.socket_activity(sock._fd, None, sock)
+        return client
+
+    def send(self, client, obj):
+        client.recvable.append(json.dumps(obj) + "\n")
+        return self.rstatus.clients[client].try_recv(client._fd, None)
+
+    def test_needs_token(self):
+        assert self.listen() is None
+        assert len(self.rstatus.listeners) == 1
+
+    def test_tcp(self):
+        sock = self.listen(auth_token="sekrit")
+        assert sock.family == FakeSocketModule.AF_INET
+        assert sock.addr == ("127.0.0.1", 7777) and sock.called_listen
+        assert sock.sockopts == {(1, 2): 1}
+        assert len(self.rstatus.listeners) == 2
+
+        # Nothing is sent before authenticating, and anything else drops
+        client = self.connect(sock)
+        assert client.sent == []
+        assert not self.send(client, {"type": "settings",
+                                      "send_messages": True})
+        assert client not in self.rstatus.clients
+        assert json.loads(client.sent[0][1])["type"] == "disconnect_notice"
+
+        client = self.connect(sock)
+        assert not self.send(client, {"type": "auth", "token": "wrong"})
+        assert client not in self.rstatus.clients
+
+        client = self.connect(sock)
+        assert self.send(client, {"type": "auth", "token": u"sekrit"})
+        assert snapshot_objs(client.sent[0][1])[0]["channel"] == "#blah"
+        assert self.send(client, {"type": "settings", "send_messages": True})
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "Sibling", None)
+        assert json.loads(client.sent[1][1])["message"] == "Hello"
+
+        # The UNIX socket still needs no token
+        unix = fakes["socket"].sockets[0]
+        client = self.connect(unix)
+        assert snapshot_objs(client.sent[0][1])[0]["channel"] == "#blah"
+
+    def test_cleartext_loopback_only(self):
+        assert self.listen("0.0.0.0:7777", auth_token="sekrit") is None
+        assert self.listen(":7777", auth_token="sekrit") is None
+        assert len(self.rstatus.listeners) == 1
+
+        sock = self.listen("0.0.0.0:7777", auth_token="sekrit",
+                           tls_cert="cert.pem")
+        assert sock.addr == ("0.0.0.0", 7777)
+        assert self.rstatus.listeners[sock]["tls"]
+
+    def test_auth_timeout(self):
+        client = self.connect(self.listen(auth_token="sekrit"))
+        fakes["irssi"].time_advance(TXRX)
+        assert client not in self.rstatus.clients
+
+    def test_tls(self):
+        sock = self.listen(auth_token="sekrit", tls_cert="~/cert.pem")
+        assert self.rstatus.listeners[sock]["tls"]
+
+        # The certificate is loaded once, when listening
+        (context,) = fakes["ssl"].contexts
+        assert context.purpose == FakeSSLModule.Purpose.CLIENT_AUTH
+        assert context.certfile == "/home/theuser/cert.pem"
+
+        client = FakeSocketClass(client=True)
+        client.sendable = 10 ** 6
+        client.handshake_wants = [2, 3]
+        sock.acceptable.append((client, ("127.0.0.1", 40000)))
+        assert self.rstatus.socket_activity(sock._fd, None, sock)
+
+        assert client.tls_context is context
+        assert client.tls_kwargs == {"server_side": True,
+                                     "do_handshake_on_connect": False}
+        assert client not in self.rstatus.clients
+
+        for iotype in [FakeIrssiModule.IO_IN, FakeIrssiModule.IO_OUT]:
+            watch = self.rstatus.handshakes[client]["watch"]
+            assert fakes["irssi"].iowatches[watch][3] == iotype
+            assert not self.rstatus.tls_handshake(client._fd, iotype, client)
+            del fakes["irssi"].iowatches[watch]
+
+        assert self.rstatus.handshakes == {}
+        assert self.rstatus.clients[client].tls
+        assert self.send(client, {"type": "auth", "token": "sekrit"})
+        assert snapshot_objs(client.sent[0][1])[0]["channel"] == "#blah"
+
+    def test_tls_failures(self):
+        sock = self.listen(auth_token="sekrit", tls_cert="cert.pem")
+
+        stuck = FakeSocketClass(client=True)
+        stuck.handshake_wants = [2] * 100
+        broken = FakeSocketClass(client=True)
+        broken.handshake_wants = [1]
+        sock.acceptable += [(stuck, ("127.0.0.1", 40000)),
+                            (broken, ("127.0.0.1", 40001))]
+        self.rstatus.socket_activity(sock._fd, None, sock)
+        self.rstatus.socket_activity(sock._fd, None, sock)
+
+        assert broken.closed and broken not in self.rstatus.handshakes
+        assert not stuck.closed
+        fakes["irssi"].time_advance(TXRX)
+        assert stuck.closed and self.rstatus.handshakes == {}
+        assert self.rstatus.clients == {}
+
+class TestHelper:
+    def setup(self):
+        for name, module in fakes.items():
+            module.reset()
+        fakes["irssi"].presets["fanout_helper"] = 1
+        fakes["irssi"]._windows.append(FakeIrssiWindow("#blah", 3))
+        # Keep clear of the fds that the child dup2()s over
+        FakeSocketClass.next_fd = max(FakeSocketClass.next_fd, 10)
+        self.rstatus = rstatus.RStatus(debug=True)
+        (self.ours, self.theirs) = fakes["socket"].pairs[0]
+
+    def calls(self, sock):
+        reader = rstatus_helper.CallReader(1 << 20)
+        calls = reader.feed("".join(s[2] for s in sock.sent))
+        sock.sent = []
+        return calls
+
+    def test_start(self):
+        assert self.rstatus.helper.pid == 4242
+        assert self.theirs.closed and not self.ours.closed
+
+        # The plugin keeps the listening socket, but doesn't watch it
+        assert self.rstatus.socket in self.rstatus.listeners
+        assert sorted(w[3] for w in fakes["irssi"].iowatches.values()) == \
+            [FakeIrssiModule.IO_IN, FakeIrssiModule.IO_ERR,
+             FakeIrssiModule.IO_HUP]
+        assert all(w[0] is self.ours
+                   for w in fakes["irssi"].iowatches.values())
+
+        [(name, (settings, policy, windows))] = self.calls(self.ours)
+        assert name == "helper_sync"
+        assert rstatus.settings_native(settings) == self.rstatus.settings
+        assert rstatus.FilterPolicy(*policy).allows(windows[0])
+        assert windows == [{"channel": "#blah", "server": "TheServer",
+                            "level": 3, "wtype": "channel",
+                            "type": "window_level"}]
+
+    def test_forwards(self):
+        self.calls(self.ours)
+        seq = self.rstatus.seq
+
+        self.rstatus.windowhilight(FakeIrssiWindow("Sibling", 2))
+        self.rstatus.privmsg(FakeIrssiServer(), "Hello", "Sibling", None)
+        self.rstatus.channeldestroyed(FakeIrssiIrcChannel("#blah"))
+        change_settings(self.rstatus, override_ignore="#spam")
+        self.rstatus.status(None, None, None)
+
+        calls = self.calls(self.ours)
+        assert [name for (name, args) in calls] == \
+            ["window_level_set", "broadcast", "broadcast",
+             "window_level_remove", "broadcast", "helper_sync", "status"]
+        assert calls[2][1][0]["message"] == "Hello"
+        assert calls[5][1][0]["override_ignore"] == ["#spam"]
+        assert calls[5][1][1] == [True, True, [], ["#spam"]]
+
+        # Sequence numbers and history belong to the helper
+        assert self.rstatus.seq == seq and not self.rstatus.history
+
+    def test_prnt(self, capsys):
+        capsys.readouterr()
+        self.ours.recvable.append(
+            rstatus_helper.pack_call("helper_prnt", ("Hello", )) +
+            rstatus_helper.pack_call("client_drop", ("x", )))
+        assert self.rstatus.helper.try_recv(self.ours._fd, None)
+
+        out = capsys.readouterr()[0]
+        assert "Irssi: Hello\n" in out
+        assert "Ignoring helper call u'client_drop'" in out
+
+    def test_bad_call(self, capsys):
+        # Anything but a JSON call drops the link before it is looked at
+        self.ours.recvable.append(pickle.dumps(("helper_prnt", ("x", ))) +
+                                  "\n")
+        assert not self.rstatus.helper.try_recv(self.ours._fd, None)
+        assert self.rstatus.helper is None and self.ours.closed
+        assert "Lost helper process (RECV Bad Call)" in capsys.readouterr()[0]
+
+    def test_lost(self):
+        self.ours.recvable.append("")
+        assert not self.rstatus.helper.try_recv(self.ours._fd, None)
+
+        # Clients are served from irssi again
+        assert self.rstatus.helper is None
+        assert self.ours.closed
+        assert fakes["irssi"].iowatches.values() == \
+            [(self.rstatus.socket, self.rstatus.socket_activity,
+              self.rstatus.socket, None)]
+
+        assert fakes["os"].waitpids == [4242]
+        fakes["irssi"].time_advance(1)
+        assert fakes["os"].waitpids == [4242, 4242]
+        assert fakes["irssi"].timeouts == {}
+
+    def test_fork_fails(self):
+        for name, module in fakes.items():
+            module.reset()
+        fakes["irssi"].presets["fanout_helper"] = 1
+        fakes["os"].fork_result = OSError(errno.EAGAIN, "No")
+        self.rstatus = rstatus.RStatus(debug=True)
+
+        assert self.rstatus.helper is None
+        assert fakes["irssi"].iowatches.values()[0][1] == \
+            self.rstatus.socket_activity
+
+    def test_child(self, capsys):
+        # What the child sees just after the fork: irssi's loop is gone
+        rs = self.rstatus
+        fakes["irssi"].iowatches.clear()
+        self.theirs.closed = False
+        rs.helper_child(self.theirs, fakes["irssi"])
+
+        assert rs.helper is None and rs.upstream.sock is self.theirs
+        (low, high) = sorted([self.theirs._fd, rs.socket._fd])
+        assert fakes["os"].fd_calls == \
+            [("open", "/dev/null")] + \
+            [("dup2", 99, fd) for fd in (0, 1, 2)] + \
+            [("closerange", 3, low), ("closerange", low + 1, high),
+             ("closerange", high + 1, 65536)]
+        assert (rs.socket, rs.socket_activity, rs.socket, None) in \
+            fakes["irssi"].iowatches.values()
+
+        def upstream(*calls):
+            self.theirs.recvable.append("".join(
+                rstatus_helper.pack_call(name, args) for (name, args) in calls))
+            assert rs.upstream.try_recv(self.theirs._fd, None)
+
+        # State arrives from the plugin before anything else
+        windows = [{"nick": "asdf", "server": "TheServer", "level": 1,
+                    "wtype": "query", "type": "window_level"}]
+        upstream(("helper_sync", (rstatus.settings_plain(rs.settings),
+                                  rs.filter.args, windows)))
+
+        client = FakeSocketClass(client=True)
+        client.sendable = 10 ** 6
+        rs.socket.acceptable.append((client, ''))
+        assert rs.socket_activity(rs.socket._fd, None, rs.socket)
+        assert snapshot_objs(client.sent[0][1]) == windows
+        client.sent = []
+
+        info = {"nick": "asdf", "server": "TheServer", "level": 3,
+                "wtype": "query", "type": "window_level"}
+        upstream(("window_level_set", (info, )), ("broadcast", (info, )),
+                 ("status", (None, None, None)))
+        assert pop_seqs([json.loads(client.sent[0][1])]) == [info.copy()]
+        assert rs.window_levels.values() == [info]
+
+        assert "Irssi: Connected clients: 1\n" in capsys.readouterr()[0]
+
+        # Unloading the plugin closes its end
+        upstream_link = rs.upstream
+        self.theirs.recvable.append("")
+        assert not upstream_link.try_recv(self.theirs._fd, None)
+        assert rs.upstream is None
+        assert fakes["irssi"].stopped
+
+class TestFanoutDaemon:
+    # What the serving half reads
+    settings = {"socket": "/tmp/clients", "listen_tcp": "",
+                "listen_backlog": 128, "auth_token": "", "tls_cert": "",
+                "slow_consumer": "disconnect"}
+
+    def setup(self):
+        for name, module in fakes.items():
+            module.reset()
+        fakes["irssi"].presets["fanout_daemon"] = "~/.irssi/rstatus_fanout"
+
+    def calls(self, sock):
+        reader = rstatus_helper.CallReader(1 << 20)
+        calls = reader.feed("".join(s[2] for s in sock.sent))
+        sock.sent = []
+        return calls
+
+    def test_plugin(self):
+        rs = rstatus.RStatus()
+        [sock] = fakes["socket"].sockets
+        assert sock.addr == "/home/theuser/.irssi/rstatus_fanout"
+        assert rs.helper.sock is sock and rs.helper.pid is None
+
+        # irssi holds just the one socket
+        assert not rs.listeners and rs.socket is None
+        assert all(w[0] is sock for w in fakes["irssi"].iowatches.values())
+        assert [name for (name, args) in self.calls(sock)] == \
+            ["helper_sync"]
+
+        rs.windowhilight(FakeIrssiWindow("Sibling", 2))
+        assert [name for (name, args) in self.calls(sock)] == \
+            ["window_level_set", "broadcast"]
+
+        # Restarting the daemon, or one too busy to accept (EAGAIN): the
+        # plugin retries until it gets through
+        fakes["socket"].connect_error = FakeSocketError()
+        sock.recvable.append("")
+        assert not rs.helper.try_recv(sock._fd, None)
+        assert rs.helper is None and sock.closed
+        assert len(fakes["irssi"].timeouts) == 1
+
+        fakes["irssi"].time_advance(rs.timeout_daemon_retry)
+        assert rs.helper is None
+        fakes["socket"].connect_error = None
+        fakes["irssi"].time_advance(rs.timeout_daemon_retry)
+        assert rs.helper.sock is fakes["socket"].sockets[-1]
+        assert rs.helper.sock.connect_nonblocking
+        assert fakes["irssi"].timeouts == {}
+
+        [(name, (settings, policy, windows))] = \
+            self.calls(fakes["socket"].sockets[-1])
+        assert name == "helper_sync"
+        assert [info["nick"] for info in windows] == ["Sibling"]
+
+    def test_plugin_daemon_uid(self, capsys):
+        # Someone else bound the path first: nothing is sent to them
+        fakes["socket"].peer_uid = 1001
+        rs = rstatus.RStatus()
+        [sock] = fakes["socket"].sockets
+        assert rs.helper is None and sock.closed and sock.sent == []
+        assert len(fakes["irssi"].timeouts) == 1
+        assert "belongs to uid 1001" in capsys.readouterr()[0]
+
+    def test_daemon(self):
+        rs = rstatus.RStatus(daemon_path="/tmp/upstream")
+        [listener] = fakes["socket"].sockets
+        assert listener.addr == "/tmp/upstream" and listener.backlog == 1
+        assert fakes["os"].unlinked_files == ["/tmp/upstream"]
+        # Bound 0600, and the umask put back
+        assert fakes["os"].umasks == [0177, 022]
+        assert fakes["irssi"].settings == {} and fakes["irssi"].signals == {}
+
+        def plugin_connects():
+            plugin = FakeSocketClass(client=True)
+            plugin.sendable = 10 ** 6
+            listener.acceptable.append((plugin, ''))
+            assert rs.daemon_accept(listener._fd, None, listener)
+            assert rs.upstream.sock is plugin
+            return plugin
+
+        # Only the daemon's own user may drive it
+        stranger = FakeSocketClass(client=True)
+        stranger.peer_uid = 1001
+        listener.acceptable.append((stranger, ''))
+        assert rs.daemon_accept(listener._fd, None, listener)
+        assert stranger.closed and rs.upstream is None
+
+        # Clients are only listened for once the plugin says where
+        plugin = plugin_connects()
+        assert len(fakes["socket"].sockets) == 1
+
+        settings = self.settings
+        windows = [{"nick": "asdf", "server": "TheServer", "level": 1,
+                    "wtype": "query", "type": "window_level"}]
+        plugin.recvable.append(rstatus_helper.pack_call(
+            "helper_sync", (settings, [True, True, [], []], windows)))
+        assert rs.upstream.try_recv(plugin._fd, None)
+        assert rs.socket.addr == "/tmp/clients"
+        assert (rs.socket, rs.socket_activity, rs.socket, None) in \
+            fakes["irssi"].iowatches.values()
+
+        client = FakeSocketClass(client=True)
+        client.sendable = 10 ** 6
+        rs.socket.acceptable.append((client, ''))
+        assert rs.socket_activity(rs.socket._fd, None, rs.socket)
+        assert snapshot_objs(client.sent[0][1]) == windows
+
+        # The daemon outlives the plugin, and serves the next one
+        plugin.recvable.append("")
+        assert not rs.upstream.try_recv(plugin._fd, None)
+        assert rs.upstream is None and not fakes["irssi"].stopped
+
+        plugin = plugin_connects()
+        newer = plugin_connects()
+        assert plugin.closed and not newer.closed
+
+        newer.recvable.append(rstatus_helper.pack_call(
+            "helper_sync", (settings, rs.filter.args, windows)))
+        assert rs.upstream.try_recv(newer._fd, None)
+        assert len(rs.listeners) == 1 and rs.clients
+
+    def test_daemon_listen_fails(self, capsys):
+        rs = rstatus.RStatus(daemon_path="/tmp/upstream")
+        [listener] = fakes["socket"].sockets
+        plugin = FakeSocketClass(client=True)
+        listener.acceptable.append((plugin, ''))
+        rs.daemon_accept(listener._fd, None, listener)
+
+        fakes["os"].unlink = None
+        plugin.recvable.append(rstatus_helper.pack_call(
+            "helper_sync", (self.settings, [True, True, [], []], [])))
+        try:
+            rs.upstream.try_recv(plugin._fd, None)
+        finally:
+            del fakes["os"].unlink
+        assert fakes["irssi"].stopped
+        assert "Could not listen for clients" in capsys.readouterr()[0]
+
+class TestPollLoop:
+    def test_calls(self):
+        data = rstatus_helper.pack_call("broadcast", ({"x": 1}, )) + \
+               rstatus_helper.pack_call("status", (None, None, None))
+
+        reader = rstatus_helper.CallReader(1024)
+        calls = []
+        for c in data:
+            calls += reader.feed(c)
+        assert calls == [("broadcast", [{"x": 1}]),
+                         ("status", [None, None, None])]
+        assert reader.size == 0
+
+        # Only JSON calls are read; anything else (a pickle, say) is refused
+        # before any of it is acted on
+        for data in [pickle.dumps(("status", ())) + "\n",
+                     '{"name": "status"}\n', '["status", null]\n']:
+            try:
+                rstatus_helper.CallReader(1024).feed(data)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("bad call accepted")
+
+        reader = rstatus_helper.CallReader(4)
+        try:
+            reader.feed(data)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("call over limit accepted")
+
+    def test_loop(self):
+        lines = []
+        loop = rstatus_helper.PollLoop(prnt=lines.append)
+        (a, b) = socket.socketpair()
+        events = []
+
+        def readable(fd, condition, tag):
+            events.append((tag, a.recv(100)))
+            return True
+
+        def once(tag):
+            events.append(tag)
+            return False
+
+        def repeat(tag):
+            events.append(tag)
+            if events.count(tag) < 3:
+                return True
+            loop.source_remove(watch)
+
+        def broken():
+            raise KeyError("x")
+
+        watch = loop.io_add_watch(a, readable, "read", loop.IO_IN)
+        loop.timeout_add(0, once, "once")
+        loop.timeout_add(0, broken)
+        b.send("Hello")
+        loop.run_once()
+        assert events == [("read", "Hello"), "once"]
+        assert "KeyError" in lines[-1]
+
+        # Watches can be removed from callbacks; the loop ends once
+        # there is nothing left to wait for
+        loop.timeout_add(1, repeat, "repeat")
+        loop.run()
+        assert events[2:] == ["repeat"] * 3
+        assert loop.running and not loop.watches and not loop.timeouts
+
+        def writable(fd, condition):
+            loop.stop()
+            return True
+
+        loop.io_add_watch(a.fileno(), writable, condition=loop.IO_OUT)
+        loop.run()
+        assert not loop.running and loop.watches
+
+        a.close()
+        b.close()
+
 class TestExampleClients:
     def setup(self):
         self.rstatus = prepare_rstatus()
@@ -971,13 +2601,13 @@ class TestExampleClients:
         fakes["irssi"]._windows.append(FakeIrssiWindow("#Spam", 0))
         fakes["irssi"]._windows.append(FakeIrssiWindow("#blah", 3))
         fakes["irssi"]._windows.append(FakeIrssiWindow("#bleh", 0))
-        self.rstatus.settings["override_ignore"] = "#spam"
+        self.rstatus.window_levels_reload()
+        change_settings(self.rstatus, override_ignore="#spam")
 
     def test_lagless(self):
         self.create_windows()
         client = self.create_client(sendable=60000)
-        data = ''.join(map(lambda x: x[1], client.sent))
-        data = map(json.loads, data.strip().split("\n"))
+        data = snapshot_objs(''.join(map(lambda x: x[1], client.sent)))
 
         assert data == \
             [ { "nick": "ASdf", "level": 1, "server": "TheServer",
@@ -1002,10 +2632,10 @@ class TestExampleClients:
         server = FakeIrssiServer("mynickname")
         self.rstatus.pubmsg(server, "mynickname: hi", "dude", None, "#spam")
         self.rstatus.pubmsg(server, "mynickname: hi", "dude", None, "#bleh")
-        assert json.loads(client.sent[1][1][:-1]) == \
-            { "channel": "#bleh", "nick": "dude", "type": "message",
-              "wtype": "channel", "message": "mynickname: hi",
-              "server": "TheServer" }
+        assert pop_seqs([json.loads(client.sent[1][1][:-1])]) == \
+            [ { "channel": "#bleh", "nick": "dude", "type": "message",
+                "wtype": "channel", "message": "mynickname: hi",
+                "server": "TheServer" } ]
         assert len(client.sent) == 2
 
         client.recvable.append(json.dumps({"type": "settings",
@@ -1037,8 +2667,7 @@ class TestExampleClients:
         client.recvable.append(json.dumps({"type": "reset_request"}) + "\n")
         fakes["irssi"].proc_io()
 
-        ndata = ''.join(map(lambda x: x[1], client.sent))
-        ndata = map(json.loads, ndata.strip().split("\n"))
+        ndata = snapshot_objs(''.join(map(lambda x: x[1], client.sent)))
         assert ndata == [{"type": "reset"}] + data
 
 
@@ -1071,9 +2700,9 @@ class TestExampleClients:
 
         self.rstatus.privmsg(FakeIrssiServer(), "Hello", "Sibling", None)
         assert len(laggy_client.sent) == 1
-        assert json.loads(laggy_client.sent[0][1]) == \
-            {"nick": "Sibling", "type": "message", "wtype": "query",
-             "message": "Hello", "server": "TheServer" }
+        assert pop_seqs([json.loads(laggy_client.sent[0][1])]) == \
+            [ {"nick": "Sibling", "type": "message", "wtype": "query",
+               "message": "Hello", "server": "TheServer" } ]
 
         laggy_client.recvable.append("\n")
         fakes["irssi"].proc_io()
@@ -1087,6 +2716,7 @@ class TestExampleClients:
 
     def test_mute(self):
         client = FakeSocketClass(client=True)
+        client.sendable = 10 ** 6
         self.socket.acceptable.append((client, ''))
         self.rstatus.socket_activity(self.socket._fd, None, self.socket)
         assert not client.closed
@@ -1094,3 +2724,358 @@ class TestExampleClients:
         assert not client.closed
         fakes["irssi"].time_advance(2)
         assert client.closed
+
+class TestRelay:
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_listen(self):
+        sock = relay.listen("127.0.0.1:0")
+        assert sock.family == socket.AF_INET
+        sock.close()
+
+        # Nothing asks who is connecting, so only loopback is offered
+        for address in ["0.0.0.0:7000", "192.0.2.1:7000"]:
+            try:
+                relay.listen(address)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("listened on " + address)
+
+        # A socket left behind is replaced; anything else is left alone
+        path = os.path.join(self.tmp, "sock")
+        relay.listen(path).close()
+        sock = relay.listen(path)
+        assert sock.getsockname() == path
+        sock.close()
+
+        path = os.path.join(self.tmp, "file")
+        open(path, "w").close()
+        try:
+            relay.listen(path)
+        except socket.error:
+            pass
+        else:
+            raise AssertionError("replaced a file")
+        assert os.path.isfile(path)
+
+    def multi(self, listener, use_splice=True):
+        # Each accepted connection is paired with one end of a socketpair;
+        # far holds the other ends
+        far = []
+
+        def connect():
+            (ours, theirs) = socket.socketpair()
+            far.append(theirs)
+            return (ours, ours)
+
+        return (relay.MultiRelay(listener, connect, use_splice), far)
+
+    def test_multi_accept_errors(self, capsys):
+        path = os.path.join(self.tmp, "sock")
+
+        class Listener:
+            def __init__(self, sock, errors):
+                self.sock = sock
+                self.errors = errors
+                self.fileno = sock.fileno
+                self.setblocking = sock.setblocking
+
+            def accept(self):
+                if self.errors:
+                    raise socket.error(self.errors.pop(0), "Failed")
+                return self.sock.accept()
+
+        listener = Listener(relay.listen(path),
+                            [errno.ECONNABORTED, errno.EMFILE])
+        (multi, far) = self.multi(listener)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+
+        # The first error is skipped over; the second stops accepting until
+        # the next sweep rather than ending the relay
+        multi._poll_once()
+        assert multi._accept_paused and not multi._pairs
+        assert "Could not accept a connection" in capsys.readouterr()[1]
+
+        # Until the sweep, the waiting connection doesn't wake the relay
+        multi._next_sweep = time.time()
+        multi._poll_once()
+        assert not multi._accept_paused and not multi._pairs
+
+        multi._poll_once()
+        assert len(multi._pairs) == 1 and len(far) == 1
+        client.close()
+
+    def modes(self):
+        modes = [False]
+        if relay.splice is not None:
+            modes.append(True)
+        return modes
+
+    def fill(self, sock):
+        # Until the kernel takes no more; returns how much it took
+        sock.setblocking(False)
+        total = 0
+        while True:
+            try:
+                total += sock.send("y" * 65536)
+            except socket.error, e:
+                assert e.errno == errno.EAGAIN
+                return total
+
+    def drain(self, sock):
+        sock.setblocking(False)
+        data = []
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except socket.error, e:
+                assert e.errno == errno.EAGAIN
+                break
+            if not chunk:
+                break
+            data.append(chunk)
+        return "".join(data)
+
+    def test_half_close(self):
+        for use_splice in self.modes():
+            (a_far, a) = socket.socketpair()
+            (b, b_far) = socket.socketpair()
+            r = relay.Relay((a, a), (b, b), use_splice)
+
+            # b can't take anything yet, so the data is still waiting in the
+            # relay when a's side goes away
+            junk = self.fill(b)
+            a_far.sendall("last words\n")
+            a_far.close()
+
+            received = []
+            for i in xrange(1000):
+                try:
+                    r._poll_once()
+                except relay.DisconnectedError:
+                    break
+                received.append(self.drain(b_far))
+            else:
+                raise AssertionError("relay never finished")
+
+            received.append(self.drain(b_far))
+            received = "".join(received)
+            assert len(received) == junk + len("last words\n")
+            assert received.endswith("y" * 10 + "last words\n")
+
+            for sock in (a, b, b_far):
+                sock.close()
+
+    def relayed(self, poll_once, sock, expect):
+        # Polls until sock has been sent expect (and nothing more)
+        data = ""
+        for i in xrange(1000):
+            if len(data) >= len(expect):
+                break
+            poll_once()
+            data += self.drain(sock)
+        assert data == expect
+
+    def both_ways(self, poll_once, a_far, b_far):
+        big = "".join(chr(i % 256) for i in xrange(200000))
+        for (sock, far, data) in [(a_far, b_far, "Hello\n"),
+                                  (b_far, a_far, "Hi\n"),
+                                  (a_far, b_far, big)]:
+            sock.setblocking(True)
+            sock.sendall(data)
+            self.relayed(poll_once, far, data)
+
+    def test_buffered(self):
+        (a_far, a) = socket.socketpair()
+        (b, b_far) = socket.socketpair()
+        r = relay.Relay((a, a), (b, b), use_splice=False)
+
+        # Each descriptor is registered once, and mapped to its peer
+        assert r._handlers == {a.fileno(): r._a, b.fileno(): r._b}
+        assert r._a._pipe is None and r._b._pipe is None
+
+        self.both_ways(r._poll_once, a_far, b_far)
+
+        # Nothing left to write: only reading is asked for
+        assert r._a._poll_mask(a.fileno()) == r._poll.IN
+        assert "write" not in r._a._timeouts and \
+               "write" not in r._b._timeouts
+
+        r._a._timeouts["read"] = time.time() - 1
+        assert r.run() == False
+
+        for sock in (a_far, a, b, b_far):
+            sock.close()
+
+    def test_poller(self):
+        poll = relay.Poller()
+        (a, b) = socket.socketpair()
+
+        poll.register(a.fileno(), poll.IN)
+        assert poll.poll(0) == []
+        b.send("x")
+        assert poll.poll(1) == [(a.fileno(), poll.IN)]
+
+        poll.modify(a.fileno(), poll.OUT)
+        assert poll.poll(1) == [(a.fileno(), poll.OUT)]
+        poll.unregister(a.fileno())
+        assert poll.poll(0) == []
+
+        # Regular files are always ready, even for epoll
+        path = os.path.join(self.tmp, "file")
+        with open(path, "w") as f:
+            poll.register(f.fileno(), poll.OUT)
+            assert poll.poll(10) == [(f.fileno(), poll.OUT)]
+            poll.modify(f.fileno(), 0)
+            assert poll.poll(0) == []
+            poll.unregister(f.fileno())
+
+        a.close()
+        b.close()
+
+    def test_regular_files(self):
+        # As when stdin and stdout are redirected
+        data = "".join(chr(i % 256) for i in xrange(200000))
+        (stdin, stdout) = [os.path.join(self.tmp, name)
+                           for name in ("stdin", "stdout")]
+        with open(stdin, "w") as f:
+            f.write(data)
+
+        for use_splice in self.modes():
+            (a_far, a) = socket.socketpair()
+            r = relay.Relay((a, a), (open(stdin), open(stdout, "w")),
+                            use_splice)
+
+            received = []
+            for i in xrange(1000):
+                try:
+                    r._poll_once()
+                except relay.DisconnectedError:
+                    break
+                received.append(self.drain(a_far))
+            else:
+                raise AssertionError("relay never finished")
+
+            received.append(self.drain(a_far))
+            assert "".join(received) == data
+
+            for sock in (a_far, a):
+                sock.close()
+
+    def test_multi(self):
+        for use_splice in self.modes():
+            path = os.path.join(self.tmp, "multi")
+            (multi, far) = self.multi(relay.listen(path), use_splice)
+
+            clients = []
+            for i in xrange(3):
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(path)
+                clients.append(client)
+            for i in xrange(10):
+                if len(multi._pairs) == 3:
+                    break
+                multi._poll_once()
+            assert len(multi._pairs) == 3 and len(far) == 3
+
+            for (client, other) in zip(clients, far):
+                self.both_ways(multi._poll_once, client, other)
+
+            # One pair going away leaves the others be
+            clients[0].close()
+            for i in xrange(10):
+                if len(multi._pairs) == 2:
+                    break
+                multi._poll_once()
+            assert len(multi._pairs) == 2
+            assert far[0].recv(10) == ""
+            for (client, other) in zip(clients, far)[1:]:
+                self.both_ways(multi._poll_once, client, other)
+
+            # Timeouts are found by the sweep, again one pair at a time
+            (stuck, ok) = sorted(multi._pairs)
+            stuck[0]._timeouts["read"] = time.time() - 1
+            multi._next_sweep = time.time()
+            multi._poll_once()
+            assert multi._pairs == set([ok])
+            assert set(multi._handlers.values()) == set(ok)
+
+            for sock in clients + far:
+                sock.close()
+            multi._listener.close()
+            os.unlink(path)
+
+    def test_splice(self):
+        if relay.splice is None:
+            return
+
+        (a_far, a) = socket.socketpair()
+        (b, b_far) = socket.socketpair()
+        r = relay.Relay((a, a), (b, b))
+        assert r._a._pipe is not None and r._b._pipe is not None
+        self.both_ways(r._poll_once, a_far, b_far)
+        assert r._a._pipe_pending == 0 and r._b._pipe_pending == 0
+
+        for sock in (a_far, a, b, b_far):
+            sock.close()
+
+    def test_splice_fallback(self):
+        # As on a system where splice_find() comes back empty handed
+        splice = relay.splice
+        relay.splice = None
+        try:
+            (a_far, a) = socket.socketpair()
+            (b, b_far) = socket.socketpair()
+            r = relay.Relay((a, a), (b, b))
+            assert r._a._pipe is None and r._b._pipe is None
+            self.both_ways(r._poll_once, a_far, b_far)
+        finally:
+            relay.splice = splice
+
+        # Nor is splice used for anything but sockets and pipes
+        path = os.path.join(self.tmp, "file")
+        with open(path, "w") as f:
+            assert not relay.splice_ok(f.fileno())
+        assert relay.splice_ok(a.fileno())
+
+        for sock in (a_far, a, b, b_far):
+            sock.close()
+
+    def test_splice_unsupported(self):
+        # libc has splice(), but the kernel won't splice these descriptors
+        real_splice = relay.splice
+
+        def never(fd_in, fd_out, length):
+            raise OSError(errno.EINVAL, "Invalid argument")
+
+        def only_in(fd_in, fd_out, length):
+            # Into the pipe works, out of it doesn't: what was already
+            # spliced must still arrive, and in order
+            if fd_out in pipes:
+                return real_splice(fd_in, fd_out, length)
+            raise OSError(errno.EINVAL, "Invalid argument")
+
+        splices = [never]
+        if real_splice is not None:
+            splices.append(only_in)
+
+        for fake in splices:
+            relay.splice = fake
+            try:
+                (a_far, a) = socket.socketpair()
+                (b, b_far) = socket.socketpair()
+                r = relay.Relay((a, a), (b, b))
+                pipes = set([r._a._pipe[1], r._b._pipe[1]])
+                self.both_ways(r._poll_once, a_far, b_far)
+                assert r._a._pipe is None and r._b._pipe is None
+            finally:
+                relay.splice = real_splice
+
+            for sock in (a_far, a, b, b_far):
+                sock.close()